@@ -1,10 +1,15 @@
-from rest_framework import viewsets, filters, status
+from rest_framework import viewsets, filters, status, serializers
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.permissions import (
+    SAFE_METHODS, IsAuthenticated, IsAuthenticatedOrReadOnly
+)
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.permissions import AllowAny
 from .models import Categoria, Autor, Libro, Prestamo
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import render
 from rest_framework.decorators import api_view, throttle_classes
 from .throttles import BurstRateThrottle
@@ -12,13 +17,237 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from .external_services import GoogleBooksAPI
+from .busqueda import BusquedaTextoFilter
+from .codecs import PARSER_CLASSES, RENDERER_CLASSES
+from .cache_respuestas import cachear_respuesta
+from .condicional import (
+    PrecondicionFallida, agregar_validadores, mas_reciente, precondiciones_cumplidas,
+    respuesta_no_modificada, validadores_detalle, validadores_filas
+)
+from .autocompletado import autocompletado
+from .paginacion import KeysetPagination
+from .lectura_rapida import (
+    COLUMNAS_VIGENCIA_PRESTAMO, DERIVADOS_LIBROS, DERIVADOS_PRESTAMOS, LecturaRapida,
+    vigencia_prestamo,
+)
+from .importacion import NDJSONParser, importar_libros
+from .inventario import AjustesInvalidos, DemasiadosAjustes, ajustar_stock
+from .exportacion import (
+    COLUMNAS_LIBROS, COLUMNAS_PRESTAMOS, FORMATOS, respuesta_exportacion
+)
 from .serializers import (
     CategoriaSerializer, AutorSerializer, 
     LibroSerializer, PrestamoSerializer
 )
 
 
-class CategoriaViewSet(viewsets.ModelViewSet):
+class CamposParcialesMixin:
+    """
+    `?fields=id,titulo,stock` / `?omit=descripcion` en lecturas: recorta los
+    campos del serializer y lee solo las columnas que esos campos necesitan
+    (`.only()`), con select_related únicamente para las relaciones pedidas.
+    """
+    campos_query_param = 'fields'
+    omitir_query_param = 'omit'
+    
+    def get_serializer(self, *args, **kwargs):
+        if self.request is not None and self.request.method == 'GET':
+            campos, omitir = self.get_campos_pedidos()
+            if campos is not None:
+                kwargs.setdefault('campos', campos)
+            if omitir:
+                kwargs.setdefault('omitir', omitir)
+        return super().get_serializer(*args, **kwargs)
+    
+    def get_campos_pedidos(self):
+        """(campos o None, campos a omitir) según la query string"""
+        params = self.request.query_params
+        campos = params.get(self.campos_query_param)
+        omitir = params.get(self.omitir_query_param)
+        campos = [c for c in campos.split(',') if c] if campos is not None else None
+        omitir = [c for c in omitir.split(',') if c] if omitir else []
+        
+        desconocidos = set(campos or ()).union(omitir) - set(
+            self.get_serializer_class()().fields
+        )
+        if desconocidos:
+            raise serializers.ValidationError({
+                'fields': f'Campos desconocidos: {", ".join(sorted(desconocidos))}'
+            })
+        return campos, omitir
+    
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return self.recortar_columnas(queryset)
+    
+    def get_columnas_extra(self):
+        """Columnas que la vista lee aunque el serializer no las muestre"""
+        return set()
+    
+    def recortar_columnas(self, queryset):
+        params = self.request.query_params
+        if self.request.method != 'GET' or not (
+            self.campos_query_param in params or params.get(self.omitir_query_param)
+        ):
+            return queryset
+        # Otro modelo (el objeto de una acción que serializa su relación)
+        if self.get_serializer_class().Meta.model is not queryset.model:
+            return queryset
+        
+        columnas = self.get_serializer().columnas_requeridas() | self.get_columnas_extra()
+        # El orden también se lee de la instancia (cursor de paginación)
+        modelo = queryset.model
+        for orden in queryset.query.order_by:
+            nombre = orden.lstrip('-') if isinstance(orden, str) else None
+            if nombre and nombre != 'pk' and nombre in {
+                f.name for f in modelo._meta.concrete_fields
+            }:
+                columnas.add(nombre)
+        relaciones = {c.split('__', 1)[0] for c in columnas if '__' in c}
+        queryset = queryset.select_related(None)
+        if relaciones:
+            queryset = queryset.select_related(*relaciones)
+        return queryset.only(*columnas)
+
+
+class GetCondicionalMixin:
+    """
+    ETag / Last-Modified en listados y detalle, con 304 sin serializar, e
+    If-Match / If-Unmodified-Since en escrituras (412 si el recurso cambió).
+    Debe ir antes de CamposParcialesMixin y LecturaRapidaMixin.
+    """
+    campo_modificacion = 'fecha_actualizacion'
+    # Versiones de cache de las relaciones que muestra el serializer
+    espacios_etag = ()
+    
+    def get_columnas_extra(self):
+        return super().get_columnas_extra() | {self.campo_modificacion}
+    
+    def verificar_filas(self, filas, pagina):
+        derivados, desde = self.validadores_derivados(filas)
+        etag, ultima = validadores_filas(
+            filas, self.campo_modificacion, self.espacios_etag,
+            [*(self.extra_validadores() if pagina else ()), *derivados]
+        )
+        ultima = mas_reciente(ultima, desde)
+        self.validadores = etag, ultima
+        return respuesta_no_modificada(self.request._request, etag, ultima)
+    
+    def extra_validadores(self):
+        paginador = self.paginator
+        extra = [paginador.get_next_link(), paginador.get_previous_link()]
+        pagina = getattr(paginador, 'page', None)
+        if hasattr(pagina, 'paginator'):  # Paginación numerada: muestra 'count'
+            extra.append(pagina.paginator.count)
+        return extra
+    
+    def validadores_derivados(self, filas):
+        """
+        (valores para el ETag, desde cuándo valen) de los campos que cambian
+        con la hora aunque las filas no cambien; por defecto ninguno
+        """
+        return (), None
+    
+    def listar(self, queryset, paginar=True):
+        self.validadores = None
+        respuesta = super().listar(queryset, paginar)
+        if self.validadores is None:
+            return respuesta
+        return agregar_validadores(respuesta, *self.validadores)
+    
+    def retrieve(self, request, *args, **kwargs):
+        instancia = self.get_object()
+        derivados, desde = self.validadores_derivados([instancia])
+        etag, ultima = validadores_detalle(
+            instancia, self.campo_modificacion, self.espacios_etag, derivados
+        )
+        ultima = mas_reciente(ultima, desde)
+        no_modificada = respuesta_no_modificada(request._request, etag, ultima)
+        if no_modificada is not None:
+            return no_modificada
+        return agregar_validadores(
+            Response(self.get_serializer(instancia).data), etag, ultima
+        )
+    
+    def get_object(self):
+        instancia = super().get_object()
+        if self.request.method not in SAFE_METHODS and not precondiciones_cumplidas(
+            self.request, instancia, self.campo_modificacion
+        ):
+            raise PrecondicionFallida()
+        return instancia
+    
+    def version_leida(self, instancia):
+        """
+        Fecha validada por If-Match, para condicionar el UPDATE y no pisar
+        una escritura concurrente posterior a la comprobación; None sin If-Match
+        """
+        if 'HTTP_IF_MATCH' not in self.request.META:
+            return None
+        return getattr(instancia, self.campo_modificacion)
+
+
+class LecturaRapidaMixin:
+    """
+    El listado se serializa desde `.values()` con LecturaRapida (misma
+    salida, sin instanciar modelos); detalle y escrituras usan el serializer
+    """
+    derivados_lectura = {}
+    
+    def list(self, request, *args, **kwargs):
+        return self.listar(self.filter_queryset(self.get_queryset()))
+    
+    def get_columnas_extra(self):
+        return set()
+    
+    def verificar_filas(self, filas, pagina):
+        """
+        Se llama con las filas a serializar (pagina=True si están paginadas);
+        una respuesta distinta de None la reemplaza sin serializar
+        """
+        return None
+    
+    def listar(self, queryset, paginar=True):
+        serializer = self.get_serializer()
+        if LecturaRapida.soporta(serializer, self.derivados_lectura):
+            lectura = LecturaRapida(serializer, self.derivados_lectura)
+            queryset = lectura.preparar(queryset, self.get_columnas_extra())
+            serializar = lectura.serializar
+        else:
+            serializar = lambda filas: self.get_serializer(filas, many=True).data
+        
+        pagina = self.paginate_queryset(queryset) if paginar else None
+        filas = pagina if pagina is not None else list(queryset)
+        respuesta = self.verificar_filas(filas, pagina is not None)
+        if respuesta is not None:
+            return respuesta
+        if pagina is not None:
+            return self.get_paginated_response(serializar(filas))
+        return Response(serializar(filas))
+
+
+class ExportacionMixin:
+    """
+    Agrega GET /exportar/?formato=csv|ndjson con los mismos filtros del
+    listado, en streaming y sin paginar
+    """
+    columnas_exportacion = None
+    
+    @action(detail=False, methods=['get'])
+    def exportar(self, request):
+        formato = request.query_params.get('formato', 'csv')
+        if formato not in FORMATOS:
+            return Response(
+                {'error': f'Formato no soportado. Opciones: {", ".join(FORMATOS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        queryset = self.filter_queryset(self.get_queryset())
+        return respuesta_exportacion(
+            queryset, self.columnas_exportacion, formato, self.basename
+        )
+
+
+class CategoriaViewSet(CamposParcialesMixin, viewsets.ModelViewSet):
     """
     ViewSet para Categorías
     - GET /api/categorias/ - Listar todas
@@ -30,60 +259,133 @@ class CategoriaViewSet(viewsets.ModelViewSet):
     queryset = Categoria.objects.all()
     serializer_class = CategoriaSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    renderer_classes = RENDERER_CLASSES
+    parser_classes = PARSER_CLASSES
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['nombre', 'descripcion']
     ordering_fields = ['nombre', 'fecha_creacion']
     ordering = ['nombre']
+    
+    @cachear_respuesta('categorias')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
 
-class AutorViewSet(viewsets.ModelViewSet):
+class AutorViewSet(CamposParcialesMixin, viewsets.ModelViewSet):
     """ViewSet para Autores"""
     
     queryset = Autor.objects.all()
     serializer_class = AutorSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    renderer_classes = RENDERER_CLASSES
+    parser_classes = PARSER_CLASSES
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_fields = ['pais_origen']
     search_fields = ['nombre', 'apellido', 'biografia']
     ordering_fields = ['apellido', 'nombre', 'fecha_creacion']
     ordering = ['apellido', 'nombre']
     
+    def get_serializer_class(self):
+        # ?fields / ?omit de /libros/ se validan contra los campos del libro
+        if self.action == 'libros':
+            return LibroSerializer
+        return super().get_serializer_class()
+    
     @action(detail=True, methods=['get'])
+    @cachear_respuesta('libros', 'autores', 'categorias')
     def libros(self, request, pk=None):
         """Endpoint personalizado: /api/autores/{id}/libros/"""
         autor = self.get_object()
-        libros = autor.libros.filter(activo=True)
-        serializer = LibroSerializer(libros, many=True)
+        libros = self.recortar_columnas(
+            autor.libros.filter(activo=True).select_related('autor', 'categoria')
+        )
+        serializer = self.get_serializer(libros, many=True)
         return Response(serializer.data)
 
 
-class LibroViewSet(viewsets.ModelViewSet):
+class LibroViewSet(GetCondicionalMixin, CamposParcialesMixin, LecturaRapidaMixin,
+                   ExportacionMixin, viewsets.ModelViewSet):
     """ViewSet para Libros"""
     
     queryset = Libro.objects.filter(activo=True).select_related('autor', 'categoria')
     serializer_class = LibroSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    renderer_classes = RENDERER_CLASSES
+    parser_classes = PARSER_CLASSES
+    pagination_class = KeysetPagination
+    # La búsqueda va después del ordenamiento para poder ordenar por
+    # relevancia; sus columnas las fija el índice (ver busqueda.py)
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter, BusquedaTextoFilter]
     filterset_fields = ['estado', 'categoria', 'autor']
-    search_fields = ['titulo', 'isbn', 'descripcion']
+    columnas_exportacion = COLUMNAS_LIBROS
+    derivados_lectura = DERIVADOS_LIBROS
+    espacios_etag = ('autores', 'categorias')
     ordering_fields = ['titulo', 'precio', 'fecha_publicacion', 'valoracion']
     ordering = ['-fecha_creacion']
     
+    @cachear_respuesta('libros', 'autores', 'categorias')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+    
     @action(detail=False, methods=['get'])
+    @cachear_respuesta('libros', 'autores', 'categorias')
     def disponibles(self, request):
         """Endpoint: /api/libros/disponibles/"""
-        libros = self.queryset.filter(
+        libros = self.recortar_columnas(self.queryset.filter(
             estado=Libro.DISPONIBLE,
             stock__gt=0
-        )
-        serializer = self.get_serializer(libros, many=True)
-        return Response(serializer.data)
+        ))
+        return self.listar(libros, paginar=False)
+    
+    @action(detail=False, methods=['get'])
+    def autocompletar(self, request):
+        """
+        Endpoint: /api/libros/autocompletar/?q=cien&limite=10
+        Sugerencias por prefijo de título, autor o ISBN desde el índice en
+        memoria (no consulta la base de datos por tecla)
+        """
+        try:
+            limite = min(int(request.query_params.get('limite', 10)), 50)
+        except ValueError:
+            return Response(
+                {'error': 'El límite debe ser un número entero'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(autocompletado.buscar(request.query_params.get('q', ''), limite))
+    
+    @action(detail=False, methods=['post'], parser_classes=PARSER_CLASSES + [NDJSONParser])
+    def importar(self, request):
+        """
+        Endpoint: POST /api/libros/importar/
+        Body: arreglo JSON o NDJSON (application/x-ndjson) de libros con
+        {"isbn", "titulo", "autor": {"nombre", "apellido"}, "categoria", ...}.
+        Crea o actualiza por ISBN en una sola transacción.
+        """
+        filas = request.data
+        if not isinstance(filas, list):
+            return Response(
+                {'error': 'Se espera un arreglo de libros'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        maximo = getattr(settings, 'IMPORTACION_MAX_FILAS', 20000)
+        if len(filas) > maximo:
+            return Response(
+                {'error': f'Máximo {maximo} libros por solicitud'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        resultados = importar_libros(filas, usuario=request.user)
+        resumen = {'creado': 0, 'actualizado': 0, 'duplicado': 0, 'error': 0}
+        for resultado in resultados:
+            resumen[resultado['resultado']] += 1
+        return Response({'resumen': resumen, 'resultados': resultados})
     
     @action(detail=True, methods=['post'])
     def actualizar_stock(self, request, pk=None):
         """
         Endpoint: POST /api/libros/{id}/actualizar_stock/
         Body: {"cantidad": 5}  (puede ser negativo para restar)
+        Con If-Match (ETag del detalle) responde 412 si el libro cambió
         """
         libro = self.get_object()
         cantidad = request.data.get('cantidad', 0)
@@ -96,26 +398,81 @@ class LibroViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        libro.actualizar_stock(cantidad)
+        version = self.version_leida(libro)
+        if not libro.actualizar_stock(cantidad, version=version):
+            # Sin If-Match solo falla si el libro ya no existe
+            if version is None or not Libro.objects.filter(pk=libro.pk).exists():
+                raise NotFound()
+            raise PrecondicionFallida()
         serializer = self.get_serializer(libro)
         return Response(serializer.data)
+    
+    @action(detail=False, methods=['post'])
+    def ajustar_stock(self, request):
+        """
+        Endpoint: POST /api/libros/ajustar_stock/
+        Body: arreglo de ajustes {"libro_id" o "isbn", "cantidad" o "stock"};
+        `cantidad` suma (o resta) y `stock` fija el valor final.
+        Se aplican todos o ninguno, en una sola transacción.
+        """
+        ajustes = request.data
+        if not isinstance(ajustes, list):
+            return Response(
+                {'error': 'Se espera un arreglo de ajustes'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            libros = ajustar_stock(ajustes)
+        except DemasiadosAjustes as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        except AjustesInvalidos as exc:
+            return Response({'errores': exc.errores}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'libros': libros})
 
 
-class PrestamoViewSet(viewsets.ModelViewSet):
+class PrestamoViewSet(GetCondicionalMixin, CamposParcialesMixin, LecturaRapidaMixin,
+                      ExportacionMixin, viewsets.ModelViewSet):
     """ViewSet para Préstamos"""
     
     queryset = Prestamo.objects.all().select_related('libro', 'usuario')
     serializer_class = PrestamoSerializer
     permission_classes = [AllowAny]
+    renderer_classes = RENDERER_CLASSES
+    parser_classes = PARSER_CLASSES
+    pagination_class = KeysetPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['estado', 'usuario']
     ordering_fields = ['fecha_prestamo', 'fecha_devolucion_esperada']
     ordering = ['-fecha_prestamo']
+    columnas_exportacion = COLUMNAS_PRESTAMOS
+    derivados_lectura = DERIVADOS_PRESTAMOS
+    espacios_etag = ('libros', 'usuarios')
+    
+    def get_columnas_extra(self):
+        return super().get_columnas_extra() | set(COLUMNAS_VIGENCIA_PRESTAMO)
+    
+    def validadores_derivados(self, filas):
+        """dias_prestamo y esta_atrasado cambian con la hora"""
+        valores, desde = [], None
+        for fila in filas:
+            if not isinstance(fila, dict):
+                fila = {columna: getattr(fila, columna) for columna in COLUMNAS_VIGENCIA_PRESTAMO}
+            derivados, vigente = vigencia_prestamo(fila)
+            valores.append(derivados)
+            desde = mas_reciente(desde, vigente)
+        return valores, desde
     
     def perform_create(self, serializer):
         """Al crear préstamo, asignar usuario actual y actualizar stock"""
-        prestamo = serializer.save(usuario=self.request.user)
-        prestamo.libro.actualizar_stock(-1)  # Reducir stock en 1
+        with transaction.atomic():
+            # Reservar el ejemplar con un UPDATE condicional antes de crear
+            # el préstamo: si otro préstamo se llevó el último, no se crea
+            if not serializer.validated_data['libro'].prestar_ejemplar():
+                raise serializers.ValidationError({
+                    'libro': 'Este libro no está disponible para préstamo'
+                })
+            serializer.save(usuario=self.request.user)
     
     @action(detail=True, methods=['post'])
     def devolver(self, request, pk=None):
@@ -126,20 +483,38 @@ class PrestamoViewSet(viewsets.ModelViewSet):
         from django.utils import timezone
         
         prestamo = self.get_object()
+        version = self.version_leida(prestamo)
         
-        if prestamo.estado == Prestamo.DEVUELTO:
-            return Response(
-                {'error': 'Este préstamo ya fue devuelto'},
-                status=status.HTTP_400_BAD_REQUEST
+        with transaction.atomic():
+            # Solo una devolución concurrente puede pasar el préstamo a
+            # DEVUELTO; con If-Match, solo si nadie lo modificó desde entonces
+            filtro = {'pk': prestamo.pk}
+            if version is not None:
+                filtro['fecha_actualizacion'] = version
+            devueltos = Prestamo.objects.filter(**filtro).exclude(
+                estado=Prestamo.DEVUELTO
+            ).update(
+                estado=Prestamo.DEVUELTO,
+                fecha_devolucion_real=timezone.now(),
+                fecha_actualizacion=timezone.now()
             )
+            if not devueltos:
+                actual = Prestamo.objects.filter(pk=prestamo.pk).values_list(
+                    'fecha_actualizacion', flat=True
+                ).first()
+                if actual is None:
+                    raise NotFound()
+                if version is not None and actual != version:
+                    raise PrecondicionFallida()
+                return Response(
+                    {'error': 'Este préstamo ya fue devuelto'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            # Incrementar stock del libro
+            prestamo.libro.actualizar_stock(1)
         
-        prestamo.fecha_devolucion_real = timezone.now()
-        prestamo.estado = Prestamo.DEVUELTO
-        prestamo.save()
-        
-        # Incrementar stock del libro
-        prestamo.libro.actualizar_stock(1)
-        
+        prestamo.refresh_from_db(fields=['estado', 'fecha_devolucion_real'])
         serializer = self.get_serializer(prestamo)
         return Response(serializer.data)
 
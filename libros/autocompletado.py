@@ -0,0 +1,264 @@
+"""
+Índice de prefijos en memoria para /api/libros/autocompletar/.
+
+Cada proceso mantiene arreglos ordenados de claves normalizadas (título e
+ISBN de cada libro activo, nombre completo y apellido de cada autor) que se
+consultan con `bisect`, sin tocar la base de datos por tecla.
+
+El índice se construye la primera vez que se consulta, se actualiza al
+instante con las señales de Libro/Autor del propio proceso y, para ver las
+escrituras de otros procesos, cada AUTOCOMPLETADO_SYNC_SEGUNDOS trae los
+libros con `fecha_actualizacion` posterior a la última sincronización menos
+AUTOCOMPLETADO_SYNC_MARGEN_SEGUNDOS: `fecha_actualizacion` se fija al
+guardar, no al confirmar, y una transacción que guardó antes de la marca
+pero confirmó después quedaría afuera. Reaplicar un libro ya visto no
+cambia nada.
+
+Lo que esa consulta no ve (los borrados y los cambios de nombre de autores
+en otros procesos, o transacciones más largas que el margen) se corrige con
+una recarga completa cada AUTOCOMPLETADO_RECARGA_SEGUNDOS.
+"""
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def normalizar(texto):
+    """Minúsculas, sin acentos ni signos y con espacios simples"""
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = ''.join(c if c.isalnum() else ' ' for c in texto.lower())
+    return ' '.join(texto.split())
+
+
+class IndicePrefijos:
+    """Pares (clave, id) ordenados en dos listas paralelas"""
+
+    def __init__(self):
+        self.claves = []
+        self.ids = []
+
+    def agregar(self, clave, id_):
+        if not clave:
+            return
+        posicion = bisect_left(self.claves, clave)
+        # Entre claves iguales se mantienen los ids ordenados
+        while posicion < len(self.claves) and self.claves[posicion] == clave \
+                and self.ids[posicion] < id_:
+            posicion += 1
+        self.claves.insert(posicion, clave)
+        self.ids.insert(posicion, id_)
+
+    def quitar(self, clave, id_):
+        posicion = bisect_left(self.claves, clave)
+        while posicion < len(self.claves) and self.claves[posicion] == clave:
+            if self.ids[posicion] == id_:
+                del self.claves[posicion]
+                del self.ids[posicion]
+                return
+            posicion += 1
+
+    def buscar(self, prefijo):
+        """Genera los ids cuyas claves empiezan por `prefijo`, en orden"""
+        posicion = bisect_left(self.claves, prefijo)
+        while posicion < len(self.claves) and self.claves[posicion].startswith(prefijo):
+            yield self.ids[posicion]
+            posicion += 1
+
+    @classmethod
+    def desde_pares(cls, pares):
+        """Construcción en bloque: un solo sort en lugar de n inserciones"""
+        indice = cls()
+        for clave, id_ in sorted(par for par in pares if par[0]):
+            indice.claves.append(clave)
+            indice.ids.append(id_)
+        return indice
+
+
+class AutocompletadoLibros:
+    """Índices de libros y autores más las etiquetas que devuelve la API"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._cargado = False
+        self._ultima_sync = 0.0
+        self._ultima_carga = 0.0
+        self._marca_sync = None
+
+    # ===== Construcción y sincronización =====
+
+    def cargar(self):
+        """Reconstruye todo el índice desde la base de datos"""
+        from .models import Autor, Libro
+
+        marca = timezone.now()
+        autores = {
+            autor_id: f'{nombre} {apellido}'
+            for autor_id, nombre, apellido in
+            Autor.objects.values_list('id', 'nombre', 'apellido').iterator()
+        }
+        libros = {}
+        libros_por_autor = {}
+        pares_libros = []
+        for libro_id, titulo, isbn, autor_id in Libro.objects.filter(
+            activo=True
+        ).values_list('id', 'titulo', 'isbn', 'autor_id').iterator(chunk_size=5000):
+            libros[libro_id] = (titulo, isbn, autor_id)
+            libros_por_autor.setdefault(autor_id, set()).add(libro_id)
+            pares_libros.append((normalizar(titulo), libro_id))
+            pares_libros.append((normalizar(isbn), libro_id))
+
+        pares_autores = []
+        for autor_id, nombre_completo in autores.items():
+            pares_autores.extend(self._claves_autor(nombre_completo, autor_id))
+
+        with self._lock:
+            self._autores = autores
+            self._libros = libros
+            self._libros_por_autor = libros_por_autor
+            self._indice_libros = IndicePrefijos.desde_pares(pares_libros)
+            self._indice_autores = IndicePrefijos.desde_pares(pares_autores)
+            self._marca_sync = marca
+            self._ultima_sync = self._ultima_carga = time.monotonic()
+            self._cargado = True
+
+    def sincronizar(self):
+        """
+        Aplica los libros modificados por otros procesos desde la última
+        marca, con el margen para los que confirmaron tarde
+        """
+        from .models import Autor, Libro
+
+        marca = timezone.now()
+        margen = timedelta(seconds=getattr(settings, 'AUTOCOMPLETADO_SYNC_MARGEN_SEGUNDOS', 60))
+        cambios = list(Libro.objects.filter(
+            fecha_actualizacion__gte=self._marca_sync - margen
+        ).values_list('id', 'titulo', 'isbn', 'autor_id', 'activo'))
+        nuevos_autores = {fila[3] for fila in cambios} - self._autores.keys()
+        if nuevos_autores:
+            for autor in Autor.objects.filter(pk__in=nuevos_autores):
+                self.autor_guardado(autor)
+        with self._lock:
+            for libro_id, titulo, isbn, autor_id, activo in cambios:
+                self._quitar_libro(libro_id)
+                if activo:
+                    self._agregar_libro(libro_id, titulo, isbn, autor_id)
+            self._marca_sync = marca
+            self._ultima_sync = time.monotonic()
+
+    def _asegurar_cargado(self):
+        if not self._cargado or time.monotonic() - self._ultima_carga > getattr(
+            settings, 'AUTOCOMPLETADO_RECARGA_SEGUNDOS', 600
+        ):
+            self.cargar()
+        elif time.monotonic() - self._ultima_sync > getattr(
+            settings, 'AUTOCOMPLETADO_SYNC_SEGUNDOS', 30
+        ):
+            self.sincronizar()
+
+    # ===== Actualización incremental (señales) =====
+
+    def libro_guardado(self, libro):
+        if not self._cargado:
+            return
+        with self._lock:
+            self._quitar_libro(libro.pk)
+            if libro.activo:
+                self._agregar_libro(libro.pk, libro.titulo, libro.isbn, libro.autor_id)
+
+    def libro_eliminado(self, libro):
+        if not self._cargado:
+            return
+        with self._lock:
+            self._quitar_libro(libro.pk)
+
+    def autor_guardado(self, autor):
+        if not self._cargado:
+            return
+        with self._lock:
+            anterior = self._autores.get(autor.pk)
+            if anterior is not None:
+                for clave, autor_id in self._claves_autor(anterior, autor.pk):
+                    self._indice_autores.quitar(clave, autor_id)
+            self._autores[autor.pk] = autor.nombre_completo
+            for clave, autor_id in self._claves_autor(autor.nombre_completo, autor.pk):
+                self._indice_autores.agregar(clave, autor_id)
+
+    def autor_eliminado(self, autor):
+        if not self._cargado:
+            return
+        with self._lock:
+            nombre_completo = self._autores.pop(autor.pk, None)
+            if nombre_completo is not None:
+                for clave, autor_id in self._claves_autor(nombre_completo, autor.pk):
+                    self._indice_autores.quitar(clave, autor_id)
+
+    def _agregar_libro(self, libro_id, titulo, isbn, autor_id):
+        self._libros[libro_id] = (titulo, isbn, autor_id)
+        self._libros_por_autor.setdefault(autor_id, set()).add(libro_id)
+        self._indice_libros.agregar(normalizar(titulo), libro_id)
+        self._indice_libros.agregar(normalizar(isbn), libro_id)
+
+    def _quitar_libro(self, libro_id):
+        datos = self._libros.pop(libro_id, None)
+        if datos is None:
+            return
+        titulo, isbn, autor_id = datos
+        self._libros_por_autor.get(autor_id, set()).discard(libro_id)
+        self._indice_libros.quitar(normalizar(titulo), libro_id)
+        self._indice_libros.quitar(normalizar(isbn), libro_id)
+
+    @staticmethod
+    def _claves_autor(nombre_completo, autor_id):
+        """Se busca por "nombre apellido" y también por el apellido solo"""
+        normalizado = normalizar(nombre_completo)
+        claves = {normalizado}
+        if ' ' in normalizado:
+            claves.add(normalizado.split(' ', 1)[1])
+        return [(clave, autor_id) for clave in claves]
+
+    # ===== Consulta =====
+
+    def buscar(self, texto, limite=10):
+        """
+        Devuelve hasta `limite` libros como [{'id', 'label'}]: primero los
+        que coinciden por título/ISBN y luego los de autores que coinciden.
+        """
+        prefijo = normalizar(texto)
+        if not prefijo:
+            return []
+        self._asegurar_cargado()
+
+        resultados = []
+        vistos = set()
+        with self._lock:
+            candidatos = self._indice_libros.buscar(prefijo)
+            for libro_id in candidatos:
+                if libro_id not in vistos:
+                    vistos.add(libro_id)
+                    resultados.append(self._etiqueta(libro_id))
+                    if len(resultados) >= limite:
+                        return resultados
+            for autor_id in self._indice_autores.buscar(prefijo):
+                for libro_id in self._libros_por_autor.get(autor_id, ()):
+                    if libro_id not in vistos:
+                        vistos.add(libro_id)
+                        resultados.append(self._etiqueta(libro_id))
+                        if len(resultados) >= limite:
+                            return resultados
+        return resultados
+
+    def _etiqueta(self, libro_id):
+        titulo, _isbn, autor_id = self._libros[libro_id]
+        return {
+            'id': libro_id,
+            'label': f'{titulo} - {self._autores.get(autor_id, "")}',
+        }
+
+
+autocompletado = AutocompletadoLibros()
@@ -0,0 +1,102 @@
+"""
+Búsqueda de texto completo del catálogo.
+
+Producción (MySQL) usa el índice FULLTEXT `libro_texto_idx` sobre titulo,
+isbn y descripcion; la insensibilidad a acentos la da la collation `*_ai_ci` de
+las columnas. En local/tests (SQLite) se usa la tabla FTS5
+`libros_libro_fts` con `remove_diacritics`, sincronizada por triggers.
+Ambos índices se crean en la migración 0005_busqueda_texto_completo.
+"""
+import re
+
+from django.db import connections
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+
+# Guiones entre dígitos (ISBN escrito como 978-84-...) no separan términos
+_GUION_ISBN = re.compile(r'(?<=\d)-(?=\d)')
+_PALABRA = re.compile(r'\w+')
+
+TABLA_FTS = 'libros_libro_fts'
+
+
+def obtener_terminos(texto):
+    """Separa el texto en términos seguros para la sintaxis de cualquier motor"""
+    return _PALABRA.findall(_GUION_ISBN.sub('', texto or ''))
+
+
+def buscar_libros(queryset, texto):
+    """
+    Filtra `queryset` (de Libro) por todos los términos de `texto`, como
+    prefijos, y lo anota con `relevancia` (mayor es mejor). No cambia el orden.
+    """
+    palabras = obtener_terminos(texto)
+    if not palabras:
+        return queryset.annotate(relevancia=Value(0.0, output_field=FloatField()))
+
+    vendor = connections[queryset.db].vendor
+    motor = MOTORES.get(vendor, _buscar_icontains)
+    return motor(queryset, palabras)
+
+
+def _buscar_sqlite(queryset, palabras):
+    tabla = queryset.model._meta.db_table
+    consulta = ' AND '.join(f'"{palabra}"*' for palabra in palabras)
+    # Join directo con la tabla FTS5: una subconsulta correlacionada para la
+    # relevancia repetiría el MATCH por cada fila encontrada.
+    # bm25() (rank) es menor cuanto más relevante.
+    return queryset.extra(
+        tables=[TABLA_FTS],
+        where=[f'{TABLA_FTS}.rowid = "{tabla}"."id"', f'{TABLA_FTS} MATCH %s'],
+        params=[consulta],
+        select={'relevancia': f'-{TABLA_FTS}.rank'},
+    )
+
+
+def _buscar_mysql(queryset, palabras):
+    tabla = queryset.model._meta.db_table
+    consulta = ' '.join(f'+{palabra}*' for palabra in palabras)
+    relevancia = RawSQL(
+        f'MATCH (`{tabla}`.`titulo`, `{tabla}`.`isbn`, `{tabla}`.`descripcion`) '
+        f'AGAINST (%s IN BOOLEAN MODE)',
+        [consulta], output_field=FloatField()
+    )
+    return queryset.annotate(relevancia=relevancia).filter(relevancia__gt=0)
+
+
+def _buscar_icontains(queryset, palabras):
+    """Respaldo para motores sin índice de texto completo"""
+    for palabra in palabras:
+        queryset = queryset.filter(
+            Q(titulo__icontains=palabra) | Q(isbn__icontains=palabra)
+            | Q(descripcion__icontains=palabra)
+        )
+    return queryset.annotate(relevancia=Value(0.0, output_field=FloatField()))
+
+
+MOTORES = {
+    'sqlite': _buscar_sqlite,
+    'mysql': _buscar_mysql,
+}
+
+
+class BusquedaTextoFilter(filters.SearchFilter):
+    """
+    SearchFilter que resuelve `?search=` con el índice de texto completo.
+    Debe ir después de OrderingFilter: si el cliente no pide `?ordering=`
+    los resultados se ordenan por relevancia. No usa `search_fields`: las
+    columnas son las del índice.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        texto = ' '.join(self.get_search_terms(request))
+        if not texto:
+            return queryset
+
+        queryset = buscar_libros(queryset, texto)
+        if not request.query_params.get(api_settings.ORDERING_PARAM):
+            queryset = queryset.order_by('-relevancia', '-fecha_creacion')
+        return queryset
@@ -0,0 +1,202 @@
+"""
+Cache de respuestas de lectura del catálogo sobre el backend de cache de Django.
+
+La clave combina la vista, el host, los parámetros de la query string
+ordenados, la clase de autenticación y la versión de cada espacio del que
+depende la respuesta ('libros', 'autores', 'categorias', 'usuarios'). Invalidar un
+espacio es incrementar su versión: las claves viejas dejan de consultarse y
+expiran solas, sin tener que enumerarlas.
+
+Ante una clave fría, solo un proceso calcula la respuesta (candado con
+`cache.add`); los demás esperan a que aparezca en lugar de ir todos a la base.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+
+PREFIJO = 'respuestas'
+ESPACIOS = ('libros', 'autores', 'categorias', 'usuarios')
+# Validadores de GET condicional que se guardan junto con los datos
+CABECERAS = ('ETag', 'Last-Modified')
+
+
+def obtener_cache():
+    return caches[getattr(settings, 'RESPUESTAS_CACHE_ALIAS', 'default')]
+
+
+def _segundos():
+    return getattr(settings, 'RESPUESTAS_CACHE_SEGUNDOS', 300)
+
+
+# ===== Versiones por espacio =====
+
+def _clave_version(espacio):
+    return f'{PREFIJO}:version:{espacio}'
+
+
+def obtener_versiones(espacios):
+    cache = obtener_cache()
+    claves = [_clave_version(espacio) for espacio in espacios]
+    versiones = cache.get_many(claves)
+    for clave in claves:
+        if clave not in versiones:
+            # Si la versión se perdió (expulsión), arrancar de un valor que
+            # no pueda coincidir con una versión anterior
+            cache.add(clave, time.time_ns(), None)
+            versiones[clave] = cache.get(clave)
+    return [versiones[clave] for clave in claves]
+
+
+def _incrementar_versiones(espacios):
+    cache = obtener_cache()
+    for espacio in espacios:
+        try:
+            cache.incr(_clave_version(espacio))
+        except ValueError:
+            cache.add(_clave_version(espacio), time.time_ns(), None)
+
+
+def invalidar(*espacios):
+    """
+    Incrementa la versión de los espacios ya y, si hay una transacción en
+    curso, otra vez al confirmarla: una lectura hecha entre ambos momentos
+    pudo guardar datos viejos con la versión intermedia.
+    """
+    _incrementar_versiones(espacios)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _incrementar_versiones(espacios))
+
+
+# ===== Estadísticas =====
+
+def _contar(vista, evento):
+    cache = obtener_cache()
+    clave = f'{PREFIJO}:estadisticas:{vista}:{evento}'
+    try:
+        cache.incr(clave)
+    except ValueError:
+        if not cache.add(clave, 1, None):
+            cache.incr(clave)
+
+
+def estadisticas(vistas):
+    """{vista: {'aciertos': n, 'fallos': n, 'esperas': n}}"""
+    cache = obtener_cache()
+    eventos = ('aciertos', 'fallos', 'esperas')
+    valores = cache.get_many([
+        f'{PREFIJO}:estadisticas:{vista}:{evento}' for vista in vistas for evento in eventos
+    ])
+    return {
+        vista: {
+            evento: valores.get(f'{PREFIJO}:estadisticas:{vista}:{evento}', 0)
+            for evento in eventos
+        }
+        for vista in vistas
+    }
+
+
+# ===== Consulta =====
+
+def clave_respuesta(vista, request, espacios):
+    autenticador = request.successful_authenticator
+    clase_auth = type(autenticador).__name__ if autenticador else 'anonimo'
+    parametros = sorted(
+        (nombre, request.query_params.getlist(nombre)) for nombre in request.query_params
+    )
+    huella = hashlib.md5(repr(
+        (request.get_host(), request.path, parametros, clase_auth)
+    ).encode()).hexdigest()
+    versiones = '.'.join(str(v) for v in obtener_versiones(espacios))
+    return f'{PREFIJO}:{vista}:{versiones}:{huella}'
+
+
+def obtener_o_calcular(vista, clave, calcular):
+    """
+    Devuelve (datos, origen) con origen 'HIT' o 'MISS'. `calcular` devuelve
+    (datos, cacheable). Con el candado tomado por otro proceso se espera
+    hasta RESPUESTAS_CACHE_ESPERA segundos antes de calcular sin candado.
+    """
+    cache = obtener_cache()
+    datos = cache.get(clave)
+    if datos is not None:
+        _contar(vista, 'aciertos')
+        return datos, 'HIT'
+
+    candado = f'{clave}:candado'
+    espera = getattr(settings, 'RESPUESTAS_CACHE_ESPERA', 5)
+    if not cache.add(candado, 1, espera):
+        _contar(vista, 'esperas')
+        limite = time.monotonic() + espera
+        while time.monotonic() < limite:
+            time.sleep(0.02)
+            datos = cache.get(clave)
+            if datos is not None:
+                _contar(vista, 'aciertos')
+                return datos, 'HIT'
+        candado = None
+
+    _contar(vista, 'fallos')
+    try:
+        datos, cacheable = calcular()
+        if cacheable:
+            cache.set(clave, datos, _segundos())
+    finally:
+        if candado:
+            cache.delete(candado)
+    return datos, 'MISS'
+
+
+def cachear_respuesta(*espacios):
+    """
+    Decorador para acciones GET de un viewset. Solo se guardan respuestas
+    200; permisos y throttling ya se evaluaron antes de llegar a la acción.
+    Los aciertos respetan If-None-Match / If-Modified-Since con el ETag y
+    Last-Modified guardados.
+    """
+    def decorador(metodo):
+        @wraps(metodo)
+        def envoltura(self, request, *args, **kwargs):
+            if request.method != 'GET':
+                return metodo(self, request, *args, **kwargs)
+
+            vista = f'{self.basename}-{metodo.__name__}'
+            respuestas = []
+
+            def calcular():
+                respuesta = metodo(self, request, *args, **kwargs)
+                respuestas.append(respuesta)
+                cabeceras = {c: respuesta[c] for c in CABECERAS if c in respuesta}
+                # Un 304 (HttpResponse, sin .data) tampoco se guarda
+                return (
+                    (getattr(respuesta, 'data', None), cabeceras),
+                    respuesta.status_code == status.HTTP_200_OK,
+                )
+
+            (datos, cabeceras), origen = obtener_o_calcular(
+                vista, clave_respuesta(vista, request, espacios), calcular
+            )
+            if respuestas:
+                respuesta = respuestas[0]
+            else:
+                respuesta = Response(datos, headers=cabeceras)
+                if 'ETag' in cabeceras:
+                    respuesta = get_conditional_response(
+                        request._request, etag=cabeceras['ETag'],
+                        last_modified=parse_http_date_safe(
+                            cabeceras.get('Last-Modified', '')
+                        ),
+                        response=respuesta,
+                    )
+            respuesta['X-Cache'] = origen
+            return respuesta
+        return envoltura
+    return decorador
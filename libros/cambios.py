@@ -0,0 +1,268 @@
+"""
+Publicación de los cambios de libros que originan las escrituras.
+
+Quien modifica un libro (Libro.save, actualizar_stock, prestar_ejemplar, el
+ajuste masivo de stock) arma las instantáneas en el momento y las deja con
+`registrar` en la bandeja de la transacción (transaction.on_commit). Al
+confirmarse se publican ya armadas, así ni el que difunde ni los consumers
+consultan la base; si la transacción o el savepoint se deshacen, Django
+descarta el callback y no sale nada.
+
+El callback solo pasa el lote al Publicador del event loop del servidor
+ASGI (o de un hilo propio, fuera de ASGI) y vuelve: el request no espera a
+los group_send. Cada instantánea va a las suscripciones GraphQL
+(suscripciones.publicar) y a los grupos de notificaciones de sus temas (ver
+`grupo_tema`), en lotes de hasta NOTIFICACIONES_MAX_LOTE libros por grupo
+del channel layer; los grupos de libro van por cubetas, así un ajuste de
+10.000 libros son unos cientos de group_send. También queda en
+`recientes`, el cache en memoria del proceso del que leen los `libro_update`
+de los clientes (difusion.py).
+
+Este módulo no importa los modelos para que models.py pueda usarlo.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+from functools import partial
+
+from asgiref.sync import SyncToAsync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .suscripciones import grupo_fisico, publicar
+from .utils import en_bloques
+
+logger = logging.getLogger(__name__)
+
+GRUPO = 'notificaciones'
+
+TEMA = re.compile(r'^(?:(todos|disponibles)|(libro|categoria):(\d+))$')
+
+# Último `disponible` difundido por libro, para avisar en el tema
+# disponibles cuando un libro deja de estarlo
+MAX_DISPONIBILIDAD = 100000
+_disponibilidad = OrderedDict()
+
+
+# ===== Temas =====
+
+def grupo_tema(tema):
+    """
+    Grupo del tema: 'todos' (el grupo global), 'disponibles' (libros
+    disponibles y los que dejan de estarlo), 'libro:<id>' o
+    'categoria:<id>'. None si el tema no es válido.
+    """
+    coincidencia = TEMA.match(tema) if isinstance(tema, str) else None
+    if coincidencia is None:
+        return None
+    general, tipo, id = coincidencia.groups()
+    if general == 'todos':
+        return GRUPO
+    if general:
+        return f'{GRUPO}.{general}'
+    return f'{GRUPO}.{tipo}.{int(id)}'
+
+
+def _afecta_disponibles(datos):
+    """Disponible ahora, o lo estaba (o no se sabe) en la última difusión"""
+    antes = _disponibilidad.pop(datos['id'], None)
+    _disponibilidad[datos['id']] = datos['disponible']
+    if len(_disponibilidad) > MAX_DISPONIBILIDAD:
+        _disponibilidad.popitem(last=False)
+    return datos['disponible'] or antes is not False
+
+
+def grupos_libro(datos):
+    """
+    Grupos de notificaciones que reciben el cambio de un libro (también la
+    categoría que acaba de dejar)
+    """
+    grupos = [GRUPO, f'{GRUPO}.libro.{datos["id"]}']
+    for campo in ('categoria_id', 'categoria_anterior_id'):
+        if datos.get(campo) is not None:
+            grupos.append(f'{GRUPO}.categoria.{datos[campo]}')
+    if _afecta_disponibles(datos):
+        grupos.append(f'{GRUPO}.disponibles')
+    return grupos
+
+
+# ===== Instantáneas recientes =====
+
+class Instantaneas:
+    """
+    Últimas instantáneas por id, con vencimiento
+    (NOTIFICACIONES_INSTANTANEAS_SEGUNDOS) y tamaño máximo
+    (NOTIFICACIONES_INSTANTANEAS_MAX, se descartan las más viejas). Se
+    escribe desde los hilos que confirman transacciones y se lee desde el
+    event loop, por eso el candado.
+    """
+
+    def __init__(self):
+        self.datos = OrderedDict()
+        self.candado = threading.Lock()
+
+    def guardar(self, libros):
+        expira = time.monotonic() + getattr(settings, 'NOTIFICACIONES_INSTANTANEAS_SEGUNDOS', 30)
+        maximo = getattr(settings, 'NOTIFICACIONES_INSTANTANEAS_MAX', 50000)
+        with self.candado:
+            for datos in libros:
+                self.datos.pop(datos['id'], None)
+                self.datos[datos['id']] = (expira, datos)
+            while len(self.datos) > maximo:
+                self.datos.popitem(last=False)
+
+    def obtener(self, libro_ids):
+        """({id: instantánea} de las vigentes, ids que faltan)"""
+        ahora = time.monotonic()
+        encontradas, faltan = {}, []
+        with self.candado:
+            for libro_id in libro_ids:
+                guardada = self.datos.get(libro_id)
+                if guardada is not None and guardada[0] > ahora:
+                    encontradas[libro_id] = guardada[1]
+                else:
+                    faltan.append(libro_id)
+        return encontradas, faltan
+
+    def limpiar(self):
+        with self.candado:
+            self.datos.clear()
+
+
+recientes = Instantaneas()
+
+
+# ===== Publicación =====
+
+async def difundir_instantaneas(libros):
+    """
+    Publica `libros` (instantáneas) en las suscripciones GraphQL y en un
+    frame `libros_actualizados` por grupo de notificaciones interesado (los
+    de libro, por cubeta: ver suscripciones.grupo_fisico)
+    """
+    capa = get_channel_layer()
+    if capa is None:
+        return
+    await publicar(libros)
+    por_grupo = defaultdict(list)
+    for datos in libros:
+        for grupo in {grupo_fisico(grupo) for grupo in grupos_libro(datos)}:
+            por_grupo[grupo].append(datos)
+    maximo = getattr(settings, 'NOTIFICACIONES_MAX_LOTE', 500)
+    for grupo, libros_grupo in por_grupo.items():
+        for lote in en_bloques(libros_grupo, maximo):
+            await capa.group_send(grupo, {'type': 'libros_actualizados', 'grupo': grupo, 'libros': lote})
+
+
+def libros_de_la_conexion(grupo, libros, grupos):
+    """
+    Los `libros` de un frame de `grupo` que le tocan a una conexión unida a
+    los grupos lógicos `grupos`: de una cubeta, solo los libros que sigue
+    """
+    if not grupo.startswith(f'{GRUPO}.libro.'):
+        return libros
+    return [datos for datos in libros if f'{GRUPO}.libro.{datos["id"]}' in grupos]
+
+
+class Publicador:
+    """
+    Junta en el event loop los lotes confirmados y los publica en una tarea,
+    con la última instantánea de cada libro; lo que llega mientras publica
+    sale en la vuelta siguiente
+    """
+
+    def __init__(self):
+        self.pendientes = {}
+        self.tarea = None
+
+    def agregar(self, libros):
+        for datos in libros:
+            self.pendientes.pop(datos['id'], None)
+            self.pendientes[datos['id']] = datos
+        if self.tarea is None:
+            self.tarea = asyncio.ensure_future(self._difundir())
+
+    async def _difundir(self):
+        try:
+            while self.pendientes:
+                libros, self.pendientes = list(self.pendientes.values()), {}
+                try:
+                    await difundir_instantaneas(libros)
+                except Exception:
+                    logger.exception('Error al publicar %d cambios de libros', len(libros))
+        finally:
+            self.tarea = None
+
+
+_publicadores = weakref.WeakKeyDictionary()
+
+
+def _agregar_en_loop(libros):
+    loop = asyncio.get_running_loop()
+    if loop not in _publicadores:
+        _publicadores[loop] = Publicador()
+    _publicadores[loop].agregar(libros)
+
+
+_hilo = {'pid': None, 'loop': None}
+_candado_hilo = threading.Lock()
+
+
+def _loop_publicacion():
+    """
+    El event loop del servidor ASGI si la escritura corre en uno de sus
+    hilos (sync_to_async), si no el de un hilo propio del proceso
+    """
+    if getattr(SyncToAsync.threadlocal, 'main_event_loop_pid', None) == os.getpid():
+        loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+        if loop is not None and loop.is_running():
+            return loop
+    with _candado_hilo:
+        if _hilo['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='publicador-cambios', daemon=True).start()
+            _hilo.update(pid=os.getpid(), loop=loop)
+        return _hilo['loop']
+
+
+def esperar_publicaciones(timeout=5):
+    """
+    Espera a que el hilo propio publique lo pendiente; al salir del proceso
+    (comandos de gestión) y en los tests
+    """
+    loop = _hilo['loop'] if _hilo['pid'] == os.getpid() else None
+    if loop is None or not loop.is_running():
+        return
+
+    async def vaciar():
+        publicador = _publicadores.get(loop)
+        while publicador is not None and publicador.tarea is not None:
+            await asyncio.wait([publicador.tarea])
+    asyncio.run_coroutine_threadsafe(vaciar(), loop).result(timeout)
+
+
+atexit.register(esperar_publicaciones)
+
+
+def _publicar(libros):
+    recientes.guardar(libros)
+    _loop_publicacion().call_soon_threadsafe(_agregar_en_loop, libros)
+
+
+def registrar(libros):
+    """
+    Publica las instantáneas `libros` cuando se confirme la transacción en
+    curso (enseguida si no hay ninguna). La publicación corre en segundo
+    plano: la escritura solo encola el lote, y un error al publicar se
+    registra en el log.
+    """
+    libros = list(libros)
+    if libros:
+        transaction.on_commit(partial(_publicar, libros), robust=True)
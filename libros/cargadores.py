@@ -0,0 +1,105 @@
+"""
+DataLoaders por request para las relaciones del schema GraphQL.
+
+La vista de GraphQL ejecuta en modo síncrono, así que no hay un tick del
+event loop donde juntar las claves pedidas como en un DataLoader asíncrono.
+En su lugar cada lista que devuelve un resolver se marca como un *nivel*
+(`nivel()`): cuando un objeto pide una relación que no está en cache, el
+cargador pide de una vez la de todos los objetos de su mismo nivel con un
+solo `IN`. Lo cargado se guarda por clave durante todo el request, y lo que
+devuelve cada lote forma a su vez el nivel siguiente.
+"""
+from collections import defaultdict
+
+from .models import Autor, Categoria, Libro
+
+
+def nivel(objetos):
+    """Materializa `objetos` y los marca como hermanos de un mismo nivel"""
+    objetos = list(objetos)
+    for objeto in objetos:
+        objeto._nivel = objetos
+    return objetos
+
+
+def hermanos(objeto):
+    return getattr(objeto, '_nivel', (objeto,))
+
+
+class Cargador:
+    """
+    `cargar_lote(claves)` devuelve {clave: valor}; las claves que no
+    aparecen toman `vacio()` (None para FK, [] para relaciones inversas).
+    `atributo` es la clave en el objeto padre ('autor_id', 'pk').
+    """
+
+    def __init__(self, cargar_lote, atributo, vacio=lambda: None):
+        self.cargar_lote = cargar_lote
+        self.atributo = atributo
+        self.vacio = vacio
+        self.cache = {}
+
+    def cargar(self, clave, claves_nivel=()):
+        if clave is None:
+            return self.vacio()
+        if clave not in self.cache:
+            pendientes = {clave}
+            pendientes.update(
+                c for c in claves_nivel if c is not None and c not in self.cache
+            )
+            encontrados = self.cargar_lote(sorted(pendientes))
+            for pendiente in pendientes:
+                self.cache[pendiente] = encontrados.get(pendiente, self.vacio())
+        return self.cache[clave]
+
+    def cargar_relacion(self, objeto, relacion):
+        """
+        `relacion` de `objeto`: la que ya trajo select_related/prefetch_related
+        (ver optimizador.py) o, si no, la del lote de todo su nivel
+        """
+        if relacion in getattr(objeto, '_prefetched_objects_cache', {}):
+            return list(getattr(objeto, relacion).all())
+        if relacion in objeto._state.fields_cache:
+            return getattr(objeto, relacion)
+        return self.cargar(
+            getattr(objeto, self.atributo),
+            (getattr(hermano, self.atributo) for hermano in hermanos(objeto)),
+        )
+
+
+def _por_pk(modelo):
+    def cargar_lote(claves):
+        return {objeto.pk: objeto for objeto in nivel(modelo.objects.filter(pk__in=claves))}
+    return cargar_lote
+
+
+def _por_relacion(modelo, campo):
+    """Relación inversa: {pk del padre: [hijos]} en el orden del modelo"""
+    def cargar_lote(claves):
+        grupos = defaultdict(list)
+        for objeto in nivel(modelo.objects.filter(**{f'{campo}__in': claves})):
+            grupos[getattr(objeto, f'{campo}_id')].append(objeto)
+        return grupos
+    return cargar_lote
+
+
+class Cargadores:
+    def __init__(self):
+        self.autores = Cargador(_por_pk(Autor), 'autor_id')
+        self.categorias = Cargador(_por_pk(Categoria), 'categoria_id')
+        self.libros_por_autor = Cargador(_por_relacion(Libro, 'autor'), 'pk', vacio=list)
+        self.libros_por_categoria = Cargador(_por_relacion(Libro, 'categoria'), 'pk', vacio=list)
+
+
+def cargadores(info):
+    """
+    Cargadores del request en curso (`info.context`). Sin contexto, como en
+    `schema.execute()` sin `context_value`, se batchea por nivel igual pero
+    no se reutiliza lo cargado entre campos.
+    """
+    contexto = info.context
+    if contexto is None:
+        return Cargadores()
+    if not hasattr(contexto, '_cargadores'):
+        contexto._cargadores = Cargadores()
+    return contexto._cargadores
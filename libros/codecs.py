@@ -0,0 +1,214 @@
+"""
+Codecs de serialización compartidos por la API REST, GraphQL y los WebSockets.
+
+Cada codec sabe codificar/decodificar un payload y tiene su media type
+(negociación HTTP con Accept / Content-Type) y su nombre, que es también el
+subprotocolo WebSocket con el que un cliente lo pide. JSON usa `ujson`
+cuando está instalado; `msgpack` y `cbor2` se registran solo si lo están.
+"""
+import datetime
+import decimal
+import json
+import uuid
+
+from django.utils.functional import Promise
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover
+    cbor2 = None
+
+
+def _por_defecto(valor):
+    """Tipos que no son JSON nativo, con la misma forma que DRF"""
+    if isinstance(valor, datetime.datetime):
+        texto = valor.isoformat()
+        return texto[:-6] + 'Z' if texto.endswith('+00:00') else texto
+    if isinstance(valor, (datetime.date, datetime.time)):
+        return valor.isoformat()
+    if isinstance(valor, datetime.timedelta):
+        return str(valor.total_seconds())
+    if isinstance(valor, decimal.Decimal):
+        return float(valor)
+    if isinstance(valor, (uuid.UUID, Promise)):
+        return str(valor)
+    if hasattr(valor, '__iter__'):
+        return list(valor)
+    raise TypeError(f'Tipo no serializable: {type(valor).__name__}')
+
+
+class Codec:
+    nombre = None
+    media_type = None
+    binario = True
+
+    def codificar(self, datos):
+        raise NotImplementedError
+
+    def decodificar(self, contenido):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    nombre = 'json'
+    media_type = 'application/json'
+    binario = False
+
+    def codificar(self, datos, indent=None):
+        if ujson is not None:
+            texto = ujson.dumps(datos, ensure_ascii=False, escape_forward_slashes=False,
+                                default=_por_defecto, indent=indent or 0)
+        else:
+            texto = json.dumps(datos, ensure_ascii=False, default=_por_defecto,
+                               indent=indent, separators=(',', ':') if not indent else None)
+        # Igual que DRF: U+2028/U+2029 son fin de línea en JavaScript
+        return texto.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode()
+
+    def decodificar(self, contenido):
+        # Ambos aceptan bytes UTF-8 sin decodificar antes
+        return ujson.loads(contenido) if ujson is not None else json.loads(contenido)
+
+
+class MessagePackCodec(Codec):
+    nombre = 'msgpack'
+    media_type = 'application/msgpack'
+
+    def codificar(self, datos):
+        return msgpack.packb(datos, default=_por_defecto, use_bin_type=True)
+
+    def decodificar(self, contenido):
+        return msgpack.unpackb(contenido, raw=False)
+
+
+class CBORCodec(Codec):
+    nombre = 'cbor'
+    media_type = 'application/cbor'
+
+    def codificar(self, datos):
+        # Fechas y decimales van con sus etiquetas estándar de CBOR
+        return cbor2.dumps(datos, default=lambda codificador, valor: codificador.encode(
+            _por_defecto(valor)
+        ))
+
+    def decodificar(self, contenido):
+        return cbor2.loads(contenido)
+
+
+JSON = JSONCodec()
+
+CODECS = {JSON.nombre: JSON}
+if msgpack is not None:
+    CODECS[MessagePackCodec.nombre] = MessagePackCodec()
+if cbor2 is not None:
+    CODECS[CBORCodec.nombre] = CBORCodec()
+
+POR_MEDIA_TYPE = {codec.media_type: codec for codec in CODECS.values()}
+
+
+def codec_para_media_type(media_type, por_defecto=JSON):
+    """Codec de un Content-Type (ignora parámetros como charset)"""
+    base = (media_type or '').split(';', 1)[0].strip().lower()
+    return POR_MEDIA_TYPE.get(base, por_defecto)
+
+
+def codec_para_accept(accept, por_defecto=JSON):
+    """Primer codec del header Accept, en el orden en que lo lista el cliente"""
+    for media_type in (accept or '').split(','):
+        base = media_type.split(';', 1)[0].strip().lower()
+        if base in POR_MEDIA_TYPE:
+            return POR_MEDIA_TYPE[base]
+    return por_defecto
+
+
+def codec_para_subprotocolos(subprotocolos):
+    """Primer subprotocolo WebSocket soportado, o None"""
+    for subprotocolo in subprotocolos or ():
+        if subprotocolo in CODECS:
+            return CODECS[subprotocolo]
+    return None
+
+
+# ===== DRF =====
+
+class UJSONRenderer(renderers.JSONRenderer):
+    """JSONRenderer con ujson; respeta `indent` del Accept como el original"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        return JSON.codificar(data, indent=indent)
+
+
+class CodecRenderer(renderers.BaseRenderer):
+    codec = None
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return self.codec.codificar(data)
+
+
+class UJSONParser(parsers.JSONParser):
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return JSON.decodificar(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+
+
+class CodecParser(parsers.BaseParser):
+    codec = None
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return self.codec.decodificar(stream.read())
+        except Exception as exc:
+            raise ParseError(f'{self.codec.nombre} parse error - {exc}')
+
+
+class MessagePackRenderer(CodecRenderer):
+    codec = CODECS.get('msgpack')
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+
+
+class MessagePackParser(CodecParser):
+    codec = CODECS.get('msgpack')
+    media_type = 'application/msgpack'
+
+
+class CBORRenderer(CodecRenderer):
+    codec = CODECS.get('cbor')
+    media_type = 'application/cbor'
+    format = 'cbor'
+
+
+class CBORParser(CodecParser):
+    codec = CODECS.get('cbor')
+    media_type = 'application/cbor'
+
+
+# Para `renderer_classes` / `parser_classes` de las vistas (o los DEFAULT_*
+# de REST_FRAMEWORK); los codecs binarios solo si su librería está instalada
+RENDERER_CLASSES = [UJSONRenderer] + [
+    clase for clase in (MessagePackRenderer, CBORRenderer) if clase.codec
+] + [renderers.BrowsableAPIRenderer]
+PARSER_CLASSES = [UJSONParser] + [
+    clase for clase in (MessagePackParser, CBORParser) if clase.codec
+] + [parsers.FormParser, parsers.MultiPartParser]
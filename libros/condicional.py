@@ -0,0 +1,115 @@
+"""
+Validadores para GET condicional (ETag / Last-Modified) e If-Match.
+
+En los listados se calculan sobre las filas de la página ya leída (pk y
+fecha_actualizacion) más los enlaces next/previous, antes de serializar: la
+paginación por cursor lee la página igual, así que no cuesta otra consulta,
+mientras que max()/count() sobre todo el queryset filtrado recorre el índice
+entero. En el detalle se usa la fecha de la fila. El ETag suma las versiones
+de cache de las relaciones que se muestran (nombre del autor, de la
+categoría, título del libro), que no cambian la fecha propia; Last-Modified
+solo refleja las filas propias. Los campos calculados con la hora actual
+(días de préstamo, atraso) entran con su valor en el ETag y con el momento
+en que lo tomaron en Last-Modified (`validadores_derivados` de la vista).
+
+Las precondiciones de escritura (If-Match, If-Unmodified-Since) se comparan
+solo con la fila: el ETag del detalle es '<fila>.<versiones>' y If-Match
+mira la parte de la fila, así una escritura en otra fila (que sube las
+versiones) o una versión desalojada del cache no dan 412.
+"""
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .cache_respuestas import obtener_versiones
+
+
+class PrecondicionFallida(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'El recurso cambió desde que se leyó (If-Match)'
+    default_code = 'precondition_failed'
+
+
+def _etag(*partes):
+    return quote_etag(hashlib.md5(repr(partes).encode()).hexdigest())
+
+
+def _valor(fila, campo):
+    return fila[campo] if isinstance(fila, dict) else getattr(fila, campo)
+
+
+def validadores_filas(filas, campo, espacios=(), extra=()):
+    """
+    (etag, última modificación) de las filas (instancias o dicts de
+    `.values()` con 'pk') que se van a serializar; `extra` agrega lo que
+    también cambia la respuesta, como los enlaces de paginación
+    """
+    huella = hashlib.md5()
+    ultima = None
+    for fila in filas:
+        fecha = _valor(fila, campo)
+        huella.update(f'{_valor(fila, "pk")}:{fecha.isoformat()};'.encode())
+        if ultima is None or fecha > ultima:
+            ultima = fecha
+    return _etag(huella.hexdigest(), tuple(extra), obtener_versiones(espacios)), ultima
+
+
+def _huella_fila(instancia, campo):
+    return hashlib.md5(repr((instancia.pk, getattr(instancia, campo))).encode()).hexdigest()
+
+
+def validadores_detalle(instancia, campo, espacios=(), extra=()):
+    ultima = getattr(instancia, campo)
+    etag = _huella_fila(instancia, campo)
+    if espacios or extra:
+        etag += '.' + hashlib.md5(repr((obtener_versiones(espacios), tuple(extra))).encode()).hexdigest()
+    return quote_etag(etag), ultima
+
+
+def mas_reciente(*fechas):
+    """La mayor de las fechas que no son None"""
+    return max((fecha for fecha in fechas if fecha is not None), default=None)
+
+
+def precondiciones_cumplidas(request, instancia, campo):
+    """If-Match / If-Unmodified-Since de una escritura, contra la fila sola"""
+    if_match = request.META.get('HTTP_IF_MATCH')
+    if if_match:
+        etags = parse_etags(if_match)
+        fila = _huella_fila(instancia, campo)
+        # Comparación fuerte: los ETag débiles no cumplen If-Match
+        return etags == ['*'] or any(
+            not etag.startswith('W/') and etag.strip('"').split('.')[0] == fila
+            for etag in etags
+        )
+    desde = parse_http_date_safe(request.META.get('HTTP_IF_UNMODIFIED_SINCE', ''))
+    ultima = getattr(instancia, campo)
+    return desde is None or ultima is None or _segundos(ultima) <= desde
+
+
+def _segundos(ultima):
+    return int(ultima.timestamp()) if ultima else None
+
+
+def respuesta_no_modificada(request, etag, ultima):
+    """
+    HttpResponse 304/412 si las precondiciones del request lo piden, o None
+    para seguir con la respuesta normal
+    """
+    respuesta = get_conditional_response(
+        request, etag=etag, last_modified=_segundos(ultima)
+    )
+    if respuesta is not None:
+        respuesta['ETag'] = etag
+    return respuesta
+
+
+def agregar_validadores(respuesta, etag, ultima):
+    if status.is_success(respuesta.status_code):
+        respuesta['ETag'] = etag
+        if ultima:
+            respuesta['Last-Modified'] = http_date(_segundos(ultima))
+    return respuesta
@@ -0,0 +1,102 @@
+"""
+Conexiones Relay (first/after) para las listas de libros de GraphQL.
+
+Con un orden de columna indexada se pagina por keyset, con el mismo cursor
+opaco que la API REST (paginacion.py): `WHERE (campo, id) < (...)` y
+`LIMIT first + 1`, sin OFFSET. La búsqueda ordena por relevancia (una
+anotación), así que ahí el cursor es un desplazamiento, acotado igual por
+el máximo de página.
+
+`totalCount` se resuelve con un COUNT(*) del queryset filtrado solo si el
+cliente lo pide.
+"""
+import graphene
+from django.conf import settings
+from graphql import GraphQLError
+
+from .cargadores import nivel
+from .paginacion import codificar_cursor, decodificar_cursor, filtrar_desde
+
+
+class ConexionContada(graphene.relay.Connection):
+    """Connection con totalCount; `consulta` es el queryset sin paginar"""
+
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int(required=True)
+
+    def resolve_total_count(self, info):
+        return self.consulta.count()
+
+
+def tamano_pagina(first):
+    maximo = getattr(settings, 'GRAPHQL_PAGINA_MAXIMA', 100)
+    if first is None:
+        return min(getattr(settings, 'GRAPHQL_PAGINA', 20), maximo)
+    if first < 0:
+        raise GraphQLError('`first` no puede ser negativo')
+    return min(first, maximo)
+
+
+def _cursor(after):
+    try:
+        return decodificar_cursor(after)
+    except ValueError:
+        raise GraphQLError('Cursor inválido')
+
+
+def _conexion(tipo, consulta, nodos, cursores, hay_siguiente, after):
+    nodos = nivel(nodos)
+    edges = [tipo.Edge(node=nodo, cursor=cursor) for nodo, cursor in zip(nodos, cursores)]
+    conexion = tipo(
+        edges=edges,
+        page_info=graphene.relay.PageInfo(
+            has_next_page=hay_siguiente,
+            has_previous_page=after is not None,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+    )
+    conexion.consulta = consulta
+    return conexion
+
+
+def conexion_keyset(tipo, queryset, campo, first=None, after=None, descendente=True):
+    """Página de `queryset` en el orden (campo, pk), descendente por defecto"""
+    tamano = tamano_pagina(first)
+    consulta = queryset
+    prefijo = '-' if descendente else ''
+    queryset = queryset.order_by(f'{prefijo}{campo}', f'{prefijo}pk')
+    field = queryset.model._meta.get_field(campo)
+    if after is not None:
+        cursor = _cursor(after)
+        try:
+            valor, pk = field.to_python(cursor['v']), int(cursor['pk'])
+        except Exception:
+            raise GraphQLError('Cursor inválido')
+        queryset = filtrar_desde(queryset, campo, valor, pk, descendente)
+
+    nodos = list(queryset[:tamano + 1])
+    cursores = [
+        codificar_cursor({'v': field.value_to_string(nodo), 'pk': nodo.pk})
+        for nodo in nodos[:tamano]
+    ]
+    return _conexion(tipo, consulta, nodos[:tamano], cursores, len(nodos) > tamano, after)
+
+
+def conexion_desplazamiento(tipo, queryset, first=None, after=None):
+    """Página por posición, para órdenes que no admiten keyset"""
+    tamano = tamano_pagina(first)
+    inicio = 0
+    if after is not None:
+        try:
+            inicio = int(_cursor(after)['o']) + 1
+        except (KeyError, TypeError, ValueError):
+            raise GraphQLError('Cursor inválido')
+        if inicio < 0:
+            raise GraphQLError('Cursor inválido')
+
+    nodos = list(queryset[inicio:inicio + tamano + 1])
+    cursores = [codificar_cursor({'o': inicio + i}) for i in range(min(len(nodos), tamano))]
+    return _conexion(tipo, queryset, nodos[:tamano], cursores, len(nodos) > tamano, after)
@@ -0,0 +1,210 @@
+"""
+Preparación de consultas GraphQL antes de ejecutarlas.
+
+- `preparar_documento`: parseo y validación con un LRU por proceso, clave el
+  texto de la consulta (los clientes repiten siempre las mismas).
+- `calcular_costo` / `verificar_costo`: análisis estático de profundidad,
+  ancho (campos por selección, alias incluidos) y campos a resolver
+  estimados, donde cada lista multiplica por GRAPHQL_FILAS_POR_LISTA, o por
+  `first`/`last` si está dentro de una conexión. Las consultas que pasan los límites se rechazan
+  sin ejecutar nada.
+- `consulta_persistida` / `registrar_persistida`: Automatic Persisted
+  Queries con el protocolo de Apollo (`extensions.persistedQuery.sha256Hash`);
+  el texto se guarda en el cache de Django, compartido entre procesos, con
+  vencimiento y solo si la consulta es válida y pasa los límites de costo.
+"""
+import hashlib
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from graphql import (
+    FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLError,
+    GraphQLList, GraphQLNonNull, InlineFragmentNode, IntValueNode, VariableNode,
+    get_named_type, parse, validate,
+)
+from graphql.utilities import get_operation_ast
+
+
+Costo = namedtuple('Costo', 'profundidad ancho campos')
+
+ARGUMENTOS_PAGINA = ('first', 'last')
+
+HASH = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+def _limite(nombre, defecto):
+    return getattr(settings, nombre, defecto)
+
+
+# ===== Documentos =====
+
+@lru_cache(maxsize=_limite('GRAPHQL_DOCUMENTOS_CACHE', 512))
+def preparar_documento(schema, query):
+    """(documento, errores) de `query` ya parseada y validada contra `schema`"""
+    try:
+        documento = parse(query)
+    except GraphQLError as error:
+        return None, [error]
+    return documento, validate(schema, documento)
+
+
+# ===== Costo =====
+
+def _aplanar(seleccion, fragmentos):
+    for nodo in seleccion.selections:
+        if isinstance(nodo, FieldNode):
+            yield nodo
+        elif isinstance(nodo, InlineFragmentNode):
+            yield from _aplanar(nodo.selection_set, fragmentos)
+        elif isinstance(nodo, FragmentSpreadNode):
+            yield from _aplanar(fragmentos[nodo.name.value].selection_set, fragmentos)
+
+
+def _pagina(nodo, variables):
+    """Valor de first/last del campo (una conexión), o None si no tiene"""
+    for argumento in nodo.arguments:
+        if argumento.name.value in ARGUMENTOS_PAGINA:
+            valor = argumento.value
+            if isinstance(valor, IntValueNode):
+                return max(int(valor.value), 1)
+            if isinstance(valor, VariableNode):
+                # Las variables aún no se validaron: lo que no sea entero
+                # lo rechazará la ejecución
+                try:
+                    return max(int(variables.get(valor.name.value)), 1)
+                except (TypeError, ValueError):
+                    pass
+            return None
+    return None
+
+
+def _filas(tipo, pagina):
+    """
+    Filas estimadas que devuelve un campo por cada objeto padre; las listas
+    dentro de una conexión (edges) tienen el tamaño de su página
+    """
+    if isinstance(tipo, GraphQLNonNull):
+        tipo = tipo.of_type
+    if isinstance(tipo, GraphQLList):
+        return pagina or _limite('GRAPHQL_FILAS_POR_LISTA', 100)
+    return 1
+
+
+def _costo(tipo, seleccion, fragmentos, variables, profundidad, multiplicidad, pagina=None):
+    campos = [
+        nodo for nodo in _aplanar(seleccion, fragmentos)
+        # La introspección (GraphiQL) no cuenta
+        if not nodo.name.value.startswith('__')
+    ]
+    costo = Costo(profundidad, len(campos), 0)
+    for nodo in campos:
+        definicion = getattr(tipo, 'fields', {}).get(nodo.name.value)
+        if definicion is None:
+            continue
+        filas = multiplicidad * _filas(definicion.type, pagina)
+        costo = costo._replace(campos=costo.campos + filas)
+        if nodo.selection_set is not None:
+            hijo = _costo(get_named_type(definicion.type), nodo.selection_set,
+                          fragmentos, variables, profundidad + 1, filas,
+                          _pagina(nodo, variables))
+            costo = Costo(
+                max(costo.profundidad, hijo.profundidad),
+                max(costo.ancho, hijo.ancho),
+                costo.campos + hijo.campos,
+            )
+    return costo
+
+
+def calcular_costo(schema, documento, operation_name=None, variables=None):
+    """Costo estático de la operación; @skip/@include se cuentan como incluidos"""
+    operacion = get_operation_ast(documento, operation_name)
+    if operacion is None:
+        return Costo(0, 0, 0)
+    fragmentos = {
+        definicion.name.value: definicion for definicion in documento.definitions
+        if isinstance(definicion, FragmentDefinitionNode)
+    }
+    return _costo(schema.get_root_type(operacion.operation), operacion.selection_set,
+                  fragmentos, variables or {}, 1, 1)
+
+
+def verificar_costo(schema, documento, operation_name=None, variables=None):
+    """Lista de errores (vacía si la consulta está dentro de los límites)"""
+    costo = calcular_costo(schema, documento, operation_name, variables)
+    limites = Costo(
+        _limite('GRAPHQL_MAX_PROFUNDIDAD', 10),
+        _limite('GRAPHQL_MAX_ANCHO', 100),
+        _limite('GRAPHQL_MAX_COSTO', 50000),
+    )
+    excedidos = [
+        f'{nombre} {valor} (máximo {maximo})'
+        for nombre, valor, maximo in zip(Costo._fields, costo, limites)
+        if valor > maximo
+    ]
+    if not excedidos:
+        return []
+    return [GraphQLError(
+        'Consulta demasiado costosa: ' + ', '.join(excedidos),
+        extensions={'code': 'QUERY_TOO_EXPENSIVE', 'costo': costo._asdict()},
+    )]
+
+
+# ===== Consultas persistidas =====
+
+def _cache_persistidas():
+    return caches[_limite('GRAPHQL_PERSISTIDAS_CACHE_ALIAS', 'default')]
+
+
+def huella(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def _persistida(extensiones):
+    """(hash, clave de cache) de `persistedQuery`, o None si no viene"""
+    persistida = (extensiones or {}).get('persistedQuery')
+    if not isinstance(persistida, dict) or not persistida.get('sha256Hash'):
+        return None
+    sha = persistida['sha256Hash']
+    if not isinstance(sha, str) or not HASH.match(sha):
+        raise GraphQLError('sha256Hash debe tener 64 caracteres hexadecimales',
+                           extensions={'code': 'PERSISTED_QUERY_HASH_INVALID'})
+    return sha, f'graphql:persistida:{sha.lower()}'
+
+
+def consulta_persistida(query, extensiones):
+    """
+    Texto de la consulta a ejecutar. Con `persistedQuery` y texto, verifica
+    que el hash corresponda (se guarda después, con registrar_persistida);
+    con solo el hash, lo busca. Si no está, el cliente recibe
+    PersistedQueryNotFound y reintenta enviando el texto.
+    """
+    persistida = _persistida(extensiones)
+    if persistida is None:
+        return query
+    sha, clave = persistida
+    if query:
+        if huella(query) != sha.lower():
+            raise GraphQLError('provided sha does not match query',
+                               extensions={'code': 'PERSISTED_QUERY_HASH_MISMATCH'})
+        return query
+    query = _cache_persistidas().get(clave)
+    if query is None:
+        raise GraphQLError('PersistedQueryNotFound',
+                           extensions={'code': 'PERSISTED_QUERY_NOT_FOUND'})
+    return query
+
+
+def registrar_persistida(query, extensiones):
+    """
+    Guarda `query` bajo su hash por GRAPHQL_PERSISTIDAS_SEGUNDOS; se llama
+    solo con consultas ya validadas y dentro de los límites de costo, así
+    no se guarda cualquier texto que mande un cliente
+    """
+    persistida = _persistida(extensiones)
+    if persistida is not None and query:
+        _cache_persistidas().set(
+            persistida[1], query, _limite('GRAPHQL_PERSISTIDAS_SEGUNDOS', 24 * 60 * 60)
+        )
@@ -1,83 +1,176 @@
-import json
+import asyncio
+from collections import defaultdict
+from inspect import isawaitable
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import Libro
+from django.conf import settings
+from graphql import (
+    ExecutionResult, GraphQLError, OperationType, create_source_event_stream, execute,
+    get_operation_ast,
+)
+from .cambios import grupo_tema, libros_de_la_conexion
+from .codecs import JSON, codec_para_subprotocolos
+from .consultas_graphql import preparar_documento, verificar_costo
+from .contrapresion import ContrapresionMixin
+from .historial_chat import historial, since_valido
+from .difusion import coalescedor
+from .schema import schema as schema_libros
+from .suscripciones import ColaLibros, grupo_fisico, grupos_instantanea
 
 
-class NotificacionesConsumer(AsyncWebsocketConsumer):
-    """Consumer para notificaciones en tiempo real"""
+class CodecConsumerMixin:
+    """
+    Codec por conexión según el subprotocolo que pida el cliente
+    (`new WebSocket(url, ['msgpack', 'json'])`): los binarios viajan en frames
+    binarios; sin subprotocolo se usa JSON en frames de texto
+    """
+    codec = JSON
+    
+    async def aceptar(self):
+        codec = codec_para_subprotocolos(self.scope.get('subprotocols'))
+        if codec is None:
+            await self.accept()
+        else:
+            self.codec = codec
+            await self.accept(subprotocol=codec.nombre)
+    
+    async def enviar(self, datos):
+        contenido = self.codec.codificar(datos)
+        if self.codec.binario:
+            await self.send(bytes_data=contenido)
+        else:
+            await self.send(text_data=contenido.decode())
+    
+    def decodificar(self, text_data=None, bytes_data=None):
+        return self.codec.decodificar(text_data if text_data is not None else bytes_data)
+
+
+class NotificacionesConsumer(ContrapresionMixin, CodecConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Consumer para notificaciones en tiempo real. Cada conexión recibe solo
+    los temas que sigue (cambios.grupo_tema): al conectar los de
+    `?temas=libro:5,categoria:2` o, si no indica, 'todos'; después se
+    cambian con {"type": "suscribir"|"desuscribir", "temas": [...]}.
+    Con la cola de salida llena los lotes de libros pendientes se juntan.
+    """
+    politica_desborde = 'agrupar'
     
     async def connect(self):
         """Cuando un cliente se conecta"""
-        self.room_group_name = 'notificaciones'
+        self.temas = {}  # grupo: tema
         
-        # Unirse al grupo
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        temas = parse_qs(self.scope.get('query_string', b'').decode()).get('temas')
+        temas = temas[0].split(',') if temas else ['todos']
+        # Unirse a los grupos de sus temas
+        invalidos = await self.suscribir(temas)
         
-        await self.accept()
+        await self.aceptar()
         
         # Mensaje de bienvenida
-        await self.send(text_data=json.dumps({
+        await self.enviar({
             'type': 'connection',
-            'message': '✅ Conectado a notificaciones en tiempo real'
-        }))
+            'message': '✅ Conectado a notificaciones en tiempo real',
+            'temas': sorted(self.temas.values()),
+        })
+        if invalidos:
+            await self.enviar_error_temas(invalidos)
     
     async def disconnect(self, close_code):
         """Cuando un cliente se desconecta"""
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        for fisico in {grupo_fisico(grupo) for grupo in self.temas}:
+            await self.channel_layer.group_discard(fisico, self.channel_name)
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Recibir mensaje del cliente"""
-        data = json.loads(text_data)
+        data = self.decodificar(text_data, bytes_data)
         message_type = data.get('type')
         
         if message_type == 'libro_update':
             libro_id = data.get('libro_id')
             await self.notificar_cambio_libro(libro_id)
+        elif message_type in ('suscribir', 'desuscribir'):
+            temas = data.get('temas')
+            if not isinstance(temas, list):
+                temas = [temas]
+            if message_type == 'suscribir':
+                invalidos = await self.suscribir(temas)
+            else:
+                invalidos = await self.desuscribir(temas)
+            if invalidos:
+                await self.enviar_error_temas(invalidos)
+            await self.enviar({'type': 'suscripciones', 'temas': sorted(self.temas.values())})
     
-    async def notificar_cambio_libro(self, libro_id):
-        """Notificar a todos sobre cambio en libro"""
-        libro_data = await self.get_libro_data(libro_id)
-        
-        # Broadcast a todo el grupo
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'libro_actualizado',
-                'libro': libro_data
-            }
-        )
+    async def suscribir(self, temas):
+        """Une la conexión a los grupos de `temas`; devuelve los inválidos"""
+        maximo = getattr(settings, 'NOTIFICACIONES_MAX_TEMAS', 100)
+        invalidos = []
+        for tema in temas:
+            grupo = grupo_tema(tema)
+            if grupo is None or (grupo not in self.temas and len(self.temas) >= maximo):
+                invalidos.append(tema)
+            elif grupo not in self.temas:
+                # Varios libros comparten grupo del channel layer (su cubeta)
+                if not self.en_grupo(grupo_fisico(grupo)):
+                    await self.channel_layer.group_add(grupo_fisico(grupo), self.channel_name)
+                self.temas[grupo] = tema
+        return invalidos
+    
+    def en_grupo(self, fisico):
+        return any(grupo_fisico(grupo) == fisico for grupo in self.temas)
     
-    async def libro_actualizado(self, event):
-        """Enviar notificación al cliente"""
-        await self.send(text_data=json.dumps({
-            'type': 'libro_actualizado',
-            'libro': event['libro']
-        }))
+    async def desuscribir(self, temas):
+        invalidos = []
+        for tema in temas:
+            grupo = grupo_tema(tema)
+            if grupo is None:
+                invalidos.append(tema)
+            elif self.temas.pop(grupo, None) is not None and not self.en_grupo(grupo_fisico(grupo)):
+                await self.channel_layer.group_discard(grupo_fisico(grupo), self.channel_name)
+        return invalidos
     
-    @database_sync_to_async
-    def get_libro_data(self, libro_id):
-        """Obtener datos del libro (sync to async)"""
+    async def enviar_error_temas(self, temas):
+        await self.enviar({
+            'type': 'error',
+            'message': f'Temas inválidos o por encima del máximo: {temas}',
+        })
+    
+    async def notificar_cambio_libro(self, libro_id):
+        """
+        Notificar a todos sobre cambio en libro: se agrupa con los demás
+        cambios de la ventana en un solo `libros_actualizados` (difusion.py)
+        """
         try:
-            libro = Libro.objects.get(pk=libro_id)
-            return {
-                'id': libro.id,
-                'titulo': libro.titulo,
-                'stock': libro.stock,
-                'disponible': libro.esta_disponible
-            }
-        except Libro.DoesNotExist:
+            coalescedor().agregar(int(libro_id))
+        except (TypeError, ValueError):
+            pass
+    
+    def fusionar_frames(self, anterior, nuevo):
+        """Dos lotes de libros en uno, con el último estado de cada libro"""
+        if anterior['type'] != 'libros_actualizados' or nuevo['type'] != 'libros_actualizados':
+            return None
+        libros = {datos['id']: datos for datos in anterior['libros']}
+        libros.update((datos['id'], datos) for datos in nuevo['libros'])
+        if len(libros) > getattr(settings, 'NOTIFICACIONES_MAX_LOTE', 500):
             return None
+        return {'type': 'libros_actualizados', 'libros': list(libros.values())}
+    
+    async def libros_actualizados(self, event):
+        """Enviar al cliente el lote de libros cambiados"""
+        libros = libros_de_la_conexion(event.get('grupo', ''), event['libros'], self.temas)
+        if libros:
+            await self.enviar({
+                'type': 'libros_actualizados',
+                'libros': libros
+            })
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    """Consumer para chat de biblioteca"""
+class ChatConsumer(ContrapresionMixin, CodecConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Consumer para chat de biblioteca. Al conectar envía el historial de la
+    sala desde `?since=<id>` (historial_chat.py). Con la cola de salida
+    llena se pierden los mensajes más viejos.
+    """
     
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
@@ -88,7 +181,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.aceptar()
+        
+        # Lo que se perdió desde `since` (o el historial entero). Ya está en
+        # el grupo: un mensaje puede llegar repetido, con el mismo id
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since')
+        mensajes = await historial(self.channel_layer).desde(
+            self.room_name, since_valido(since[0]) if since else None
+        )
+        await self.enviar({'type': 'historial', 'mensajes': mensajes})
         
         # Notificar que alguien se conectó
         await self.channel_layer.group_send(
@@ -105,16 +206,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decodificar(text_data, bytes_data)
         message = data['message']
         username = data.get('username', 'Anónimo')
+        mensaje_id = await historial(self.channel_layer).agregar(self.room_name, username, message)
         
         # Enviar mensaje a todos en la sala
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
+                'id': mensaje_id,
                 'message': message,
                 'username': username
             }
@@ -122,15 +225,171 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def chat_message(self, event):
         """Recibir mensaje del grupo y enviarlo al WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.enviar({
             'type': 'message',
+            'id': event.get('id'),
             'message': event['message'],
             'username': event['username']
-        }))
+        })
     
     async def user_join(self, event):
         """Usuario se unió"""
-        await self.send(text_data=json.dumps({
+        await self.enviar({
             'type': 'system',
             'message': event['message']
-        }))
\ No newline at end of file
+        })
+
+
+class GraphQLSuscripcionesConsumer(CodecConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Suscripciones GraphQL con el protocolo graphql-transport-ws (el de los
+    clientes graphql-ws y Apollo). Las consultas y mutaciones siguen yendo
+    por HTTP. Los eventos llegan por los grupos del channel layer de
+    suscripciones.py; la conexión se une a cada grupo mientras alguna de
+    sus suscripciones lo escuche.
+    """
+    subprotocolo = 'graphql-transport-ws'
+    schema = None  # por defecto el de libros.schema
+    
+    async def connect(self):
+        if self.subprotocolo not in self.scope.get('subprotocols', ()):
+            await self.close(code=4406)
+            return
+        self.iniciada = False
+        self.operaciones = {}
+        self.oyentes = defaultdict(set)
+        self.grupos = set()
+        self.candado_grupos = asyncio.Lock()
+        await self.accept(subprotocol=self.subprotocolo)
+    
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'operaciones'):
+            return
+        for tarea in self.operaciones.values():
+            tarea.cancel()
+        grupos, self.grupos = self.grupos, set()
+        for grupo in grupos:
+            await self.channel_layer.group_discard(grupo, self.channel_name)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            mensaje = self.decodificar(text_data, bytes_data)
+            tipo = mensaje['type']
+        except (TypeError, ValueError, KeyError):
+            await self.close(code=4400)
+            return
+        
+        if tipo == 'connection_init':
+            if self.iniciada:
+                await self.close(code=4429)
+                return
+            self.iniciada = True
+            await self.enviar({'type': 'connection_ack'})
+        elif tipo == 'ping':
+            await self.enviar({'type': 'pong'})
+        elif tipo == 'pong':
+            pass
+        elif tipo == 'subscribe':
+            if not self.iniciada:
+                await self.close(code=4401)
+                return
+            id, payload = mensaje.get('id'), mensaje.get('payload')
+            if not isinstance(id, str) or not isinstance(payload, dict):
+                await self.close(code=4400)
+                return
+            if id in self.operaciones:
+                await self.close(code=4409)
+                return
+            await self.suscribir(id, payload)
+        elif tipo == 'complete':
+            tarea = self.operaciones.pop(mensaje.get('id'), None)
+            if tarea is not None:
+                tarea.cancel()
+        else:
+            await self.close(code=4400)
+    
+    def get_schema(self):
+        return (self.schema or schema_libros).graphql_schema
+    
+    async def suscribir(self, id, payload):
+        schema = self.get_schema()
+        variables = payload.get('variables') or {}
+        operation_name = payload.get('operationName')
+        documento, errores = preparar_documento(schema, payload.get('query') or '')
+        if not errores:
+            operacion = get_operation_ast(documento, operation_name)
+            if operacion is None or operacion.operation != OperationType.SUBSCRIPTION:
+                errores = [GraphQLError('Por WebSocket solo se aceptan suscripciones')]
+        if not errores:
+            errores = verificar_costo(schema, documento, operation_name, variables)
+        if not errores:
+            eventos = await create_source_event_stream(
+                schema, documento, context_value=self,
+                variable_values=variables, operation_name=operation_name,
+            )
+            if isinstance(eventos, ExecutionResult):
+                errores = eventos.errors
+        if errores:
+            await self.enviar({
+                'type': 'error', 'id': id, 'payload': [error.formatted for error in errores]
+            })
+            return
+        self.operaciones[id] = asyncio.ensure_future(
+            self.emitir(id, eventos, schema, documento, variables, operation_name)
+        )
+    
+    async def emitir(self, id, eventos, schema, documento, variables, operation_name):
+        # Como graphql.subscribe, pero ejecutando cada evento en la misma
+        # tarea: MapAsyncIterator crea dos tareas y un asyncio.wait por evento
+        try:
+            async for evento in eventos:
+                resultado = execute(
+                    schema, documento, evento, self, variables, operation_name
+                )
+                if isawaitable(resultado):
+                    resultado = await resultado
+                await self.enviar({'type': 'next', 'id': id, 'payload': resultado.formatted})
+        except GraphQLError as error:
+            self.operaciones.pop(id, None)
+            await self.enviar({'type': 'error', 'id': id, 'payload': [error.formatted]})
+            return
+        self.operaciones.pop(id, None)
+        await self.enviar({'type': 'complete', 'id': id})
+    
+    # Grupos del channel layer (ver suscripciones.escuchar)
+    
+    async def escuchar(self, grupos):
+        cola = ColaLibros(getattr(settings, 'GRAPHQL_SUSCRIPCION_COLA_MAXIMA', 1000))
+        for grupo in grupos:
+            self.oyentes[grupo].add(cola)
+            await self.sincronizar_grupo(grupo_fisico(grupo))
+        return cola
+    
+    def dejar(self, grupos, cola):
+        for grupo in grupos:
+            self.oyentes[grupo].discard(cola)
+            if not self.oyentes[grupo]:
+                del self.oyentes[grupo]
+                asyncio.ensure_future(self.sincronizar_grupo(grupo_fisico(grupo)))
+    
+    async def sincronizar_grupo(self, fisico):
+        """
+        Une o saca la conexión del grupo del channel layer `fisico` según
+        tenga suscripciones que escuchen alguno de sus grupos lógicos
+        """
+        async with self.candado_grupos:
+            necesario = any(grupo_fisico(grupo) == fisico for grupo in self.oyentes)
+            if necesario and fisico not in self.grupos:
+                await self.channel_layer.group_add(fisico, self.channel_name)
+                self.grupos.add(fisico)
+            elif not necesario and fisico in self.grupos:
+                await self.channel_layer.group_discard(fisico, self.channel_name)
+                self.grupos.discard(fisico)
+    
+    async def libro_cambiado(self, evento):
+        for libro in evento['libros']:
+            for grupo in grupos_instantanea(libro):
+                # El libro llega una vez por cada grupo del channel layer
+                if grupo_fisico(grupo) == evento['grupo']:
+                    for cola in self.oyentes.get(grupo, ()):
+                        cola.poner(libro)
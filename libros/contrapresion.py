@@ -0,0 +1,207 @@
+"""
+Contrapresión para los consumers WebSocket (ContrapresionMixin).
+
+- Salida acotada: los frames de cada conexión se encolan y los escribe una
+  tarea aparte, así un cliente lento no frena al consumer, que sigue
+  leyendo el channel layer. La cola admite WEBSOCKET_COLA_MAXIMA frames;
+  llena, se aplica la política de la clase (`politica_desborde`, o la de
+  WEBSOCKET_POLITICAS_DESBORDE por nombre de clase):
+    - 'descartar': se tira el frame más viejo;
+    - 'agrupar': el frame nuevo se junta con uno pendiente si el consumer
+      sabe fusionarlos (`fusionar_frames`), si no se tira el más viejo;
+    - 'desconectar': se cierra la conexión con `codigo_saturada`.
+  Con servidores cuyo `send` no espera al cliente (daphne) la cola casi no
+  se llena y el límite lo pone el buffer del servidor.
+- Límite de entrada: cubeta de fichas por conexión,
+  WEBSOCKET_MENSAJES_POR_SEGUNDO sostenidos y ráfagas de
+  WEBSOCKET_RAFAGA_MENSAJES. Lo que pasa del límite se descarta y el
+  cliente recibe un aviso por ráfaga.
+- Métricas del proceso en `metricas.resumen()`: conexiones, frames en cola
+  (total y la cola más larga), descartados, agrupados, desconexiones por
+  saturación y mensajes entrantes rechazados.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+POLITICAS = ('descartar', 'agrupar', 'desconectar')
+
+
+class Metricas:
+    """Contadores de todas las conexiones del proceso"""
+
+    def __init__(self):
+        self.salidas = weakref.WeakSet()
+        self.descartados = 0
+        self.agrupados = 0
+        self.desconexiones = 0
+        self.limitados = 0
+
+    def resumen(self):
+        profundidades = [len(salida) for salida in list(self.salidas)]
+        return {
+            'conexiones': len(profundidades),
+            'en_cola': sum(profundidades),
+            'cola_maxima': max(profundidades, default=0),
+            'descartados': self.descartados,
+            'agrupados': self.agrupados,
+            'desconexiones': self.desconexiones,
+            'limitados': self.limitados,
+        }
+
+
+metricas = Metricas()
+
+
+class Salida:
+    """
+    Cola acotada de frames de una conexión; una tarea los pasa a
+    `escribir` de a uno, esperando a que el servidor acepte cada uno
+    """
+
+    def __init__(self, escribir, maximo, politica, fusionar=None):
+        if politica not in POLITICAS:
+            raise ValueError(f'Política de desborde desconocida: {politica}')
+        self.escribir = escribir
+        self.maximo = maximo
+        self.politica = politica
+        self.fusionar = fusionar
+        self.frames = deque()
+        self.descartados = 0
+        self.agrupados = 0
+        self.cerrada = False
+        self.hay_frames = asyncio.Event()
+        self.tarea = asyncio.ensure_future(self._escribir())
+        metricas.salidas.add(self)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def poner(self, datos):
+        """Encola `datos`; False si la cola está llena y hay que desconectar"""
+        if self.cerrada:
+            return True
+        if len(self.frames) >= self.maximo:
+            if self.politica == 'desconectar':
+                return False
+            if self.politica == 'agrupar' and self._agrupar(datos):
+                return True
+            self.frames.popleft()
+            self.descartados += 1
+            metricas.descartados += 1
+        self.frames.append(datos)
+        self.hay_frames.set()
+        return True
+
+    def _agrupar(self, datos):
+        if self.fusionar is None:
+            return False
+        # Del más nuevo al más viejo: el primero que acepte la fusión
+        for posicion in range(len(self.frames) - 1, -1, -1):
+            fusionado = self.fusionar(self.frames[posicion], datos)
+            if fusionado is not None:
+                self.frames[posicion] = fusionado
+                self.agrupados += 1
+                metricas.agrupados += 1
+                return True
+        return False
+
+    async def _escribir(self):
+        try:
+            while True:
+                await self.hay_frames.wait()
+                self.hay_frames.clear()
+                while self.frames:
+                    await self.escribir(self.frames.popleft())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Error al escribir en el WebSocket; se descartan %d frames', len(self.frames))
+            self.cerrar()
+
+    def cerrar(self):
+        self.cerrada = True
+        self.frames.clear()
+        self.tarea.cancel()
+        metricas.salidas.discard(self)
+
+
+class LimiteEntrada:
+    """Cubeta de fichas: `por_segundo` mensajes sostenidos, ráfagas de `rafaga`"""
+
+    def __init__(self, por_segundo, rafaga):
+        self.por_segundo = por_segundo
+        self.rafaga = rafaga
+        self.fichas = rafaga
+        self.ultimo = time.monotonic()
+
+    def permitir(self):
+        ahora = time.monotonic()
+        self.fichas = min(self.rafaga, self.fichas + (ahora - self.ultimo) * self.por_segundo)
+        self.ultimo = ahora
+        if self.fichas < 1:
+            return False
+        self.fichas -= 1
+        return True
+
+
+class ContrapresionMixin:
+    """
+    Salida acotada y límite de entrada para un consumer con `enviar`
+    (CodecConsumerMixin), que debe ir después en las bases
+    """
+    politica_desborde = 'descartar'
+    codigo_saturada = 4008
+
+    def fusionar_frames(self, anterior, nuevo):
+        """Frame que reemplaza a `anterior` incluyendo `nuevo`, o None"""
+        return None
+
+    async def websocket_connect(self, message):
+        politica = getattr(settings, 'WEBSOCKET_POLITICAS_DESBORDE', {}).get(
+            type(self).__name__, self.politica_desborde
+        )
+        self.salida = Salida(
+            super().enviar, getattr(settings, 'WEBSOCKET_COLA_MAXIMA', 100),
+            politica, self.fusionar_frames,
+        )
+        self.entrada = LimiteEntrada(
+            getattr(settings, 'WEBSOCKET_MENSAJES_POR_SEGUNDO', 10),
+            getattr(settings, 'WEBSOCKET_RAFAGA_MENSAJES', 20),
+        )
+        self.entrada_avisada = False
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            if self.salida.descartados:
+                logger.info('%s: %d frames descartados por cliente lento',
+                            self.channel_name, self.salida.descartados)
+            self.salida.cerrar()
+
+    async def websocket_receive(self, message):
+        if self.entrada.permitir():
+            self.entrada_avisada = False
+            await super().websocket_receive(message)
+            return
+        metricas.limitados += 1
+        if not self.entrada_avisada:
+            self.entrada_avisada = True
+            await self.enviar({
+                'type': 'error',
+                'message': 'Demasiados mensajes: se descartan hasta que baje el ritmo',
+            })
+
+    async def enviar(self, datos):
+        if not self.salida.poner(datos):
+            metricas.desconexiones += 1
+            self.salida.cerrar()
+            await self.close(code=self.codigo_saturada)
@@ -0,0 +1,97 @@
+"""
+Difusión agrupada de los `libro_update` que envían los clientes al grupo
+`notificaciones`.
+
+Los `libro_update` que recibe NotificacionesConsumer no se reenvían uno por
+uno: los ids se juntan durante NOTIFICACIONES_VENTANA segundos y cada
+cliente recibe un único frame `libros_actualizados` con el último estado de
+cada libro (en frames de hasta NOTIFICACIONES_MAX_LOTE libros). Una ráfaga
+de 500 cambios pasa de 500 frames por cliente a uno por ventana.
+
+Las instantáneas salen del cache del proceso que llenan las escrituras
+(cambios.recientes); solo las que faltan o vencieron se leen, con una
+consulta por ventana, y quedan en el cache. Los cambios que hace el propio
+servidor no pasan por aquí: se publican al confirmarse (cambios.py).
+
+Cada conexión elige sus temas (ver cambios.grupo_tema) y se une solo a
+esos grupos; cada ventana arma un lote por grupo con los libros que le
+tocan, así un cambio llega únicamente a quien lo sigue. Un libro que cae en
+dos temas de la misma conexión (su id y su categoría) llega en los dos
+lotes.
+
+El agrupamiento es por proceso: cada worker tiene su event loop y junta lo
+que recibieron sus conexiones.
+"""
+import asyncio
+import logging
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .cambios import difundir_instantaneas, recientes
+from .models import Libro
+from .suscripciones import instantanea
+from .utils import en_bloques
+
+logger = logging.getLogger(__name__)
+
+CAMPOS_INSTANTANEA = ('id', 'titulo', 'stock', 'estado', 'categoria_id')
+
+
+@database_sync_to_async
+def instantaneas(libro_ids):
+    """Instantáneas de los libros que existen, leídas de la base"""
+    libros = []
+    for bloque in en_bloques(sorted(libro_ids)):
+        libros += [
+            instantanea(libro) for libro in
+            Libro.objects.filter(pk__in=bloque).order_by('pk').only(*CAMPOS_INSTANTANEA)
+        ]
+    return libros
+
+
+async def difundir(libro_ids):
+    """
+    Frames `libros_actualizados` con el estado de `libro_ids`, en orden de
+    id: del cache lo vigente, de la base lo que falte
+    """
+    encontradas, faltan = recientes.obtener(libro_ids)
+    if faltan:
+        leidas = await instantaneas(faltan)
+        recientes.guardar(leidas)
+        encontradas.update((datos['id'], datos) for datos in leidas)
+    await difundir_instantaneas([encontradas[libro_id] for libro_id in sorted(encontradas)])
+
+
+class Coalescedor:
+    """Junta ids y los difunde una vez por ventana"""
+
+    def __init__(self):
+        self.pendientes = set()
+        self.tarea = None
+
+    def agregar(self, libro_id):
+        self.pendientes.add(libro_id)
+        if self.tarea is None:
+            self.tarea = asyncio.ensure_future(self._difundir_al_cerrar())
+
+    async def _difundir_al_cerrar(self):
+        await asyncio.sleep(getattr(settings, 'NOTIFICACIONES_VENTANA', 0.05))
+        libro_ids, self.pendientes, self.tarea = self.pendientes, set(), None
+        try:
+            await difundir(libro_ids)
+        except Exception:
+            # Lo que llegue después abre otra ventana igual
+            logger.exception('Error al difundir %d cambios de libros', len(libro_ids))
+
+
+_coalescedores = weakref.WeakKeyDictionary()
+
+
+def coalescedor():
+    """El Coalescedor del event loop en curso"""
+    loop = asyncio.get_running_loop()
+    if loop not in _coalescedores:
+        _coalescedores[loop] = Coalescedor()
+    return _coalescedores[loop]
@@ -0,0 +1,123 @@
+"""
+Exportación en streaming (CSV / NDJSON) del catálogo y de los préstamos.
+
+Las filas se leen con `.values()` en bloques por clave primaria
+(`pk > último ORDER BY pk LIMIT n`) en lugar de confiar en un cursor del
+servidor: PyMySQL trae el resultado completo al cliente, así que la
+memoria del worker solo queda acotada si cada consulta lo está.
+"""
+import csv
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db.models import F, Value
+from django.db.models.functions import Concat
+from django.http import StreamingHttpResponse
+
+from .codecs import JSON
+
+
+LOTE = 2000
+
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+COLUMNAS_LIBROS = {
+    'id': F('id'),
+    'titulo': F('titulo'),
+    'subtitulo': F('subtitulo'),
+    'isbn': F('isbn'),
+    'autor': F('autor_id'),
+    'autor_nombre': Concat('autor__nombre', Value(' '), 'autor__apellido'),
+    'categoria': F('categoria_id'),
+    'categoria_nombre': F('categoria__nombre'),
+    'editorial': F('editorial'),
+    'fecha_publicacion': F('fecha_publicacion'),
+    'paginas': F('paginas'),
+    'idioma': F('idioma'),
+    'stock': F('stock'),
+    'estado': F('estado'),
+    'precio': F('precio'),
+    'valoracion': F('valoracion'),
+    'activo': F('activo'),
+    'fecha_creacion': F('fecha_creacion'),
+    'fecha_actualizacion': F('fecha_actualizacion'),
+}
+
+COLUMNAS_PRESTAMOS = {
+    'id': F('id'),
+    'libro': F('libro_id'),
+    'libro_titulo': F('libro__titulo'),
+    'usuario': F('usuario_id'),
+    'usuario_nombre': F('usuario__username'),
+    'fecha_prestamo': F('fecha_prestamo'),
+    'fecha_devolucion_esperada': F('fecha_devolucion_esperada'),
+    'fecha_devolucion_real': F('fecha_devolucion_real'),
+    'estado': F('estado'),
+    'notas': F('notas'),
+}
+
+
+def iterar_filas(queryset, columnas, lote=None):
+    """Genera dicts con `columnas`, consultando de a `lote` filas por pk"""
+    lote = lote or LOTE
+    # Los alias no pueden coincidir con campos del modelo: se usa un prefijo
+    alias = {f'_exp_{nombre}': expresion for nombre, expresion in columnas.items()}
+    base = queryset.order_by('pk').values('pk', **alias)
+    ultimo = None
+    while True:
+        bloque = base if ultimo is None else base.filter(pk__gt=ultimo)
+        filas = list(bloque[:lote])
+        for fila in filas:
+            yield {nombre: fila[f'_exp_{nombre}'] for nombre in columnas}
+        if len(filas) < lote:
+            return
+        ultimo = filas[-1]['pk']
+
+
+def _a_texto(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    return valor
+
+
+class _Eco:
+    """Pseudo-archivo para csv.writer: devuelve la línea en lugar de guardarla"""
+
+    def write(self, valor):
+        return valor
+
+
+def lineas_csv(columnas, filas):
+    escritor = csv.writer(_Eco())
+    yield escritor.writerow(list(columnas))
+    for fila in filas:
+        yield escritor.writerow([_a_texto(fila[nombre]) for nombre in columnas])
+
+
+def lineas_ndjson(columnas, filas):
+    for fila in filas:
+        yield JSON.codificar(
+            {nombre: _a_texto(valor) for nombre, valor in fila.items()}
+        ).decode() + '\n'
+
+
+def generar_exportacion(queryset, columnas, formato):
+    """Iterador de líneas de texto en el formato pedido"""
+    filas = iterar_filas(queryset, columnas)
+    if formato == 'csv':
+        return lineas_csv(columnas, filas)
+    return lineas_ndjson(columnas, filas)
+
+
+def respuesta_exportacion(queryset, columnas, formato, nombre):
+    respuesta = StreamingHttpResponse(
+        generar_exportacion(queryset, columnas, formato),
+        content_type=FORMATOS[formato]
+    )
+    respuesta['Content-Disposition'] = f'attachment; filename="{nombre}.{formato}"'
+    return respuesta
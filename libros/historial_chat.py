@@ -0,0 +1,122 @@
+"""
+Historial de las salas de chat: los últimos CHAT_HISTORIAL_MENSAJES
+mensajes de cada sala, que vencen CHAT_HISTORIAL_SEGUNDOS después del
+último. ChatConsumer los reenvía al conectar desde `?since=<id>` (o todos,
+sin `since`), así quien se reconecta recupera lo que se perdió.
+
+Con el channel layer de Redis (channels_redis) cada sala es un stream en
+el mismo Redis, en el shard que le toca a su clave: XADD con MAXLEN exacto
+y EXPIRE van en un pipeline (un viaje, O(1): se recorta de a una entrada) y
+la reproducción es un XRANGE desde el id. Con otro layer (InMemory, en los
+tests) se usa un deque por sala en el proceso.
+
+Cada entrada guarda solo [usuario, mensaje], codificada con msgpack si está
+instalado. Los ids son los del stream ('<ms>-<n>'), crecientes por sala.
+"""
+import re
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .codecs import CODECS, JSON
+
+ID = re.compile(r'^\d+(?:-\d+)?$')
+
+CODEC = CODECS.get('msgpack', JSON)
+
+
+def _maximo():
+    return getattr(settings, 'CHAT_HISTORIAL_MENSAJES', 100)
+
+
+def _segundos():
+    return getattr(settings, 'CHAT_HISTORIAL_SEGUNDOS', 24 * 60 * 60)
+
+
+def _orden(mensaje_id):
+    """(ms, n) del id; sin '-n' vale n=0, como en Redis"""
+    ms, _, numero = mensaje_id.partition('-')
+    return int(ms), int(numero or 0)
+
+
+def _mensaje(mensaje_id, contenido):
+    username, message = CODEC.decodificar(contenido)
+    return {'id': mensaje_id, 'username': username, 'message': message}
+
+
+class HistorialRedis:
+    """Un stream por sala en el Redis del channel layer"""
+
+    def __init__(self, capa):
+        self.capa = capa
+
+    def clave(self, sala):
+        return f'{self.capa.prefix}:chat:{sala}'
+
+    def conexion(self, clave):
+        return self.capa.connection(self.capa.consistent_hash(clave))
+
+    async def agregar(self, sala, username, message):
+        clave = self.clave(sala)
+        async with self.conexion(clave) as conexion:
+            async with conexion.pipeline(transaction=False) as pipeline:
+                pipeline.xadd(clave, {'d': CODEC.codificar([username, message])},
+                              maxlen=_maximo(), approximate=False)
+                pipeline.expire(clave, _segundos())
+                mensaje_id, _ = await pipeline.execute()
+        return mensaje_id.decode()
+
+    async def desde(self, sala, since=None):
+        clave = self.clave(sala)
+        async with self.conexion(clave) as conexion:
+            entradas = await conexion.xrange(clave, min=f'({since}' if since else '-')
+        return [_mensaje(mensaje_id.decode(), campos[b'd']) for mensaje_id, campos in entradas]
+
+
+class HistorialMemoria:
+    """Un deque por sala en el proceso"""
+
+    def __init__(self):
+        self.salas = {}  # sala: (vence, último número, deque de (id, contenido))
+
+    def _sala(self, sala):
+        guardada = self.salas.get(sala)
+        if guardada is None or guardada[0] <= time.monotonic():
+            return 0, deque(maxlen=_maximo())
+        return guardada[1], guardada[2]
+
+    async def agregar(self, sala, username, message):
+        if sala not in self.salas:
+            ahora = time.monotonic()
+            self.salas = {
+                nombre: guardada for nombre, guardada in self.salas.items() if guardada[0] > ahora
+            }
+        numero, mensajes = self._sala(sala)
+        mensaje_id = f'{numero + 1}-0'
+        mensajes.append((mensaje_id, CODEC.codificar([username, message])))
+        self.salas[sala] = (time.monotonic() + _segundos(), numero + 1, mensajes)
+        return mensaje_id
+
+    async def desde(self, sala, since=None):
+        _, mensajes = self._sala(sala)
+        minimo = _orden(since) if since else (-1, -1)
+        return [
+            _mensaje(mensaje_id, contenido) for mensaje_id, contenido in mensajes
+            if _orden(mensaje_id) > minimo
+        ]
+
+
+_memoria = HistorialMemoria()
+
+
+def historial(capa):
+    """El historial que corresponde al channel layer `capa`"""
+    if hasattr(capa, 'consistent_hash') and hasattr(capa, 'connection'):
+        return HistorialRedis(capa)
+    return _memoria
+
+
+def since_valido(since):
+    """`since` si es un id de mensaje, si no None"""
+    return since if isinstance(since, str) and ID.match(since) else None
@@ -0,0 +1,233 @@
+"""
+Importación masiva de libros (POST /api/libros/importar/).
+
+Valida todas las filas, resuelve autores y categorías con una consulta por
+bloque de claves distintas (por nombre exacto y, si no está, por el nombre
+sin mayúsculas ni acentos cuando coincide con uno solo; si coincide con
+varios la fila se rechaza) y escribe con bulk_create + upsert sobre `isbn`,
+todo en una transacción. Cada fila válida reemplaza los datos del libro con
+el mismo ISBN, y sus instantáneas se publican al confirmarse
+(cambios.registrar), como en el ajuste masivo de stock.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.parsers import BaseParser
+from rest_framework.serializers import as_serializer_error
+
+from .autocompletado import normalizar
+from .cache_respuestas import invalidar
+from .cambios import registrar
+from .codecs import JSON
+from .models import Autor, Categoria, Libro, destino_upsert
+from .serializers import LibroImportacionSerializer
+from .suscripciones import instantanea
+from .utils import LOTE, en_bloques
+
+
+# fecha_creacion y creado_por se conservan al actualizar
+CAMPOS_ACTUALIZABLES = [
+    'titulo', 'subtitulo', 'autor', 'categoria', 'editorial',
+    'fecha_publicacion', 'paginas', 'idioma', 'descripcion',
+    'imagen_portada', 'stock', 'estado', 'precio', 'valoracion',
+    'activo', 'fecha_actualizacion',
+]
+
+
+class NDJSONParser(BaseParser):
+    """Un objeto JSON por línea (application/x-ndjson)"""
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        filas = []
+        for numero, linea in enumerate(stream or [], start=1):
+            linea = linea.strip()
+            if not linea:
+                continue
+            try:
+                filas.append(JSON.decodificar(linea))
+            except ValueError as exc:
+                raise ParseError(f'NDJSON inválido en la línea {numero}: {exc}')
+        return filas
+
+
+def _emparejar(pedidas, filas, clave_normalizada):
+    """
+    ({clave pedida: id}, claves ambiguas) entre las `filas` (id, clave) de
+    la base. Primero se busca la clave exacta; si no está, la normalizada
+    (sin mayúsculas ni acentos, que la collation puede ignorar) solo si
+    coincide con una única fila: si son varias, la clave es ambigua y no se
+    elige ninguna.
+    """
+    exactas = {}
+    normalizadas = defaultdict(set)
+    for fila_id, clave in filas:
+        exactas[clave] = fila_id
+        normalizadas[clave_normalizada(clave)].add(fila_id)
+    resueltas, ambiguas = {}, set()
+    for clave in pedidas:
+        candidatas = normalizadas.get(clave_normalizada(clave), ())
+        if clave in exactas:
+            resueltas[clave] = exactas[clave]
+        elif len(candidatas) == 1:
+            resueltas[clave] = next(iter(candidatas))
+        elif candidatas:
+            ambiguas.add(clave)
+    return resueltas, ambiguas
+
+
+def _autor_normalizado(clave):
+    return normalizar(clave[0]), normalizar(clave[1])
+
+
+def _resolver_autores(claves):
+    """
+    ({(nombre, apellido): autor_id}, claves ambiguas), creando los que
+    falten
+    """
+    def buscar(pendientes):
+        filas = []
+        for bloque in en_bloques(pendientes):
+            filas.extend(
+                (autor_id, (nombre, apellido)) for autor_id, nombre, apellido in
+                Autor.objects.filter(
+                    nombre__in={nombre for nombre, _ in bloque},
+                    apellido__in={apellido for _, apellido in bloque},
+                ).values_list('id', 'nombre', 'apellido')
+            )
+        return _emparejar(pendientes, filas, _autor_normalizado)
+
+    resueltos, ambiguos = buscar(claves)
+    faltantes = set(claves) - resueltos.keys() - ambiguos
+    if faltantes:
+        Autor.objects.bulk_create(
+            [Autor(nombre=nombre, apellido=apellido) for nombre, apellido in faltantes],
+            batch_size=LOTE, ignore_conflicts=True,
+        )
+        resueltos.update(buscar(faltantes)[0])
+    return resueltos, ambiguos
+
+
+def _resolver_categorias(nombres):
+    """({nombre: categoria_id}, nombres ambiguos), creando las que falten"""
+    def buscar(pendientes):
+        filas = []
+        for bloque in en_bloques(pendientes):
+            filas.extend(Categoria.objects.filter(nombre__in=bloque).values_list('id', 'nombre'))
+        return _emparejar(pendientes, filas, normalizar)
+
+    resueltas, ambiguas = buscar(nombres)
+    faltantes = set(nombres) - resueltas.keys() - ambiguas
+    if faltantes:
+        Categoria.objects.bulk_create(
+            [Categoria(nombre=nombre) for nombre in faltantes],
+            batch_size=LOTE, ignore_conflicts=True,
+        )
+        resueltas.update(buscar(faltantes)[0])
+    return resueltas, ambiguas
+
+
+def importar_libros(filas, usuario=None):
+    """
+    Importa `filas` (dicts con el formato de LibroImportacionSerializer) y
+    devuelve un resultado por fila: creado, actualizado, duplicado (el ISBN
+    aparece más adelante en la misma carga) o error con sus mensajes.
+    """
+    resultados = []
+    validas = {}  # isbn -> (posición, datos); la última aparición gana
+    # Una sola instancia: construir los campos del serializer por fila
+    # cuesta más que validar
+    validador = LibroImportacionSerializer()
+    for posicion, fila in enumerate(filas):
+        isbn = fila.get('isbn') if isinstance(fila, dict) else None
+        resultados.append({'fila': posicion, 'isbn': isbn})
+        try:
+            datos = validador.run_validation(fila)
+        except ValidationError as exc:
+            resultados[posicion].update(
+                resultado='error', errores=as_serializer_error(exc)
+            )
+            continue
+        anterior = validas.get(datos['isbn'])
+        if anterior is not None:
+            resultados[anterior[0]]['resultado'] = 'duplicado'
+        validas[datos['isbn']] = (posicion, datos)
+
+    if not validas:
+        return resultados
+
+    with transaction.atomic():
+        autores, autores_ambiguos = _resolver_autores({
+            (datos['autor']['nombre'], datos['autor']['apellido'])
+            for _, datos in validas.values()
+        })
+        categorias, categorias_ambiguas = _resolver_categorias({
+            datos['categoria'] for _, datos in validas.values() if datos.get('categoria')
+        })
+        for isbn, (posicion, datos) in list(validas.items()):
+            autor = (datos['autor']['nombre'], datos['autor']['apellido'])
+            errores = {}
+            if autor in autores_ambiguos:
+                errores['autor'] = [
+                    f'Hay varios autores "{" ".join(autor)}" que solo difieren en '
+                    'mayúsculas o acentos'
+                ]
+            if datos.get('categoria') in categorias_ambiguas:
+                errores['categoria'] = [
+                    f'Hay varias categorías "{datos["categoria"]}" que solo difieren en '
+                    'mayúsculas o acentos'
+                ]
+            if errores:
+                resultados[posicion].update(resultado='error', errores=errores)
+                del validas[isbn]
+
+        # Autor y categoría anteriores de los ISBN existentes:
+        # creado/actualizado, contadores y aviso a la categoría que se deja
+        existentes = {}
+        for bloque in en_bloques(validas):
+            existentes.update(
+                (isbn, (autor_id, categoria_id)) for isbn, autor_id, categoria_id in
+                Libro.objects.filter(isbn__in=bloque).values_list('isbn', 'autor_id', 'categoria_id')
+            )
+
+        libros = []
+        for isbn, (posicion, datos) in validas.items():
+            datos = dict(datos)
+            autor = datos.pop('autor')
+            categoria = datos.pop('categoria', None)
+            libros.append(Libro(
+                autor_id=autores[(autor['nombre'], autor['apellido'])],
+                categoria_id=categorias.get(categoria) if categoria else None,
+                creado_por=usuario if usuario and usuario.is_authenticated else None,
+                **datos
+            ))
+            resultados[posicion]['resultado'] = (
+                'actualizado' if isbn in existentes else 'creado'
+            )
+
+        Libro.objects.bulk_create(
+            libros,
+            batch_size=LOTE,
+            update_conflicts=True,
+            unique_fields=destino_upsert('isbn'),
+            update_fields=CAMPOS_ACTUALIZABLES,
+        )
+        # bulk_create no pasa por Libro.save(): contadores de autores en bloque
+        autor_ids = {libro.autor_id for libro in libros}
+        autor_ids.update(autor_id for autor_id, _ in existentes.values())
+        for bloque in en_bloques(autor_ids):
+            Autor.recalcular_total_libros(bloque)
+        # Ni bulk_create ni los autores/categorías nuevos emiten señales
+        invalidar('libros', 'autores', 'categorias')
+        # El upsert no devuelve los ids de los libros actualizados
+        ids = {}
+        for bloque in en_bloques(validas):
+            ids.update(Libro.objects.filter(isbn__in=bloque).values_list('isbn', 'pk'))
+        for libro in libros:
+            libro.pk = ids[libro.isbn]
+        registrar(
+            instantanea(libro, existentes.get(libro.isbn, (None, None))[1]) for libro in libros
+        )
+
+    return resultados
@@ -0,0 +1,125 @@
+"""
+Ajuste masivo de stock (POST /api/libros/ajustar_stock/ y la mutación
+actualizarStockLibros).
+
+Los ajustes se validan todos antes de tocar la base y se aplican juntos en
+una transacción: si alguno es inválido o apunta a un libro inexistente no
+se aplica ninguno. Las filas se bloquean con SELECT ... FOR UPDATE en orden
+de id, así dos cargas que se solapan piden los candados en el mismo orden
+y no pueden bloquearse mutuamente. El stock final se calcula en Python con
+las reglas del UPDATE atómico (Libro.stock_ajustado) y se escribe solo
+para los libros que cambian, con un UPDATE por cada valor final distinto;
+sus instantáneas se publican juntas al confirmarse (cambios.registrar).
+
+Cada llamada admite hasta AJUSTES_STOCK_MAX_FILAS ajustes, venga del REST o
+de GraphQL.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import as_serializer_error
+
+from .cache_respuestas import invalidar
+from .cambios import registrar
+from .models import Libro
+from .serializers import AjusteStockSerializer
+from .suscripciones import instantanea
+from .utils import en_bloques
+
+
+class AjustesInvalidos(Exception):
+    """`errores`: [{'ajuste': posición, 'errores': {...}}]"""
+
+    def __init__(self, errores):
+        super().__init__(errores)
+        self.errores = errores
+
+
+class DemasiadosAjustes(Exception):
+    """Más de AJUSTES_STOCK_MAX_FILAS ajustes en una llamada"""
+
+    def __init__(self, maximo):
+        super().__init__(f'Máximo {maximo} ajustes por solicitud')
+        self.maximo = maximo
+
+
+def _validar(ajustes):
+    validador = AjusteStockSerializer()
+    validos, errores = [], []
+    for posicion, ajuste in enumerate(ajustes):
+        try:
+            validos.append((posicion, validador.run_validation(ajuste)))
+        except ValidationError as exc:
+            errores.append({'ajuste': posicion, 'errores': as_serializer_error(exc)})
+    if errores:
+        raise AjustesInvalidos(errores)
+    return validos
+
+
+def ajustar_stock(ajustes):
+    """
+    Aplica `ajustes` en orden (varios sobre el mismo libro se acumulan) y
+    devuelve el stock resultante de cada libro afectado:
+    [{'libro_id', 'isbn', 'stock', 'estado'}] en el orden en que aparecen.
+    Lanza AjustesInvalidos sin modificar nada si alguno no es válido, y
+    DemasiadosAjustes si son más de AJUSTES_STOCK_MAX_FILAS.
+    """
+    maximo = getattr(settings, 'AJUSTES_STOCK_MAX_FILAS', 20000)
+    if len(ajustes) > maximo:
+        raise DemasiadosAjustes(maximo)
+    validos = _validar(ajustes)
+
+    with transaction.atomic():
+        por_isbn = {}
+        for bloque in en_bloques({datos['isbn'] for _, datos in validos if 'isbn' in datos}):
+            por_isbn.update(Libro.objects.filter(isbn__in=bloque).values_list('isbn', 'pk'))
+
+        destinos = []
+        for _, datos in validos:
+            destinos.append(datos['libro_id'] if 'libro_id' in datos else por_isbn.get(datos['isbn']))
+
+        filas = {}
+        for bloque in en_bloques(sorted({pk for pk in destinos if pk is not None})):
+            filas.update(
+                (fila['pk'], fila) for fila in Libro.objects.select_for_update()
+                .filter(pk__in=bloque).order_by('pk').values('pk', 'isbn', 'titulo', 'stock', 'estado', 'categoria_id')
+            )
+
+        errores = [
+            {'ajuste': posicion, 'errores': {'libro': ['El libro no existe']}}
+            for (posicion, _), pk in zip(validos, destinos) if pk not in filas
+        ]
+        if errores:
+            raise AjustesInvalidos(errores)
+
+        originales = {pk: (fila['estado'], fila['stock']) for pk, fila in filas.items()}
+        afectados = {}
+        for (_, datos), pk in zip(validos, destinos):
+            fila = filas[pk]
+            cantidad = datos['cantidad'] if 'cantidad' in datos else datos['stock'] - fila['stock']
+            fila['estado'], fila['stock'] = Libro.stock_ajustado(fila['estado'], fila['stock'], cantidad)
+            afectados[pk] = fila
+
+        # Un UPDATE por valor final (stock, estado): en un inventario los
+        # valores se repiten mucho, y bulk_update arma un CASE por fila
+        cambiados = [pk for pk, fila in afectados.items() if (fila['estado'], fila['stock']) != originales[pk]]
+        grupos = defaultdict(list)
+        for pk in cambiados:
+            grupos[(filas[pk]['stock'], filas[pk]['estado'])].append(pk)
+        ahora = timezone.now()
+        for (stock, estado), pks in grupos.items():
+            for bloque in en_bloques(pks):
+                Libro.objects.filter(pk__in=bloque).update(
+                    stock=stock, estado=estado, fecha_actualizacion=ahora
+                )
+        if grupos:
+            invalidar('libros')
+            registrar(instantanea(Libro(**filas[pk])) for pk in cambiados)
+
+    return [
+        {'libro_id': pk, 'isbn': fila['isbn'], 'stock': fila['stock'], 'estado': fila['estado']}
+        for pk, fila in afectados.items()
+    ]
@@ -0,0 +1,134 @@
+"""
+Serialización de solo lectura para los listados grandes.
+
+`LecturaRapida` arma los dicts de salida directamente desde filas de
+`.values()` en lugar de instanciar modelos y recorrer la maquinaria de campos
+de DRF por cada fila. La salida es idéntica a la del serializer original:
+se usan sus mismos campos (ya recortados por ?fields=/?omit=) y, para los
+tipos con formato propio (decimales, fechas), su `to_representation`.
+
+Los campos que no son columnas se calculan en `DERIVADOS_*` a partir de las
+columnas declaradas en `dependencias` del serializer.
+"""
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import Libro
+
+
+# Campos cuyo to_representation no cambia el valor que devuelve la base
+_IDENTIDAD = (
+    serializers.CharField, serializers.IntegerField, serializers.BooleanField,
+    serializers.ChoiceField, serializers.ReadOnlyField,
+    serializers.PrimaryKeyRelatedField,
+)
+
+# Mismo criterio que las propiedades del modelo / las fuentes con punto
+DERIVADOS_LIBROS = {
+    'autor_nombre': lambda fila: f"{fila['autor__nombre']} {fila['autor__apellido']}",
+    'esta_disponible': lambda fila: (
+        fila['estado'] == Libro.DISPONIBLE and fila['stock'] > 0
+    ),
+}
+
+
+def _dias_prestamo(fila):
+    fin = fila['fecha_devolucion_real'] or timezone.now()
+    return (fin - fila['fecha_prestamo']).days
+
+
+def _esta_atrasado(fila):
+    if fila['fecha_devolucion_real']:
+        return False
+    return timezone.now().date() > fila['fecha_devolucion_esperada']
+
+
+DERIVADOS_PRESTAMOS = {
+    'dias_prestamo': _dias_prestamo,
+    'esta_atrasado': _esta_atrasado,
+}
+
+COLUMNAS_VIGENCIA_PRESTAMO = ('fecha_prestamo', 'fecha_devolucion_esperada', 'fecha_devolucion_real')
+
+
+def vigencia_prestamo(fila):
+    """
+    ((dias_prestamo, esta_atrasado), desde cuándo valen): cambian con la
+    hora aunque la fila no cambie, y eso cuenta para el GET condicional
+    """
+    dias, atrasado = _dias_prestamo(fila), _esta_atrasado(fila)
+    desde = fila['fecha_prestamo'] + timedelta(days=dias)
+    if atrasado:
+        # Se atrasó al empezar el día siguiente al vencimiento
+        vencido = datetime.combine(
+            fila['fecha_devolucion_esperada'] + timedelta(days=1), time.min,
+            tzinfo=timezone.now().tzinfo,
+        )
+        desde = max(desde, vencido)
+    return (dias, atrasado), desde
+
+
+class LecturaRapida:
+    """Plan de serialización por filas para un serializer (hijo, no lista)"""
+
+    def __init__(self, serializer, derivados):
+        self.derivados = derivados
+        self.plan = []
+        self.columnas = set(serializer.columnas_requeridas())
+        for nombre, campo in serializer.fields.items():
+            if campo.write_only:
+                continue
+            if nombre in derivados:
+                self.plan.append((nombre, derivados[nombre], None, False))
+                continue
+            clave = campo.source.replace('.', '__')
+            convertir = None if isinstance(campo, _IDENTIDAD) else campo.to_representation
+            # DRF omite la clave si la relación intermedia es nula
+            self.plan.append((nombre, clave, convertir, '.' in campo.source))
+
+    @classmethod
+    def soporta(cls, serializer, derivados):
+        """False si algún campo no puede leerse de una fila de `.values()`"""
+        for nombre, campo in serializer.fields.items():
+            if nombre in derivados or campo.write_only:
+                continue
+            if isinstance(campo, (serializers.SerializerMethodField,
+                                  serializers.BaseSerializer)):
+                return False
+            if isinstance(campo, serializers.ReadOnlyField) and '.' not in campo.source:
+                modelo = serializer.Meta.model
+                if campo.source not in {f.name for f in modelo._meta.concrete_fields}:
+                    return False
+        return True
+
+    def preparar(self, queryset, extra=()):
+        """
+        Queryset de `.values()` con las columnas del plan, las del orden y
+        las `extra` que use la vista
+        """
+        columnas = self.columnas | set(extra)
+        modelo = queryset.model
+        concretos = {f.name for f in modelo._meta.concrete_fields}
+        for orden in queryset.query.order_by:
+            if isinstance(orden, str) and orden.lstrip('-') in concretos:
+                columnas.add(orden.lstrip('-'))
+        # Los select de .extra() (relevancia) se piden para poder ordenar
+        return queryset.values('pk', *columnas, *queryset.query.extra)
+
+    def serializar(self, filas):
+        datos = []
+        for fila in filas:
+            salida = {}
+            for nombre, clave, convertir, opcional in self.plan:
+                valor = clave(fila) if callable(clave) else fila[clave]
+                if valor is None:
+                    if not opcional:
+                        salida[nombre] = None
+                elif convertir is None:
+                    salida[nombre] = valor
+                else:
+                    salida[nombre] = convertir(valor)
+            datos.append(salida)
+        return datos
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from libros.exportacion import (
+    COLUMNAS_LIBROS, COLUMNAS_PRESTAMOS, FORMATOS, generar_exportacion
+)
+from libros.models import Libro, Prestamo
+
+
+ORIGENES = {
+    'libros': (Libro.objects.filter(activo=True), COLUMNAS_LIBROS),
+    'prestamos': (Prestamo.objects.all(), COLUMNAS_PRESTAMOS),
+}
+
+
+class Command(BaseCommand):
+    """Exporta el catálogo o el historial de préstamos a un archivo"""
+
+    help = 'Exporta libros o préstamos a CSV/NDJSON sin cargarlos en memoria'
+
+    def add_arguments(self, parser):
+        parser.add_argument('origen', choices=list(ORIGENES))
+        parser.add_argument('salida', help='Ruta del archivo a escribir')
+        parser.add_argument(
+            '--formato', choices=list(FORMATOS), default='csv',
+            help='Formato de salida (default: csv)'
+        )
+        parser.add_argument(
+            '--filtro', action='append', default=[], metavar='CAMPO=VALOR',
+            help='Filtro del ORM, repetible (ej. --filtro estado=activo)'
+        )
+
+    def handle(self, *args, **options):
+        queryset, columnas = ORIGENES[options['origen']]
+        for filtro in options['filtro']:
+            campo, separador, valor = filtro.partition('=')
+            if not separador:
+                raise CommandError(f'Filtro inválido: {filtro} (se espera CAMPO=VALOR)')
+            queryset = queryset.filter(**{campo: valor})
+
+        inicio = time.monotonic()
+        lineas = 0
+        with open(options['salida'], 'w', encoding='utf-8', newline='') as archivo:
+            for linea in generar_exportacion(queryset, columnas, options['formato']):
+                archivo.write(linea)
+                lineas += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{lineas} líneas escritas en {options["salida"]} '
+            f'en {time.monotonic() - inicio:.2f}s'
+        ))
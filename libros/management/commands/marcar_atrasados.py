@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from libros.models import Prestamo
+
+
+class Command(BaseCommand):
+    """Marca como atrasados los préstamos activos vencidos"""
+
+    help = 'Pasa a ATRASADO los préstamos activos cuya fecha de devolución ya pasó'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote', type=int, default=5000,
+            help='Filas por UPDATE (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        inicio = time.monotonic()
+        total = Prestamo.marcar_atrasados(lote=options['lote'])
+        duracion = time.monotonic() - inicio
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Préstamos marcados como atrasados: {total} en {duracion:.2f}s'
+        ))
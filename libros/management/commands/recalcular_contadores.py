@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from libros.models import Autor, EstadisticasUsuario
+
+
+class Command(BaseCommand):
+    """Reconstruye los contadores desnormalizados de autores y usuarios"""
+
+    help = 'Recalcula Autor.total_libros y EstadisticasUsuario.total_prestamos en bloque'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote', type=int, default=1000,
+            help='Cantidad de autores/usuarios por transacción (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        lote = options['lote']
+
+        autores = self._por_lotes(Autor.objects.values_list('pk', flat=True), lote,
+                                  Autor.recalcular_total_libros)
+        usuarios = self._por_lotes(User.objects.values_list('pk', flat=True), lote,
+                                   EstadisticasUsuario.recalcular)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Contadores recalculados: {autores} autores, {usuarios} usuarios'
+        ))
+
+    def _por_lotes(self, ids, lote, recalcular):
+        """Aplica `recalcular` a los ids en bloques ordenados por pk"""
+        total = 0
+        ultimo_id = 0
+        while True:
+            bloque = list(ids.filter(pk__gt=ultimo_id).order_by('pk')[:lote])
+            if not bloque:
+                return total
+            with transaction.atomic():
+                recalcular(bloque)
+            total += len(bloque)
+            ultimo_id = bloque[-1]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libros', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='libro',
+            name='libros_libr_isbn_88473c_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='libro',
+            name='libros_libr_autor_i_ef6aa2_idx',
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['-fecha_creacion', 'activo'], name='libro_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['estado', '-fecha_creacion'], name='libro_estado_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['autor', '-fecha_creacion'], name='libro_autor_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['categoria', '-fecha_creacion'], name='libro_categoria_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(condition=models.Q(('activo', True), ('estado', 'disponible'), ('stock__gt', 0)), fields=['-fecha_creacion'], name='libro_disponibles_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['-fecha_prestamo'], name='prestamo_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['estado', '-fecha_prestamo'], name='prestamo_estado_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['usuario', 'estado', '-fecha_prestamo'], name='prestamo_usuario_estado_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:10
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def poblar_contadores(apps, schema_editor):
+    Autor = apps.get_model('libros', 'Autor')
+    Libro = apps.get_model('libros', 'Libro')
+    Prestamo = apps.get_model('libros', 'Prestamo')
+    EstadisticasUsuario = apps.get_model('libros', 'EstadisticasUsuario')
+
+    activos = Libro.objects.filter(
+        autor=OuterRef('pk'), activo=True
+    ).order_by().values('autor').annotate(total=Count('id')).values('total')
+    Autor.objects.update(total_libros=Coalesce(Subquery(activos), 0))
+
+    totales = Prestamo.objects.order_by().values('usuario').annotate(total=Count('id'))
+    EstadisticasUsuario.objects.bulk_create(
+        (EstadisticasUsuario(usuario_id=fila['usuario'], total_prestamos=fila['total'])
+         for fila in totales.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('libros', '0002_indices_consultas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EstadisticasUsuario',
+            fields=[
+                ('usuario', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='estadisticas', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total_prestamos', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Estadísticas de usuarios',
+            },
+        ),
+        migrations.AddField(
+            model_name='autor',
+            name='total_libros',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Cantidad de libros activos del autor'),
+        ),
+        migrations.RunPython(poblar_contadores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libros', '0003_contadores_desnormalizados'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['estado', 'fecha_devolucion_esperada'], name='prestamo_estado_vence_idx'),
+        ),
+    ]
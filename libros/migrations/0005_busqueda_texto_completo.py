@@ -0,0 +1,75 @@
+from django.db import migrations
+
+
+# SQLite: tabla FTS5 de contenido externo sincronizada con triggers, así
+# también la mantienen los UPDATE masivos. Ojo: cuando SQLite reconstruye
+# libros_libro (ALTER de columnas) se pierden los triggers; la migración
+# que lo haga debe volver a ejecutar SQLITE_CREAR.
+SQLITE_CREAR = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS libros_libro_fts USING fts5(
+        titulo, isbn, descripcion,
+        content='libros_libro', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS libros_libro_fts_ai AFTER INSERT ON libros_libro BEGIN
+        INSERT INTO libros_libro_fts(rowid, titulo, isbn, descripcion)
+        VALUES (new.id, new.titulo, new.isbn, new.descripcion);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS libros_libro_fts_ad AFTER DELETE ON libros_libro BEGIN
+        INSERT INTO libros_libro_fts(libros_libro_fts, rowid, titulo, isbn, descripcion)
+        VALUES ('delete', old.id, old.titulo, old.isbn, old.descripcion);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS libros_libro_fts_au
+    AFTER UPDATE OF titulo, isbn, descripcion ON libros_libro BEGIN
+        INSERT INTO libros_libro_fts(libros_libro_fts, rowid, titulo, isbn, descripcion)
+        VALUES ('delete', old.id, old.titulo, old.isbn, old.descripcion);
+        INSERT INTO libros_libro_fts(rowid, titulo, isbn, descripcion)
+        VALUES (new.id, new.titulo, new.isbn, new.descripcion);
+    END
+    """,
+    "INSERT INTO libros_libro_fts(libros_libro_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BORRAR = [
+    'DROP TRIGGER IF EXISTS libros_libro_fts_ai',
+    'DROP TRIGGER IF EXISTS libros_libro_fts_ad',
+    'DROP TRIGGER IF EXISTS libros_libro_fts_au',
+    'DROP TABLE IF EXISTS libros_libro_fts',
+]
+
+# MySQL mantiene el índice FULLTEXT por sí mismo
+MYSQL_CREAR = [
+    'ALTER TABLE libros_libro ADD FULLTEXT INDEX libro_texto_idx (titulo, isbn, descripcion)',
+]
+
+MYSQL_BORRAR = [
+    'ALTER TABLE libros_libro DROP INDEX libro_texto_idx',
+]
+
+
+def ejecutar(sentencias_por_motor):
+    def operacion(apps, schema_editor):
+        for sentencia in sentencias_por_motor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sentencia)
+    return operacion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libros', '0004_indice_prestamos_vencidos'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            ejecutar({'sqlite': SQLITE_CREAR, 'mysql': MYSQL_CREAR}),
+            ejecutar({'sqlite': SQLITE_BORRAR, 'mysql': MYSQL_BORRAR}),
+        ),
+    ]
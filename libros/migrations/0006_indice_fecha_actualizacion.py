@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libros', '0005_busqueda_texto_completo'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['fecha_actualizacion'], name='libro_actualizacion_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libros', '0006_indice_fecha_actualizacion'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='libro',
+            name='libro_fecha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='libro',
+            name='libro_estado_fecha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='libro',
+            name='libro_autor_fecha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='libro',
+            name='libro_categoria_fecha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='prestamo',
+            name='prestamo_fecha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='prestamo',
+            name='prestamo_estado_fecha_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='prestamo',
+            name='prestamo_usuario_estado_idx',
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['-fecha_creacion', '-id'], name='libro_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['estado', '-fecha_creacion', '-id'], name='libro_estado_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['autor', '-fecha_creacion', '-id'], name='libro_autor_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='libro',
+            index=models.Index(fields=['categoria', '-fecha_creacion', '-id'], name='libro_categoria_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['-fecha_prestamo', '-id'], name='prestamo_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['estado', '-fecha_prestamo', '-id'], name='prestamo_estado_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prestamo',
+            index=models.Index(fields=['usuario', 'estado', '-fecha_prestamo', '-id'], name='prestamo_usuario_estado_id_idx'),
+        ),
+    ]
@@ -1,8 +1,46 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User
 from decimal import Decimal
 
+from .cache_respuestas import invalidar
+from .cambios import registrar
+from .suscripciones import instantanea
+
+
+def destino_upsert(*campos):
+    """
+    `unique_fields` para bulk_create(update_conflicts=True). MySQL resuelve el
+    conflicto por cualquier clave única y no acepta que se indique destino.
+    """
+    if connection.features.supports_update_conflicts_with_target:
+        return list(campos)
+    return None
+
+
+def valores_guardados(instancia, campos, update_fields=None):
+    """
+    Valores de `campos` en la fila de `instancia` antes de guardarla, para
+    saber si el save los cambia. None si la fila es nueva o si
+    `update_fields` no incluye ninguno de los campos.
+    """
+    if instancia._state.adding:
+        return None
+    diferidos = instancia.get_deferred_fields()
+    if update_fields is None and diferidos:
+        # Como Model.save: solo se escriben los campos cargados
+        update_fields = {campo.attname for campo in instancia._meta.concrete_fields} - diferidos
+    campos = [instancia._meta.get_field(campo) for campo in campos]
+    if update_fields is not None and not any(
+        {campo.name, campo.attname} & set(update_fields) for campo in campos
+    ):
+        return None
+    return type(instancia)._base_manager.filter(pk=instancia.pk).values_list(
+        *[campo.attname for campo in campos]
+    ).first()
+
 
 class Categoria(models.Model):
     """Categorías de libros (Ficción, No Ficción, Ciencia, etc.)"""
@@ -31,6 +69,14 @@ class Autor(models.Model):
     foto = models.URLField(blank=True, help_text="URL de la foto del autor")
     fecha_creacion = models.DateTimeField(auto_now_add=True)
     
+    # Contador desnormalizado, mantenido por Libro.save()/delete() y el
+    # delete() de los querysets de libros
+    total_libros = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Cantidad de libros activos del autor"
+    )
+    
     class Meta:
         verbose_name_plural = "Autores"
         ordering = ['apellido', 'nombre']
@@ -42,6 +88,31 @@ class Autor(models.Model):
     @property
     def nombre_completo(self):
         return f"{self.nombre} {self.apellido}"
+    
+    @classmethod
+    def recalcular_total_libros(cls, autor_ids=None):
+        """
+        Recalcula total_libros con un único UPDATE por subconsulta.
+        Sin `autor_ids` recalcula todos los autores.
+        """
+        activos = Libro.objects.filter(
+            autor=OuterRef('pk'), activo=True
+        ).order_by().values('autor').annotate(total=Count('id')).values('total')
+        autores = cls.objects.all()
+        if autor_ids is not None:
+            autores = autores.filter(pk__in=autor_ids)
+        return autores.update(total_libros=Coalesce(Subquery(activos), 0))
+
+
+class LibroQuerySet(models.QuerySet):
+
+    def delete(self):
+        """Borra en bloque y recalcula los contadores de los autores afectados"""
+        with transaction.atomic():
+            autor_ids = set(self.values_list('autor_id', flat=True))
+            resultado = super().delete()
+            Autor.recalcular_total_libros(autor_ids)
+        return resultado
 
 
 class Libro(models.Model):
@@ -123,33 +194,140 @@ class Libro(models.Model):
         related_name='libros_creados'
     )
     
+    objects = LibroQuerySet.as_manager()
+    
     class Meta:
         verbose_name_plural = "Libros"
         ordering = ['-fecha_creacion']
+        # Todas las consultas del catálogo filtran activo=True y ordenan por
+        # -fecha_creacion; `activo` no encabeza ningún índice porque casi
+        # todas las filas son activas y Django lo compara como `WHERE activo`.
+        # El `-id` final es el desempate de la paginación por cursor.
         indexes = [
-            models.Index(fields=['isbn']),
             models.Index(fields=['titulo']),
-            models.Index(fields=['autor']),
+            models.Index(fields=['-fecha_creacion', '-id'], name='libro_fecha_id_idx'),
+            models.Index(fields=['estado', '-fecha_creacion', '-id'],
+                         name='libro_estado_fecha_id_idx'),
+            models.Index(fields=['autor', '-fecha_creacion', '-id'],
+                         name='libro_autor_fecha_id_idx'),
+            models.Index(fields=['categoria', '-fecha_creacion', '-id'],
+                         name='libro_categoria_fecha_id_idx'),
+            # Cambios recientes (sincronización del autocompletado)
+            models.Index(fields=['fecha_actualizacion'],
+                         name='libro_actualizacion_idx'),
+            # /api/libros/disponibles/ (MySQL no soporta índices parciales
+            # y usa libro_estado_fecha_id_idx)
+            models.Index(fields=['-fecha_creacion'],
+                         condition=models.Q(activo=True, estado='disponible', stock__gt=0),
+                         name='libro_disponibles_idx'),
         ]
     
     def __str__(self):
         return f"{self.titulo} - {self.autor.nombre_completo}"
     
+    def save(self, *args, **kwargs):
+        """
+        Guarda el libro y, si es nuevo o cambia de autor o de `activo`,
+        recalcula total_libros en la misma transacción
+        """
+        creado = self._state.adding
+        with transaction.atomic():
+            anterior = valores_guardados(self, ['autor', 'activo', 'categoria'], kwargs.get('update_fields'))
+            # Categoría que deja el libro, para avisar a sus suscriptores (signals.py)
+            self._categoria_anterior_id = anterior[2] if anterior is not None else None
+            super().save(*args, **kwargs)
+            if creado:
+                Autor.recalcular_total_libros([self.autor_id])
+            elif anterior is not None and anterior[:2] != (self.autor_id, self.activo):
+                Autor.recalcular_total_libros({anterior[0], self.autor_id})
+    
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            resultado = super().delete(*args, **kwargs)
+            Autor.recalcular_total_libros([self.autor_id])
+        return resultado
+    
     @property
     def esta_disponible(self):
         """Verifica si el libro está disponible para préstamo"""
         return self.estado == self.DISPONIBLE and self.stock > 0
     
-    def actualizar_stock(self, cantidad):
-        """Actualiza el stock del libro"""
-        self.stock += cantidad
-        if self.stock < 0:
-            self.stock = 0
-        if self.stock == 0:
-            self.estado = self.PRESTADO
-        elif self.stock > 0 and self.estado == self.PRESTADO:
-            self.estado = self.DISPONIBLE
-        self.save()
+    def actualizar_stock(self, cantidad, version=None):
+        """
+        Actualiza el stock del libro con un UPDATE atómico. Con `version`
+        (fecha_actualizacion leída) solo escribe si nadie modificó el libro
+        desde entonces; devuelve False si no se actualizó.
+        """
+        filtro = {'pk': self.pk}
+        if version is not None:
+            filtro['fecha_actualizacion'] = version
+        if not Libro.objects.filter(**filtro).update(**self._expresiones_stock(cantidad)):
+            return False
+        invalidar('libros')
+        self.refresh_from_db(fields=['stock', 'estado', 'fecha_actualizacion'])
+        self._publicar_cambio()
+        return True
+    
+    def prestar_ejemplar(self):
+        """
+        Descuenta un ejemplar solo si el libro sigue disponible.
+        Devuelve False si otro préstamo se llevó el último ejemplar.
+        """
+        actualizados = Libro.objects.filter(
+            pk=self.pk,
+            estado=self.DISPONIBLE,
+            stock__gt=0
+        ).update(**self._expresiones_stock(-1))
+        if actualizados:
+            invalidar('libros')
+            self.refresh_from_db(fields=['stock', 'estado', 'fecha_actualizacion'])
+            self._publicar_cambio()
+        return bool(actualizados)
+    
+    def _publicar_cambio(self):
+        """El UPDATE no dispara post_save: se publica desde aquí"""
+        registrar([instantanea(self)])
+    
+    @classmethod
+    def stock_ajustado(cls, estado, stock, cantidad):
+        """(estado, stock) tras sumar `cantidad`, con las reglas de _expresiones_stock"""
+        if stock + cantidad <= 0:
+            return cls.PRESTADO, 0
+        return (cls.DISPONIBLE if estado == cls.PRESTADO else estado), stock + cantidad
+    
+    @classmethod
+    def _expresiones_stock(cls, cantidad):
+        """
+        Expresiones SQL para sumar `cantidad` al stock y recalcular el estado
+        en la misma sentencia. `estado` va primero porque MySQL evalúa las
+        asignaciones de izquierda a derecha y debe ver el stock anterior.
+        """
+        from django.utils import timezone
+        agotado = models.Q(stock__lte=-cantidad)
+        return {
+            'estado': Case(
+                When(agotado, then=Value(cls.PRESTADO)),
+                When(estado=cls.PRESTADO, then=Value(cls.DISPONIBLE)),
+                default=F('estado'),
+            ),
+            # Se evita `stock + cantidad` negativo: la columna es UNSIGNED en MySQL
+            'stock': Case(
+                When(agotado, then=Value(0)),
+                default=F('stock') + cantidad,
+            ),
+            'fecha_actualizacion': timezone.now(),
+        }
+
+
+class PrestamoQuerySet(models.QuerySet):
+
+    def delete(self):
+        """Borra en bloque (también desde el admin) y recalcula los usuarios afectados"""
+        with transaction.atomic():
+            usuario_ids = set(self.values_list('usuario_id', flat=True))
+            resultado = super().delete()
+            EstadisticasUsuario.recalcular(usuario_ids)
+        return resultado
 
 
 class Prestamo(models.Model):
@@ -180,14 +358,76 @@ class Prestamo(models.Model):
     estado = models.CharField(max_length=20, choices=ESTADOS, 
                              default=ACTIVO)
     notas = models.TextField(blank=True)
+    # Validador de GET condicional; los UPDATE masivos la fijan a mano
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+    
+    objects = PrestamoQuerySet.as_manager()
     
     class Meta:
         verbose_name_plural = "Préstamos"
         ordering = ['-fecha_prestamo']
+        indexes = [
+            models.Index(fields=['-fecha_prestamo', '-id'], name='prestamo_fecha_id_idx'),
+            models.Index(fields=['estado', '-fecha_prestamo', '-id'],
+                         name='prestamo_estado_fecha_id_idx'),
+            models.Index(fields=['usuario', 'estado', '-fecha_prestamo', '-id'],
+                         name='prestamo_usuario_estado_id_idx'),
+            # Barrido de vencidos (marcar_atrasados)
+            models.Index(fields=['estado', 'fecha_devolucion_esperada'],
+                         name='prestamo_estado_vence_idx'),
+        ]
     
     def __str__(self):
         return f"{self.libro.titulo} - {self.usuario.username}"
     
+    def save(self, *args, **kwargs):
+        """
+        Guarda el préstamo y actualiza las estadísticas del usuario (de los
+        dos, si el préstamo cambia de usuario)
+        """
+        creado = self._state.adding
+        with transaction.atomic():
+            anterior = valores_guardados(self, ['usuario'], kwargs.get('update_fields'))
+            super().save(*args, **kwargs)
+            if creado:
+                EstadisticasUsuario.incrementar(self.usuario_id)
+            elif anterior is not None and anterior[0] != self.usuario_id:
+                EstadisticasUsuario.recalcular([anterior[0], self.usuario_id])
+    
+    def delete(self, *args, **kwargs):
+        # Se recuenta en lugar de restar uno: un contador desfasado en 0
+        # haría fallar el UPDATE de la columna sin signo
+        with transaction.atomic():
+            resultado = super().delete(*args, **kwargs)
+            EstadisticasUsuario.recalcular([self.usuario_id])
+        return resultado
+    
+    @classmethod
+    def marcar_atrasados(cls, hoy=None, lote=5000):
+        """
+        Pasa a ATRASADO los préstamos activos vencidos con UPDATEs por lotes.
+        Cada lote toma los ids más antiguos por fecha_devolucion_esperada
+        desde prestamo_estado_vence_idx; como las filas actualizadas salen
+        del conjunto ACTIVO, el siguiente lote continúa donde quedó el
+        anterior. Pensado para el comando `marcar_atrasados` o un
+        programador de tareas. Devuelve la cantidad de filas modificadas.
+        """
+        from django.utils import timezone
+        hoy = hoy or timezone.localdate()
+        vencidos = cls.objects.filter(
+            estado=cls.ACTIVO,
+            fecha_devolucion_esperada__lt=hoy
+        ).order_by('fecha_devolucion_esperada')
+        total = 0
+        while True:
+            ids = list(vencidos.values_list('pk', flat=True)[:lote])
+            if not ids:
+                return total
+            with transaction.atomic():
+                total += cls.objects.filter(
+                    pk__in=ids, estado=cls.ACTIVO
+                ).update(estado=cls.ATRASADO, fecha_actualizacion=timezone.now())
+    
     @property
     def dias_prestamo(self):
         """Calcula días que lleva el préstamo"""
@@ -202,4 +442,54 @@ class Prestamo(models.Model):
         from django.utils import timezone
         if self.fecha_devolucion_real:
             return False
-        return timezone.now().date() > self.fecha_devolucion_esperada
\ No newline at end of file
+        return timezone.now().date() > self.fecha_devolucion_esperada
+
+
+class EstadisticasUsuario(models.Model):
+    """Contadores desnormalizados de préstamos por usuario"""
+    
+    usuario = models.OneToOneField(User, on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name='estadisticas')
+    total_prestamos = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        verbose_name_plural = "Estadísticas de usuarios"
+    
+    def __str__(self):
+        return f"{self.usuario.username}: {self.total_prestamos} préstamos"
+    
+    @classmethod
+    def incrementar(cls, usuario_id, cantidad=1):
+        """
+        Suma `cantidad` con un UPDATE atómico, sin bajar de 0; crea la fila
+        si no existe
+        """
+        # Como en Libro._expresiones_stock, sin restar por debajo de 0: la
+        # columna es UNSIGNED en MySQL
+        actualizados = cls.objects.filter(usuario_id=usuario_id).update(
+            total_prestamos=Case(
+                When(total_prestamos__lte=-cantidad, then=Value(0)),
+                default=F('total_prestamos') + cantidad,
+            )
+        )
+        if not actualizados:
+            cls.recalcular([usuario_id])
+    
+    @classmethod
+    def recalcular(cls, usuario_ids):
+        """Recalcula total_prestamos de los usuarios indicados en bloque"""
+        usuario_ids = list(usuario_ids)
+        totales = dict(
+            Prestamo.objects.filter(usuario_id__in=usuario_ids)
+            .order_by().values('usuario')
+            .annotate(total=Count('id'))
+            .values_list('usuario', 'total')
+        )
+        cls.objects.bulk_create(
+            [cls(usuario_id=usuario_id, total_prestamos=totales.get(usuario_id, 0))
+             for usuario_id in usuario_ids],
+            update_conflicts=True,
+            unique_fields=destino_upsert('usuario'),
+            update_fields=['total_prestamos'],
+        )
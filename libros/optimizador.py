@@ -0,0 +1,112 @@
+"""
+Optimización de los querysets de GraphQL según la selección del cliente.
+
+`optimizar(queryset, info)` recorre el selection set del campo que se está
+resolviendo (fragmentos, alias y @skip/@include incluidos) y aplica:
+
+- `.only()` con las columnas de los campos pedidos, más las que declare el
+  tipo en `dependencias` para sus campos calculados;
+- `select_related` para las FK pedidas, con sus propias columnas;
+- `Prefetch` con un queryset optimizado igual, recursivamente, para las
+  relaciones inversas.
+
+Lo que el optimizador no llegó a traer (objetos devueltos por mutaciones,
+por ejemplo) lo resuelven los cargadores de `cargadores.py`.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from graphene.utils.str_converters import to_snake_case
+from graphql import (
+    FieldNode, FragmentSpreadNode, GraphQLIncludeDirective, GraphQLSkipDirective,
+    InlineFragmentNode, get_named_type,
+)
+from graphql.execution.values import get_directive_values
+
+
+def _incluido(nodo, info):
+    skip = get_directive_values(GraphQLSkipDirective, nodo, info.variable_values)
+    if skip and skip['if']:
+        return False
+    include = get_directive_values(GraphQLIncludeDirective, nodo, info.variable_values)
+    return not include or include['if']
+
+
+def _campos(nodos, info, campos=None):
+    """{nombre del campo GraphQL: [FieldNode, ...]} de las selecciones de `nodos`"""
+    campos = {} if campos is None else campos
+    for nodo in nodos:
+        if nodo.selection_set is None:
+            continue
+        for seleccion in nodo.selection_set.selections:
+            if not _incluido(seleccion, info):
+                continue
+            if isinstance(seleccion, FieldNode):
+                campos.setdefault(seleccion.name.value, []).append(seleccion)
+            elif isinstance(seleccion, InlineFragmentNode):
+                _campos([seleccion], info, campos)
+            elif isinstance(seleccion, FragmentSpreadNode):
+                _campos([info.fragments[seleccion.name.value]], info, campos)
+    return campos
+
+
+def _plan(modelo, tipo, nodos, info, prefijo=''):
+    """
+    (columnas para only, rutas de select_related, Prefetch) de un nivel; las
+    FK se recorren con el mismo plan bajo `prefijo`
+    """
+    columnas = {prefijo + modelo._meta.pk.name}
+    relacionados, precargas = [], []
+    dependencias = getattr(getattr(tipo, 'graphene_type', None), 'dependencias', {})
+
+    for nombre_gql, subnodos in _campos(nodos, info).items():
+        if nombre_gql.startswith('__') or nombre_gql not in tipo.fields:
+            continue
+        nombre = to_snake_case(nombre_gql)
+        try:
+            campo = modelo._meta.get_field(nombre)
+        except FieldDoesNotExist:
+            columnas.update(prefijo + dependencia for dependencia in dependencias.get(nombre, ()))
+            continue
+
+        subtipo = get_named_type(tipo.fields[nombre_gql].type)
+        if campo.many_to_one or (campo.one_to_one and campo.concrete):
+            columnas.add(prefijo + nombre)
+            sub = _plan(campo.related_model, subtipo, subnodos, info, f'{prefijo}{nombre}__')
+            columnas |= sub[0]
+            relacionados += [f'{prefijo}{nombre}'] + sub[1]
+            precargas += sub[2]
+        elif campo.one_to_many:
+            interno = _optimizar(
+                campo.related_model._default_manager.all(), subtipo, subnodos, info,
+                # La FK hacia el padre, para repartir los hijos
+                extra=(campo.field.name,),
+            )
+            precargas.append(Prefetch(prefijo + campo.get_accessor_name(), queryset=interno))
+        elif campo.concrete and not campo.many_to_many:
+            columnas.add(prefijo + nombre)
+    return columnas, relacionados, precargas
+
+
+def _optimizar(queryset, tipo, nodos, info, extra=()):
+    columnas, relacionados, precargas = _plan(queryset.model, tipo, nodos, info)
+    queryset = queryset.only(*columnas, *extra)
+    if relacionados:
+        queryset = queryset.select_related(*relacionados)
+    if precargas:
+        queryset = queryset.prefetch_related(*precargas)
+    return queryset
+
+
+def optimizar(queryset, info, ruta=(), extra=()):
+    """
+    Queryset del campo raíz en resolución, recortado a lo que se pidió.
+    `ruta` baja por campos intermedios hasta los objetos del modelo (en una
+    conexión Relay, ('edges', 'node')); `extra` son columnas que necesita el
+    resolver aunque no se pidan, como las del cursor.
+    """
+    tipo = get_named_type(info.return_type)
+    nodos = info.field_nodes
+    for nombre in ruta:
+        nodos = _campos(nodos, info).get(nombre, [])
+        tipo = get_named_type(tipo.fields[nombre].type)
+    return _optimizar(queryset, tipo, nodos, info, extra)
@@ -0,0 +1,187 @@
+"""
+Paginación por cursor (keyset) para listados grandes.
+
+Ordena por (campo, id) y pide la página siguiente con
+`WHERE (campo, id) < (último_campo, último_id)`, sin OFFSET ni COUNT(*).
+El campo sale del orden ya aplicado por OrderingFilter; si no sirve como
+clave (columna nula, anotación o varios campos) se usa paginación por
+número de página. Acepta instancias o filas de `.values()` que incluyan 'pk'.
+"""
+import base64
+import json
+from types import SimpleNamespace
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def codificar_cursor(datos):
+    return base64.urlsafe_b64encode(
+        json.dumps(datos, separators=(',', ':')).encode()
+    ).decode('ascii')
+
+
+def decodificar_cursor(codificado):
+    """dict del cursor opaco; ValueError si no es válido"""
+    datos = json.loads(base64.urlsafe_b64decode(codificado.encode('ascii')))
+    if not isinstance(datos, dict):
+        raise ValueError(codificado)
+    return datos
+
+
+def filtrar_desde(queryset, campo, valor, pk, hacia_atras):
+    """Filas estrictamente después de (valor, pk) en el orden (campo, pk)"""
+    operador = 'lt' if hacia_atras else 'gt'
+    return queryset.filter(
+        Q(**{f'{campo}__{operador}': valor})
+        | Q(**{campo: valor, f'pk__{operador}': pk})
+    )
+
+
+class PaginacionNumerada(PageNumberPagination):
+    """Respaldo para órdenes que no admiten cursor"""
+    page_size = api_settings.PAGE_SIZE or 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class KeysetPagination(BasePagination):
+    """Cursor opaco sobre (campo de orden, id); devuelve next/previous/results"""
+
+    page_size = api_settings.PAGE_SIZE or 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Cursor inválido'
+    paginacion_respaldo = PaginacionNumerada
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.respaldo = None
+        campo, descendente = self.get_campo_orden(queryset)
+        if campo is None:
+            self.respaldo = self.paginacion_respaldo()
+            return self.respaldo.paginate_queryset(queryset, request, view)
+
+        self.campo = campo
+        self.field = queryset.model._meta.get_field(campo)
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        reverso = bool(cursor and cursor['r'])
+
+        # En reverso (página anterior) se recorre al revés y luego se invierte
+        hacia_atras = descendente != reverso
+        prefijo = '-' if hacia_atras else ''
+        queryset = queryset.order_by(f'{prefijo}{campo}', f'{prefijo}pk')
+        if cursor:
+            queryset = filtrar_desde(queryset, campo, cursor['v'], cursor['pk'], hacia_atras)
+
+        resultados = list(queryset[:self.page_size + 1])
+        hay_mas = len(resultados) > self.page_size
+        resultados = resultados[:self.page_size]
+        if reverso:
+            resultados.reverse()
+            self.hay_siguiente, self.hay_anterior = True, hay_mas
+        else:
+            self.hay_siguiente, self.hay_anterior = hay_mas, cursor is not None
+        self.page = resultados
+        return resultados
+
+    def get_campo_orden(self, queryset):
+        """
+        Devuelve (campo, descendente) si el orden admite cursor, o
+        (None, None) para usar la paginación de respaldo.
+        """
+        orden = [o for o in (queryset.query.order_by or queryset.model._meta.ordering)
+                 if o not in ('pk', '-pk', 'id', '-id')]
+        if len(orden) != 1 or not isinstance(orden[0], str):
+            return None, None
+        campo = orden[0].lstrip('-')
+        try:
+            field = queryset.model._meta.get_field(campo)
+        except FieldDoesNotExist:
+            return None, None
+        if field.null or not field.concrete or field.is_relation:
+            return None, None
+        return campo, orden[0].startswith('-')
+
+    def get_page_size(self, request):
+        try:
+            tamano = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(tamano, self.max_page_size))
+
+    # ===== Cursor =====
+
+    def decode_cursor(self, request):
+        codificado = request.query_params.get(self.cursor_query_param)
+        if not codificado:
+            return None
+        try:
+            datos = decodificar_cursor(codificado)
+            return {
+                'v': self.field.to_python(datos['v']),
+                'pk': int(datos['pk']),
+                'r': bool(datos.get('r')),
+            }
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instancia, reverso):
+        if isinstance(instancia, dict):
+            # Fila de .values() (lectura rápida)
+            pk = instancia['pk']
+            instancia = SimpleNamespace(**{self.field.attname: instancia[self.campo]})
+        else:
+            pk = instancia.pk
+        datos = {
+            'v': self.field.value_to_string(instancia),
+            'pk': pk,
+            'r': int(reverso),
+        }
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, codificar_cursor(datos))
+
+    # ===== Respuesta =====
+
+    def get_next_link(self):
+        if self.respaldo:
+            return self.respaldo.get_next_link()
+        if not self.hay_siguiente or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverso=False)
+
+    def get_previous_link(self):
+        if self.respaldo:
+            return self.respaldo.get_previous_link()
+        if not self.hay_anterior:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(),
+                                      self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverso=True)
+
+    def get_paginated_response(self, data):
+        if self.respaldo:
+            return self.respaldo.get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
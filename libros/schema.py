@@ -1,20 +1,38 @@
 import graphene
+from django.conf import settings
 from graphene_django import DjangoObjectType
+from graphql import GraphQLError
 from .models import Libro, Autor, Categoria
+from .busqueda import buscar_libros
+from .cargadores import cargadores, nivel
+from .conexiones import ConexionContada, conexion_desplazamiento, conexion_keyset
+from .inventario import AjustesInvalidos, DemasiadosAjustes, ajustar_stock
+from .optimizador import optimizar
+from .suscripciones import escuchar, grupo_categoria, grupo_libro, ids_suscripcion
 
 
 # ===== TYPES (Tipos de Datos) =====
 
+# Los resolvers raíz recortan el queryset a la selección (optimizador.py);
+# las relaciones que no vinieron precargadas se resuelven con los cargadores
+# del request (un IN por relación y nivel) en lugar de una consulta por objeto
+
 class AutorType(DjangoObjectType):
     class Meta:
         model = Autor
         fields = '__all__'
+    
+    def resolve_libros(self, info):
+        return cargadores(info).libros_por_autor.cargar_relacion(self, 'libros')
 
 
 class CategoriaType(DjangoObjectType):
     class Meta:
         model = Categoria
         fields = '__all__'
+    
+    def resolve_libros(self, info):
+        return cargadores(info).libros_por_categoria.cargar_relacion(self, 'libros')
 
 
 class LibroType(DjangoObjectType):
@@ -23,13 +41,37 @@ class LibroType(DjangoObjectType):
         fields = '__all__'
     
     esta_disponible = graphene.Boolean()
+    # Columnas que el optimizador pide para los campos calculados
+    dependencias = {'esta_disponible': ('estado', 'stock')}
     
     def resolve_esta_disponible(self, info):
         return self.esta_disponible
+    
+    def resolve_autor(self, info):
+        return cargadores(info).autores.cargar_relacion(self, 'autor')
+    
+    def resolve_categoria(self, info):
+        return cargadores(info).categorias.cargar_relacion(self, 'categoria')
+
+
+class LibroConnection(ConexionContada):
+    class Meta:
+        node = LibroType
 
 
 # ===== QUERIES (Consultas) =====
 
+def _acotar(queryset):
+    """Las listas sin paginar devuelven como mucho GRAPHQL_MAX_LISTA filas"""
+    return queryset[:getattr(settings, 'GRAPHQL_MAX_LISTA', 1000)]
+
+
+def _conexion_libros(info, queryset, first, after):
+    """Keyset sobre (-fecha_creacion, -id), el orden indexado del catálogo"""
+    queryset = optimizar(queryset, info, ruta=('edges', 'node'), extra=('fecha_creacion',))
+    return conexion_keyset(LibroConnection, queryset, 'fecha_creacion', first, after)
+
+
 class Query(graphene.ObjectType):
     # Queries simples
     all_libros = graphene.List(LibroType)
@@ -55,41 +97,86 @@ class Query(graphene.ObjectType):
         titulo=graphene.String(required=True)
     )
     
+    # Conexiones Relay (first/after); las listas de arriba quedan por
+    # compatibilidad, acotadas a GRAPHQL_MAX_LISTA libros
+    all_libros_conexion = graphene.Field(
+        LibroConnection, first=graphene.Int(), after=graphene.String()
+    )
+    libros_por_autor_conexion = graphene.Field(
+        LibroConnection,
+        autor_id=graphene.Int(required=True),
+        first=graphene.Int(),
+        after=graphene.String()
+    )
+    libros_disponibles_conexion = graphene.Field(
+        LibroConnection, first=graphene.Int(), after=graphene.String()
+    )
+    buscar_libros_conexion = graphene.Field(
+        LibroConnection,
+        titulo=graphene.String(required=True),
+        first=graphene.Int(),
+        after=graphene.String()
+    )
+    
     # Resolvers
     def resolve_all_libros(self, info):
-        return Libro.objects.filter(activo=True)
+        return nivel(_acotar(optimizar(Libro.objects.filter(activo=True), info)))
     
     def resolve_all_autores(self, info):
-        return Autor.objects.all()
+        return nivel(optimizar(Autor.objects.all(), info))
     
     def resolve_all_categorias(self, info):
-        return Categoria.objects.all()
+        return nivel(optimizar(Categoria.objects.all(), info))
     
     def resolve_libro(self, info, id=None, isbn=None):
+        libros = optimizar(Libro.objects.all(), info)
         if id:
-            return Libro.objects.get(pk=id)
+            return libros.get(pk=id)
         if isbn:
-            return Libro.objects.get(isbn=isbn)
+            return libros.get(isbn=isbn)
         return None
     
     def resolve_libros_por_autor(self, info, autor_id):
-        return Libro.objects.filter(
+        return nivel(_acotar(optimizar(Libro.objects.filter(
             autor_id=autor_id,
             activo=True
-        )
+        ), info)))
     
     def resolve_libros_disponibles(self, info):
-        return Libro.objects.filter(
+        return nivel(_acotar(optimizar(Libro.objects.filter(
             estado=Libro.DISPONIBLE,
             stock__gt=0,
             activo=True
-        )
+        ), info)))
     
     def resolve_buscar_libros(self, info, titulo):
-        return Libro.objects.filter(
-            titulo__icontains=titulo,
-            activo=True
+        return nivel(_acotar(buscar_libros(
+            optimizar(Libro.objects.filter(activo=True), info),
+            titulo
+        ).order_by('-relevancia', '-fecha_creacion')))
+    
+    def resolve_all_libros_conexion(self, info, first=None, after=None):
+        return _conexion_libros(info, Libro.objects.filter(activo=True), first, after)
+    
+    def resolve_libros_por_autor_conexion(self, info, autor_id, first=None, after=None):
+        return _conexion_libros(
+            info, Libro.objects.filter(autor_id=autor_id, activo=True), first, after
         )
+    
+    def resolve_libros_disponibles_conexion(self, info, first=None, after=None):
+        return _conexion_libros(info, Libro.objects.filter(
+            estado=Libro.DISPONIBLE,
+            stock__gt=0,
+            activo=True
+        ), first, after)
+    
+    def resolve_buscar_libros_conexion(self, info, titulo, first=None, after=None):
+        # La relevancia es una anotación: cursor por posición
+        queryset = buscar_libros(
+            optimizar(Libro.objects.filter(activo=True), info, ruta=('edges', 'node')),
+            titulo
+        ).order_by('-relevancia', '-fecha_creacion')
+        return conexion_desplazamiento(LibroConnection, queryset, first, after)
 
 
 # ===== MUTATIONS (Modificaciones) =====
@@ -112,6 +199,46 @@ class ActualizarStockLibro(graphene.Mutation):
         )
 
 
+class AjusteStockInput(graphene.InputObjectType):
+    """Libro por libro_id o isbn; stock por cantidad (diferencia) o stock (final)"""
+    libro_id = graphene.Int()
+    isbn = graphene.String()
+    cantidad = graphene.Int()
+    stock = graphene.Int()
+
+
+class StockLibro(graphene.ObjectType):
+    libro_id = graphene.Int()
+    isbn = graphene.String()
+    stock = graphene.Int()
+    estado = graphene.String()
+
+
+class ActualizarStockLibros(graphene.Mutation):
+    """Ajustes de inventario en bloque: se aplican todos o ninguno"""
+    class Arguments:
+        ajustes = graphene.List(graphene.NonNull(AjusteStockInput), required=True)
+    
+    libros = graphene.List(StockLibro)
+    mensaje = graphene.String()
+    
+    def mutate(self, info, ajustes):
+        try:
+            libros = ajustar_stock([
+                {campo: valor for campo, valor in ajuste.items() if valor is not None}
+                for ajuste in ajustes
+            ])
+        except DemasiadosAjustes as exc:
+            raise GraphQLError(str(exc))
+        except AjustesInvalidos as exc:
+            raise GraphQLError('Ajustes inválidos', extensions={'errores': exc.errores})
+        
+        return ActualizarStockLibros(
+            libros=[StockLibro(**libro) for libro in libros],
+            mensaje=f"Stock actualizado en {len(libros)} libros"
+        )
+
+
 class CrearAutor(graphene.Mutation):
     class Arguments:
         nombre = graphene.String(required=True)
@@ -133,9 +260,48 @@ class CrearAutor(graphene.Mutation):
 
 class Mutation(graphene.ObjectType):
     actualizar_stock_libro = ActualizarStockLibro.Field()
+    actualizar_stock_libros = ActualizarStockLibros.Field()
     crear_autor = CrearAutor.Field()
 
 
+# ===== SUBSCRIPTIONS (ws/graphql/, ver suscripciones.py) =====
+
+class LibroActualizado(graphene.ObjectType):
+    """Instantánea publicada al cambiar un libro"""
+    id = graphene.ID(required=True)
+    titulo = graphene.String()
+    stock = graphene.Int()
+    estado = graphene.String()
+    disponible = graphene.Boolean()
+    categoria_id = graphene.ID()
+
+
+class Subscription(graphene.ObjectType):
+    libro_actualizado = graphene.Field(
+        LibroActualizado,
+        ids=graphene.List(graphene.NonNull(graphene.ID), required=True),
+        required=True
+    )
+    # Libros de la categoría que entran o salen de disponibles (el primer
+    # cambio de cada libro se envía siempre: no se sabe cómo estaba antes).
+    # Un libro que pasa a otra categoría se envía una vez más, con la nueva
+    # categoriaId, para que el cliente lo saque
+    disponibilidad_categoria = graphene.Field(
+        LibroActualizado,
+        id=graphene.ID(required=True),
+        required=True
+    )
+    
+    # Se valida al suscribir: los errores van en la respuesta a `subscribe`
+    
+    def subscribe_libro_actualizado(root, info, ids):
+        return escuchar(info, [grupo_libro(libro_id) for libro_id in ids_suscripcion(ids)])
+    
+    def subscribe_disponibilidad_categoria(root, info, id):
+        grupos = [grupo_categoria(categoria_id) for categoria_id in ids_suscripcion([id])]
+        return escuchar(info, grupos, clave=lambda libro: libro['disponible'])
+
+
 # ===== SCHEMA =====
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
\ No newline at end of file
@@ -3,7 +3,34 @@ from .models import Categoria, Autor, Libro, Prestamo
 from django.contrib.auth.models import User
 
 
-class CategoriaSerializer(serializers.ModelSerializer):
+class CamposDinamicosMixin:
+    """
+    Acepta `campos=` y `omitir=` para recortar los campos del serializer y
+    calcula las columnas que hacen falta para serializar los que quedan.
+    `dependencias` declara las columnas de los campos que no son del modelo.
+    """
+    
+    dependencias = {}
+    
+    def __init__(self, *args, campos=None, omitir=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if campos is not None:
+            for nombre in set(self.fields) - set(campos):
+                self.fields.pop(nombre)
+        for nombre in omitir or ():
+            self.fields.pop(nombre, None)
+    
+    def columnas_requeridas(self):
+        """Rutas del ORM (`autor__nombre`) para `.only()`"""
+        columnas = set()
+        for nombre, campo in self.fields.items():
+            columnas.update(self.dependencias.get(
+                nombre, [campo.source.replace('.', '__')]
+            ))
+        return columnas
+
+
+class CategoriaSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     """Serializer para Categoría"""
     
     class Meta:
@@ -12,29 +39,30 @@ class CategoriaSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'fecha_creacion']
 
 
-class AutorSerializer(serializers.ModelSerializer):
+class AutorSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     """Serializer para Autor"""
     
     nombre_completo = serializers.ReadOnlyField()
-    total_libros = serializers.SerializerMethodField()
+    dependencias = {'nombre_completo': ['nombre', 'apellido']}
     
     class Meta:
         model = Autor
         fields = ['id', 'nombre', 'apellido', 'nombre_completo', 
                  'fecha_nacimiento', 'pais_origen', 'biografia', 
                  'foto', 'total_libros', 'fecha_creacion']
-        read_only_fields = ['id', 'fecha_creacion']
-    
-    def get_total_libros(self, obj):
-        return obj.libros.filter(activo=True).count()
+        read_only_fields = ['id', 'total_libros', 'fecha_creacion']
 
 
-class LibroSerializer(serializers.ModelSerializer):
+class LibroSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     """Serializer para Libro"""
     
     autor_nombre = serializers.CharField(source='autor.nombre_completo', read_only=True)
     categoria_nombre = serializers.CharField(source='categoria.nombre', read_only=True)
     esta_disponible = serializers.ReadOnlyField()
+    dependencias = {
+        'autor_nombre': ['autor__nombre', 'autor__apellido'],
+        'esta_disponible': ['estado', 'stock'],
+    }
     
     class Meta:
         model = Libro
@@ -66,13 +94,66 @@ class LibroSerializer(serializers.ModelSerializer):
         return value
 
 
-class PrestamoSerializer(serializers.ModelSerializer):
+class AutorImportacionSerializer(serializers.Serializer):
+    """Autor de una fila de importación, identificado por nombre y apellido"""
+    
+    nombre = serializers.CharField(max_length=100)
+    apellido = serializers.CharField(max_length=100)
+
+
+class LibroImportacionSerializer(LibroSerializer):
+    """
+    Valida una fila de la importación masiva. Autor y categoría llegan por
+    nombre; el ISBN repetido no es error porque la fila actualiza el libro.
+    """
+    
+    autor_nombre = None
+    categoria_nombre = None
+    esta_disponible = None
+    autor = AutorImportacionSerializer()
+    categoria = serializers.CharField(max_length=150, required=False,
+                                      allow_blank=True, allow_null=True)
+    
+    class Meta(LibroSerializer.Meta):
+        fields = [
+            'titulo', 'subtitulo', 'isbn', 'autor', 'categoria',
+            'editorial', 'fecha_publicacion', 'paginas', 'idioma',
+            'descripcion', 'imagen_portada',
+            'stock', 'estado', 'precio', 'valoracion', 'activo'
+        ]
+        extra_kwargs = {'isbn': {'validators': []}}
+
+
+class AjusteStockSerializer(serializers.Serializer):
+    """
+    Un ajuste del inventario: el libro por `libro_id` o `isbn`, y el stock
+    como diferencia (`cantidad`, puede ser negativa) o valor final (`stock`)
+    """
+    
+    libro_id = serializers.IntegerField(required=False)
+    isbn = serializers.CharField(max_length=13, required=False)
+    cantidad = serializers.IntegerField(required=False)
+    stock = serializers.IntegerField(min_value=0, required=False)
+    
+    def validate(self, data):
+        if ('libro_id' in data) == ('isbn' in data):
+            raise serializers.ValidationError('Indique libro_id o isbn (solo uno)')
+        if ('cantidad' in data) == ('stock' in data):
+            raise serializers.ValidationError('Indique cantidad o stock (solo uno)')
+        return data
+
+
+class PrestamoSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     """Serializer para Préstamo"""
     
     libro_titulo = serializers.CharField(source='libro.titulo', read_only=True)
     usuario_nombre = serializers.CharField(source='usuario.username', read_only=True)
     dias_prestamo = serializers.ReadOnlyField()
     esta_atrasado = serializers.ReadOnlyField()
+    dependencias = {
+        'dias_prestamo': ['fecha_prestamo', 'fecha_devolucion_real'],
+        'esta_atrasado': ['fecha_devolucion_real', 'fecha_devolucion_esperada'],
+    }
     
     class Meta:
         model = Prestamo
@@ -107,4 +188,6 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'date_joined']
     
     def get_total_prestamos(self, obj):
-        return obj.prestamos.count()
\ No newline at end of file
+        # Contador desnormalizado; usar select_related('estadisticas') en listados
+        estadisticas = getattr(obj, 'estadisticas', None)
+        return estadisticas.total_prestamos if estadisticas else 0
\ No newline at end of file
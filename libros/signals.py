@@ -0,0 +1,65 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .autocompletado import autocompletado
+from .cache_respuestas import invalidar
+from .cambios import registrar
+from .models import Autor, Categoria, Libro
+from .suscripciones import instantanea
+
+
+# Los índices en memoria solo se tocan si la transacción se confirma
+
+@receiver(post_save, sender=Libro)
+def libro_guardado(sender, instance, **kwargs):
+    transaction.on_commit(lambda: autocompletado.libro_guardado(instance))
+
+
+@receiver(post_delete, sender=Libro)
+def libro_eliminado(sender, instance, **kwargs):
+    transaction.on_commit(lambda: autocompletado.libro_eliminado(instance))
+
+
+@receiver(post_save, sender=Autor)
+def autor_guardado(sender, instance, **kwargs):
+    transaction.on_commit(lambda: autocompletado.autor_guardado(instance))
+
+
+@receiver(post_delete, sender=Autor)
+def autor_eliminado(sender, instance, **kwargs):
+    transaction.on_commit(lambda: autocompletado.autor_eliminado(instance))
+
+
+# Cambios en vivo (suscripciones GraphQL y notificaciones): la instantánea
+# se toma al guardar y se publica solo si la transacción se confirma
+
+@receiver(post_save, sender=Libro)
+def publicar_libro_guardado(sender, instance, **kwargs):
+    registrar([instantanea(instance, getattr(instance, '_categoria_anterior_id', None))])
+
+
+# Cache de respuestas: cada modelo invalida su espacio de versiones
+
+ESPACIOS_CACHE = {
+    Libro: 'libros',
+    Autor: 'autores',
+    Categoria: 'categorias',
+    User: 'usuarios',
+}
+
+
+@receiver(post_save, sender=Libro)
+@receiver(post_delete, sender=Libro)
+@receiver(post_save, sender=Autor)
+@receiver(post_delete, sender=Autor)
+@receiver(post_save, sender=Categoria)
+@receiver(post_delete, sender=Categoria)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidar_cache_respuestas(sender, update_fields=None, **kwargs):
+    # El login solo guarda last_login, que ninguna respuesta muestra
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    invalidar(ESPACIOS_CACHE[sender])
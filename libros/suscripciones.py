@@ -0,0 +1,184 @@
+"""
+Suscripciones GraphQL (libroActualizado, disponibilidadCategoria) sobre
+Channels.
+
+Cada cambio de un libro va a dos grupos lógicos, el del libro y el de su
+categoría (`libro.<id>`, `categoria.<id>`), con la instantánea ya armada
+al escribir (cambios.py), así quien escucha no consulta la base. Los
+grupos de libro se reparten en CAMBIOS_CUBETAS_LIBRO grupos del channel
+layer (`grupo_fisico`): un lote de miles de libros es un group_send por
+cubeta y por categoría. Una conexión de GraphQLSuscripcionesConsumer se une
+solo a los grupos de sus suscripciones y reparte cada libro del evento
+entre las colas de las suscripciones que lo pidieron; cada una descarta lo
+que no cambió desde el último envío.
+
+La cola de cada suscripción (ColaLibros) guarda una sola instantánea por
+libro, la última, y como mucho GRAPHQL_SUSCRIPCION_COLA_MAXIMA libros; lo
+último entregado por libro se recuerda para GRAPHQL_SUSCRIPCION_MAX_ULTIMAS
+libros (el que se olvida vuelve a enviarse en su próximo cambio). Un libro
+que cambia de categoría llega también a la anterior, una última vez y con
+su nueva categoría.
+"""
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from graphql import GraphQLError
+
+from .utils import en_bloques
+
+logger = logging.getLogger(__name__)
+
+TIPO_EVENTO = 'libro.cambiado'
+
+
+def grupo_libro(libro_id):
+    return f'libro.{libro_id}'
+
+
+def grupo_categoria(categoria_id):
+    return f'categoria.{categoria_id}'
+
+
+def grupo_fisico(grupo):
+    """Grupo del channel layer del grupo lógico `grupo` (el mismo salvo los de libro)"""
+    prefijo, separador, libro_id = grupo.rpartition('libro.')
+    if not separador or not libro_id.isdigit():
+        return grupo
+    return f'{prefijo}libro.c{int(libro_id) % getattr(settings, "CAMBIOS_CUBETAS_LIBRO", 64)}'
+
+
+def _grupos_actuales(datos):
+    grupos = [grupo_libro(datos['id'])]
+    if datos.get('categoria_id') is not None:
+        grupos.append(grupo_categoria(datos['categoria_id']))
+    return grupos
+
+
+def grupos_instantanea(datos):
+    """
+    Grupos lógicos de suscripciones que reciben el cambio de un libro: el
+    del libro, el de su categoría y el de la que acaba de dejar
+    """
+    grupos = _grupos_actuales(datos)
+    if datos.get('categoria_anterior_id') is not None:
+        grupos.append(grupo_categoria(datos['categoria_anterior_id']))
+    return grupos
+
+
+def instantanea(libro, categoria_anterior_id=None):
+    """
+    Lo que se publica de cada libro; con `categoria_anterior_id` si acaba
+    de cambiar de categoría
+    """
+    datos = {
+        'id': libro.pk,
+        'titulo': libro.titulo,
+        'stock': libro.stock,
+        'estado': libro.estado,
+        'disponible': libro.esta_disponible,
+        'categoria_id': libro.categoria_id,
+    }
+    if categoria_anterior_id is not None and categoria_anterior_id != libro.categoria_id:
+        datos['categoria_anterior_id'] = categoria_anterior_id
+    return datos
+
+
+async def publicar(libros):
+    """
+    Envía las instantáneas `libros` a los grupos de sus libros y categorías:
+    un evento por grupo del channel layer, de hasta NOTIFICACIONES_MAX_LOTE
+    """
+    capa = get_channel_layer()
+    if capa is None:
+        return
+    por_grupo = defaultdict(list)
+    for datos in libros:
+        for grupo in {grupo_fisico(grupo) for grupo in grupos_instantanea(datos)}:
+            por_grupo[grupo].append(datos)
+    maximo = getattr(settings, 'NOTIFICACIONES_MAX_LOTE', 500)
+    for grupo, libros_grupo in por_grupo.items():
+        for lote in en_bloques(libros_grupo, maximo):
+            await capa.group_send(grupo, {'type': TIPO_EVENTO, 'grupo': grupo, 'libros': lote})
+
+
+def ids_suscripcion(ids):
+    """ids enteros de los argumentos ID de una suscripción"""
+    maximo = getattr(settings, 'GRAPHQL_SUSCRIPCION_MAX_IDS', 100)
+    if len(ids) > maximo:
+        raise GraphQLError(f'Se pueden seguir como mucho {maximo} libros por suscripción')
+    try:
+        return sorted({int(libro_id) for libro_id in ids})
+    except (TypeError, ValueError):
+        raise GraphQLError('id inválido')
+
+
+def escuchar(info, grupos, clave=None):
+    """
+    Flujo de las instantáneas publicadas en `grupos`. Por cada libro solo
+    se entregan las que cambian `clave(libro)` (por defecto, la instantánea
+    completa) respecto de la última entregada.
+    """
+    consumer = info.context
+    if not hasattr(consumer, 'escuchar'):
+        raise GraphQLError('Las suscripciones se sirven por WebSocket (ws/graphql/)')
+    return _eventos(consumer, grupos, clave)
+
+
+class ColaLibros:
+    """
+    Cola de una suscripción con una instantánea pendiente por libro: la
+    nueva reemplaza a la anterior sin perder su lugar. Con `maximo` libros
+    pendientes se descarta el más viejo.
+    """
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self.pendientes = OrderedDict()
+        self.descartados = 0
+        self.hay_libros = asyncio.Event()
+
+    def __len__(self):
+        return len(self.pendientes)
+
+    def poner(self, libro):
+        if libro['id'] not in self.pendientes and len(self.pendientes) >= self.maximo:
+            self.pendientes.popitem(last=False)
+            self.descartados += 1
+        self.pendientes[libro['id']] = libro
+        self.hay_libros.set()
+
+    async def obtener(self):
+        while not self.pendientes:
+            self.hay_libros.clear()
+            await self.hay_libros.wait()
+        return self.pendientes.popitem(last=False)[1]
+
+
+async def _eventos(consumer, grupos, clave):
+    cola = await consumer.escuchar(grupos)
+    ultimas = OrderedDict()
+    maximo = getattr(settings, 'GRAPHQL_SUSCRIPCION_MAX_ULTIMAS', 10000)
+    try:
+        while True:
+            libro = await cola.obtener()
+            if set(grupos).isdisjoint(_grupos_actuales(libro)):
+                # Dejó la categoría: se avisa y se olvida
+                ultimas.pop(libro['id'], None)
+                yield libro
+                continue
+            valor = clave(libro) if clave else libro
+            if libro['id'] in ultimas and ultimas[libro['id']] == valor:
+                continue
+            ultimas.pop(libro['id'], None)
+            ultimas[libro['id']] = valor
+            if len(ultimas) > maximo:
+                ultimas.popitem(last=False)
+            yield libro
+    finally:
+        consumer.dejar(grupos, cola)
+        if cola.descartados:
+            logger.info('%s: %d cambios de libros descartados por suscripción lenta',
+                        consumer.channel_name, cola.descartados)
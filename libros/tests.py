@@ -1,3 +1,2141 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import re
+import tempfile
+import threading
+import tracemalloc
+from io import StringIO
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from graphql import get_introspection_query, parse
+from rest_framework.test import APIClient
+
+from . import difusion
+from .api_views import PrestamoViewSet
+from .autocompletado import autocompletado
+from .cache_respuestas import estadisticas, obtener_cache, obtener_o_calcular
+from .cambios import _disponibilidad, esperar_publicaciones, recientes
+from .cargadores import Cargadores, nivel
+from .codecs import CODECS
+from .consultas_graphql import calcular_costo, huella, preparar_documento
+from .contrapresion import metricas
+from .historial_chat import _memoria
+from .consumers import ChatConsumer, GraphQLSuscripcionesConsumer, NotificacionesConsumer
+from .inventario import ajustar_stock
+from .models import Autor, Categoria, EstadisticasUsuario, Libro, Prestamo
+from .schema import schema
+from .suscripciones import ColaLibros, instantanea, publicar
+from .views import GraphQLCodecView
+
+
+def crear_libro(**kwargs):
+    autor = kwargs.pop('autor', None) or Autor.objects.get_or_create(
+        nombre='Gabriel', apellido='García Márquez'
+    )[0]
+    datos = {
+        'titulo': 'Cien años de soledad',
+        'isbn': '9780307474728',
+        'autor': autor,
+        'precio': Decimal('350.00'),
+    }
+    datos.update(kwargs)
+    return Libro.objects.create(**datos)
+
+
+class StockAtomicoTests(TestCase):
+    """Reglas de stock/estado del UPDATE atómico"""
+
+    def test_agotar_stock_marca_prestado(self):
+        libro = crear_libro(stock=1)
+        libro.actualizar_stock(-1)
+        self.assertEqual(libro.stock, 0)
+        self.assertEqual(libro.estado, Libro.PRESTADO)
+
+    def test_stock_nunca_negativo(self):
+        libro = crear_libro(stock=2)
+        libro.actualizar_stock(-5)
+        self.assertEqual(libro.stock, 0)
+        self.assertEqual(libro.estado, Libro.PRESTADO)
+
+    def test_reponer_stock_vuelve_a_disponible(self):
+        libro = crear_libro(stock=0, estado=Libro.PRESTADO)
+        libro.actualizar_stock(3)
+        self.assertEqual(libro.stock, 3)
+        self.assertEqual(libro.estado, Libro.DISPONIBLE)
+
+    def test_reponer_stock_respeta_mantenimiento(self):
+        libro = crear_libro(stock=1, estado=Libro.MANTENIMIENTO)
+        libro.actualizar_stock(1)
+        self.assertEqual(libro.estado, Libro.MANTENIMIENTO)
+
+    def test_prestar_sin_stock_falla(self):
+        libro = crear_libro(stock=0, estado=Libro.PRESTADO)
+        self.assertFalse(libro.prestar_ejemplar())
+        libro.refresh_from_db()
+        self.assertEqual(libro.stock, 0)
+
+
+class StockConcurrenteTests(TransactionTestCase):
+    """Muchos hilos prestando el mismo libro a la vez"""
+
+    HILOS = 20
+    STOCK_INICIAL = 5
+
+    def test_sin_sobreventa_ni_saves_completos(self):
+        libro = crear_libro(stock=self.STOCK_INICIAL)
+        resultados = []
+        barrera = threading.Barrier(self.HILOS)
+
+        def prestar():
+            try:
+                barrera.wait()
+                resultados.append(
+                    Libro.objects.get(pk=libro.pk).prestar_ejemplar()
+                )
+            finally:
+                connection.close()
+
+        with mock.patch.object(Libro, 'save', side_effect=AssertionError('save completo')):
+            hilos = [threading.Thread(target=prestar) for _ in range(self.HILOS)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+
+        libro.refresh_from_db()
+        self.assertEqual(len(resultados), self.HILOS)
+        self.assertEqual(resultados.count(True), self.STOCK_INICIAL)
+        self.assertEqual(libro.stock, 0)
+        self.assertEqual(libro.estado, Libro.PRESTADO)
+
+
+class PlanConsultasTests(TestCase):
+    """
+    Ejecuta EXPLAIN sobre el SQL de cada endpoint de listado/filtro y falla
+    si alguna tabla de la app se recorre completa o se ordena en memoria.
+    """
+
+    def setUp(self):
+        self.usuario = User.objects.create_user('lector', password='clave123')
+        self.categoria = Categoria.objects.create(nombre='Novela')
+        self.libro = crear_libro(categoria=self.categoria, stock=2)
+        Prestamo.objects.create(
+            libro=self.libro, usuario=self.usuario,
+            fecha_devolucion_esperada='2030-01-01'
+        )
+        self.client = APIClient()
+
+    def planes_problematicos(self, sql):
+        """Devuelve las líneas del plan que indican un full scan o un sort"""
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                lineas = [fila[3] for fila in cursor.fetchall()]
+                return [
+                    linea for linea in lineas
+                    if re.fullmatch(r'SCAN libros_\w+', linea)
+                    or 'TEMP B-TREE FOR ORDER BY' in linea
+                ]
+            if connection.vendor == 'mysql':
+                cursor.execute(f'EXPLAIN {sql}')
+                columnas = [col[0] for col in cursor.description]
+                filas = [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+                return [
+                    fila for fila in filas
+                    if (fila['table'] or '').startswith('libros_')
+                    and (fila['type'] == 'ALL' or 'filesort' in (fila['Extra'] or ''))
+                ]
+        self.skipTest(f'EXPLAIN no soportado para {connection.vendor}')
+
+    def assertSinFullScan(self, capturadas, origen):
+        for consulta in capturadas:
+            sql = consulta['sql']
+            if not sql.startswith('SELECT') or 'libros_' not in sql:
+                continue
+            problemas = self.planes_problematicos(sql)
+            self.assertEqual(problemas, [], f'{origen}: {sql}')
+
+    def test_endpoints_rest_usan_indices(self):
+        urls = [
+            '/api/libros/',
+            '/api/libros/?estado=disponible',
+            f'/api/libros/?autor={self.libro.autor_id}',
+            f'/api/libros/?categoria={self.categoria.id}',
+            '/api/libros/disponibles/',
+            '/api/prestamos/',
+            '/api/prestamos/?estado=activo',
+            '/api/prestamos/?estado=atrasado',
+            f'/api/prestamos/?usuario={self.usuario.id}&estado=activo',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                with CaptureQueriesContext(connection) as capturadas:
+                    respuesta = self.client.get(url)
+                self.assertEqual(respuesta.status_code, 200)
+                self.assertSinFullScan(capturadas, url)
+
+    def test_pagina_por_cursor_usa_indices(self):
+        crear_libro(isbn='9780307474729', categoria=self.categoria)
+        for url in ['/api/libros/?page_size=1', '/api/prestamos/?page_size=1']:
+            siguiente = self.client.get(url).json()['next'] or url
+            with self.subTest(url=siguiente):
+                with CaptureQueriesContext(connection) as capturadas:
+                    self.client.get(siguiente)
+                self.assertSinFullScan(capturadas, siguiente)
+
+    def test_libros_disponibles_graphql_usa_indices(self):
+        with CaptureQueriesContext(connection) as capturadas:
+            resultado = schema.execute('{ librosDisponibles { id titulo } }')
+        self.assertIsNone(resultado.errors)
+        self.assertSinFullScan(capturadas, 'librosDisponibles')
+
+
+class ContadoresTests(TestCase):
+    """Contadores desnormalizados de autores y usuarios"""
+
+    def setUp(self):
+        self.autor = Autor.objects.create(nombre='Isabel', apellido='Allende')
+        self.usuario = User.objects.create_user('lector', password='clave123')
+
+    def test_total_libros_sigue_altas_bajas_y_cambio_de_autor(self):
+        libro = crear_libro(autor=self.autor)
+        crear_libro(autor=self.autor, isbn='9780307474729')
+        self.autor.refresh_from_db()
+        self.assertEqual(self.autor.total_libros, 2)
+
+        libro.activo = False
+        libro.save()
+        self.autor.refresh_from_db()
+        self.assertEqual(self.autor.total_libros, 1)
+
+        otro = Autor.objects.create(nombre='Mario', apellido='Vargas Llosa')
+        libro = Libro.objects.get(pk=libro.pk)
+        libro.activo = True
+        libro.autor = otro
+        libro.save()
+        self.autor.refresh_from_db()
+        otro.refresh_from_db()
+        self.assertEqual((self.autor.total_libros, otro.total_libros), (1, 1))
+
+    def test_total_prestamos_por_usuario(self):
+        libro = crear_libro(autor=self.autor)
+        prestamo = Prestamo.objects.create(
+            libro=libro, usuario=self.usuario, fecha_devolucion_esperada='2030-01-01'
+        )
+        Prestamo.objects.create(
+            libro=libro, usuario=self.usuario, fecha_devolucion_esperada='2030-01-01'
+        )
+        self.assertEqual(self.usuario.estadisticas.total_prestamos, 2)
+        prestamo.delete()
+        self.usuario.estadisticas.refresh_from_db()
+        self.assertEqual(self.usuario.estadisticas.total_prestamos, 1)
+
+    def test_total_prestamos_con_borrados_masivos_y_cambio_de_usuario(self):
+        libro = crear_libro(autor=self.autor)
+        otro = User.objects.create_user('otro', password='clave123')
+        prestamos = [
+            Prestamo.objects.create(libro=libro, usuario=self.usuario,
+                                    fecha_devolucion_esperada='2030-01-01')
+            for _ in range(3)
+        ]
+        prestamos[0].usuario = otro
+        prestamos[0].save()
+        self.assertEqual(
+            (self.usuario.estadisticas.total_prestamos, otro.estadisticas.total_prestamos), (2, 1)
+        )
+
+        # Contador desfasado: borrar no falla y lo corrige
+        EstadisticasUsuario.objects.filter(usuario=self.usuario).update(total_prestamos=0)
+        prestamos[1].delete()
+        self.usuario.estadisticas.refresh_from_db()
+        self.assertEqual(self.usuario.estadisticas.total_prestamos, 1)
+
+        Prestamo.objects.all().delete()
+        self.usuario.estadisticas.refresh_from_db()
+        otro.estadisticas.refresh_from_db()
+        self.assertEqual(
+            (self.usuario.estadisticas.total_prestamos, otro.estadisticas.total_prestamos), (0, 0)
+        )
+
+    def test_total_libros_solo_se_recalcula_si_cambia(self):
+        libro = crear_libro(autor=self.autor)
+        # Completo y con el autor diferido: sin tocar los contadores
+        for cargado in [Libro.objects.get(pk=libro.pk), Libro.objects.only('titulo').get(pk=libro.pk)]:
+            cargado.titulo = 'Paula'
+            with CaptureQueriesContext(connection) as capturadas:
+                cargado.save()
+            self.assertFalse([q for q in capturadas if 'libros_autor' in q['sql']])
+
+        crear_libro(autor=self.autor, isbn='9780307474729')
+        Libro.objects.filter(pk=libro.pk).delete()
+        self.autor.refresh_from_db()
+        self.assertEqual(self.autor.total_libros, 1)
+
+    def test_comando_recalcula_tras_escrituras_masivas(self):
+        crear_libro(autor=self.autor)
+        Libro.objects.update(activo=False)  # no pasa por save()
+        EstadisticasUsuario.objects.create(usuario=self.usuario, total_prestamos=7)
+
+        call_command('recalcular_contadores', stdout=StringIO())
+
+        self.autor.refresh_from_db()
+        self.usuario.estadisticas.refresh_from_db()
+        self.assertEqual(self.autor.total_libros, 0)
+        self.assertEqual(self.usuario.estadisticas.total_prestamos, 0)
+
+    def test_listado_de_autores_con_consultas_constantes(self):
+        cliente = APIClient()
+
+        def consultas_listado(cantidad_autores):
+            for i in range(Autor.objects.count(), cantidad_autores):
+                autor = Autor.objects.create(nombre=f'Autor{i}', apellido='Prueba')
+                crear_libro(autor=autor, isbn=f'978000000{i:04d}')
+            with CaptureQueriesContext(connection) as capturadas:
+                respuesta = cliente.get('/api/autores/')
+            self.assertEqual(respuesta.status_code, 200)
+            return len(capturadas)
+
+        self.assertEqual(consultas_listado(2), consultas_listado(20))
+
+
+class MarcarAtrasadosTests(TestCase):
+    """Barrido por lotes de préstamos vencidos"""
+
+    def test_marca_solo_activos_vencidos(self):
+        usuario = User.objects.create_user('lector', password='clave123')
+        libro = crear_libro(stock=10)
+        vencidos = [
+            Prestamo.objects.create(libro=libro, usuario=usuario,
+                                    fecha_devolucion_esperada='2020-01-0%d' % dia)
+            for dia in range(1, 6)
+        ]
+        vigente = Prestamo.objects.create(
+            libro=libro, usuario=usuario, fecha_devolucion_esperada='2999-01-01'
+        )
+        devuelto = Prestamo.objects.create(
+            libro=libro, usuario=usuario, fecha_devolucion_esperada='2020-01-01',
+            estado=Prestamo.DEVUELTO
+        )
+
+        salida = StringIO()
+        call_command('marcar_atrasados', lote=2, stdout=salida)
+
+        self.assertIn('Préstamos marcados como atrasados: 5', salida.getvalue())
+        self.assertEqual(
+            Prestamo.objects.filter(estado=Prestamo.ATRASADO).count(), len(vencidos)
+        )
+        vigente.refresh_from_db()
+        devuelto.refresh_from_db()
+        self.assertEqual(vigente.estado, Prestamo.ACTIVO)
+        self.assertEqual(devuelto.estado, Prestamo.DEVUELTO)
+        self.assertEqual(Prestamo.marcar_atrasados(), 0)
+
+
+class BusquedaTextoCompletoTests(TestCase):
+    """Índice de texto completo usado por REST y GraphQL"""
+
+    def setUp(self):
+        self.cien_anos = crear_libro(
+            descripcion='La historia de la familia Buendía en Macondo'
+        )
+        self.otro = crear_libro(
+            titulo='El amor en los tiempos del cólera',
+            isbn='9780307387264',
+            descripcion='Florentino Ariza espera más de cincuenta años'
+        )
+        self.client = APIClient()
+
+    def buscar(self, texto):
+        respuesta = self.client.get('/api/libros/', {'search': texto})
+        self.assertEqual(respuesta.status_code, 200)
+        datos = respuesta.json()
+        resultados = datos['results'] if isinstance(datos, dict) else datos
+        return [libro['id'] for libro in resultados]
+
+    def test_ignora_acentos_y_mayusculas(self):
+        self.assertEqual(self.buscar('colera'), [self.otro.id])
+        self.assertEqual(self.buscar('MACONDO buendia'), [self.cien_anos.id])
+
+    def test_prefijos_e_isbn(self):
+        self.assertEqual(self.buscar('Flor'), [self.otro.id])
+        self.assertEqual(self.buscar('978-0307-387'), [self.otro.id])
+
+    def test_ordena_por_relevancia(self):
+        # "años" aparece en el título de uno y solo en la descripción del otro
+        self.assertEqual(self.buscar('años'), [self.cien_anos.id, self.otro.id])
+
+    def test_indice_sigue_las_escrituras(self):
+        self.otro.titulo = 'Crónica de una muerte anunciada'
+        self.otro.save()
+        Libro.objects.filter(pk=self.cien_anos.pk).update(descripcion='Realismo mágico')
+        self.assertEqual(self.buscar('cronica'), [self.otro.id])
+        self.assertEqual(self.buscar('macondo'), [])
+        self.assertEqual(self.buscar('magico'), [self.cien_anos.id])
+
+    def test_graphql_usa_el_mismo_motor(self):
+        resultado = schema.execute('{ buscarLibros(titulo: "colera") { id } }')
+        self.assertIsNone(resultado.errors)
+        self.assertEqual(
+            [int(libro['id']) for libro in resultado.data['buscarLibros']],
+            [self.otro.id]
+        )
+
+
+class AutocompletadoTests(TestCase):
+    """Índice de prefijos en memoria de /api/libros/autocompletar/"""
+
+    def setUp(self):
+        self.autor = Autor.objects.create(nombre='Julio', apellido='Cortázar')
+        self.rayuela = crear_libro(titulo='Rayuela', isbn='9788437604572',
+                                   autor=self.autor)
+        self.cien_anos = crear_libro()
+        autocompletado.cargar()
+        self.client = APIClient()
+
+    def sugerencias(self, texto):
+        respuesta = self.client.get('/api/libros/autocompletar/', {'q': texto})
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta.json()
+
+    def test_prefijos_de_titulo_autor_e_isbn(self):
+        esperado = [{'id': self.rayuela.id, 'label': 'Rayuela - Julio Cortázar'}]
+        self.assertEqual(self.sugerencias('ray'), esperado)
+        self.assertEqual(self.sugerencias('CORTAZ'), esperado)
+        self.assertEqual(self.sugerencias('julio cor'), esperado)
+        self.assertEqual(self.sugerencias('97884376'), esperado)
+        self.assertEqual(self.sugerencias('cien anos')[0]['id'], self.cien_anos.id)
+
+    def test_no_consulta_la_base_de_datos(self):
+        with self.assertNumQueries(0):
+            self.sugerencias('ra')
+
+    def test_senales_actualizan_el_indice(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rayuela.titulo = 'Historias de cronopios'
+            self.rayuela.save()
+            self.cien_anos.activo = False
+            self.cien_anos.save()
+        self.assertEqual(self.sugerencias('ray'), [])
+        self.assertEqual(self.sugerencias('historias')[0]['id'], self.rayuela.id)
+        self.assertEqual(self.sugerencias('cien'), [])
+
+    def test_sincroniza_cambios_de_otros_procesos(self):
+        Libro.objects.filter(pk=self.rayuela.pk).update(
+            titulo='Bestiario', fecha_actualizacion=timezone.now()
+        )
+        autocompletado.sincronizar()
+        self.assertEqual(self.sugerencias('bestia')[0]['id'], self.rayuela.id)
+
+    def test_sincroniza_transacciones_confirmadas_tarde(self):
+        # Guardado antes de la marca de la última sincronización
+        Libro.objects.filter(pk=self.rayuela.pk).update(
+            titulo='Bestiario', fecha_actualizacion=timezone.now() - timedelta(seconds=10)
+        )
+        autocompletado.sincronizar()
+        self.assertEqual(self.sugerencias('bestia')[0]['id'], self.rayuela.id)
+
+    def test_recarga_completa_quita_borrados_de_otros_procesos(self):
+        # Sin ejecutar los on_commit: el índice no se entera por las señales
+        rayuela_id = self.rayuela.id
+        self.rayuela.delete()
+        self.assertEqual(self.sugerencias('ray')[0]['id'], rayuela_id)
+        with override_settings(AUTOCOMPLETADO_RECARGA_SEGUNDOS=0):
+            self.assertEqual(self.sugerencias('ray'), [])
+
+
+class KeysetPaginationTests(TestCase):
+    """Paginación por cursor de libros y préstamos"""
+
+    def setUp(self):
+        autor = Autor.objects.create(nombre='Jorge Luis', apellido='Borges')
+        self.libros = [
+            crear_libro(titulo=f'Ficciones {i}', isbn=f'97800000{i:05d}', autor=autor)
+            for i in range(7)
+        ]
+        # Dos libros con la misma fecha: el id desempata
+        Libro.objects.filter(pk__in=[self.libros[2].pk, self.libros[3].pk]).update(
+            fecha_creacion=self.libros[2].fecha_creacion
+        )
+        self.client = APIClient()
+
+    def recorrer(self, url):
+        ids = []
+        while url:
+            with CaptureQueriesContext(connection) as capturadas:
+                datos = self.client.get(url).json()
+            self.assertFalse(any('COUNT(' in q['sql'] for q in capturadas))
+            ids.extend(libro['id'] for libro in datos['results'])
+            url = datos['next']
+        return ids
+
+    def test_recorre_todo_sin_repetir_ni_contar(self):
+        esperado = list(
+            Libro.objects.order_by('-fecha_creacion', '-pk').values_list('pk', flat=True)
+        )
+        self.assertEqual(self.recorrer('/api/libros/?page_size=2'), esperado)
+
+    def test_respeta_ordering_con_clave(self):
+        esperado = list(Libro.objects.order_by('titulo', 'pk').values_list('pk', flat=True))
+        self.assertEqual(self.recorrer('/api/libros/?ordering=titulo&page_size=3'), esperado)
+
+    def test_enlace_previous_vuelve_a_la_pagina_anterior(self):
+        primera = self.client.get('/api/libros/?page_size=3').json()
+        self.assertIsNone(primera['previous'])
+        segunda = self.client.get(primera['next']).json()
+        anterior = self.client.get(segunda['previous']).json()
+        self.assertEqual(anterior['results'], primera['results'])
+
+    def test_orden_sin_clave_usa_paginacion_numerada(self):
+        datos = self.client.get('/api/libros/?ordering=fecha_publicacion&page_size=5').json()
+        self.assertEqual(datos['count'], len(self.libros))
+        self.assertEqual(len(datos['results']), 5)
+
+    def test_cursor_invalido(self):
+        respuesta = self.client.get('/api/libros/?cursor=basura')
+        self.assertEqual(respuesta.status_code, 404)
+
+
+class ImportacionMasivaTests(TestCase):
+    """POST /api/libros/importar/ con upsert por ISBN"""
+
+    def setUp(self):
+        self.usuario = User.objects.create_user('bibliotecario', password='clave123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.usuario)
+
+    def fila(self, isbn, titulo='Pedro Páramo', **extra):
+        datos = {
+            'isbn': isbn, 'titulo': titulo, 'precio': '199.00',
+            'autor': {'nombre': 'Juan', 'apellido': 'Rulfo'},
+            'categoria': 'Novela',
+        }
+        datos.update(extra)
+        return datos
+
+    def test_crea_actualiza_y_reporta_por_fila(self):
+        existente = crear_libro(isbn='9786071603289', stock=3)
+        filas = [
+            self.fila('9786071603289', titulo='El llano en llamas', stock=8),
+            self.fila('9788437604183'),
+            self.fila('123', titulo=''),
+            self.fila('9788437604183', titulo='Pedro Páramo (2a ed.)'),
+        ]
+        respuesta = self.client.post('/api/libros/importar/', filas, format='json')
+
+        self.assertEqual(respuesta.status_code, 200)
+        datos = respuesta.json()
+        self.assertEqual(datos['resumen'],
+                         {'creado': 1, 'actualizado': 1, 'duplicado': 1, 'error': 1})
+        self.assertEqual([r['resultado'] for r in datos['resultados']],
+                         ['actualizado', 'duplicado', 'error', 'creado'])
+        self.assertIn('isbn', datos['resultados'][2]['errores'])
+
+        existente.refresh_from_db()
+        self.assertEqual((existente.titulo, existente.stock), ('El llano en llamas', 8))
+        nuevo = Libro.objects.get(isbn='9788437604183')
+        self.assertEqual(nuevo.titulo, 'Pedro Páramo (2a ed.)')
+        self.assertEqual(nuevo.creado_por, self.usuario)
+        self.assertEqual(nuevo.categoria.nombre, 'Novela')
+        rulfo = Autor.objects.get(apellido='Rulfo')
+        self.assertEqual(existente.autor, rulfo)
+        self.assertEqual(rulfo.total_libros, 2)
+
+    def test_acepta_ndjson(self):
+        cuerpo = '\n'.join(json.dumps(self.fila(f'978843760{i:04d}')) for i in range(3))
+        respuesta = self.client.post('/api/libros/importar/', cuerpo,
+                                     content_type='application/x-ndjson')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['resumen']['creado'], 3)
+
+    def test_autores_que_solo_difieren_en_acentos(self):
+        con_acento = Autor.objects.create(nombre='José', apellido='García')
+        sin_acento = Autor.objects.create(nombre='Jose', apellido='García')
+        filas = [
+            self.fila('9786071603289', autor={'nombre': 'José', 'apellido': 'García'}),
+            self.fila('9788437604183', autor={'nombre': 'Jose', 'apellido': 'García'}),
+            self.fila('9788437604572', autor={'nombre': 'JOSE', 'apellido': 'García'}),
+        ]
+        datos = self.client.post('/api/libros/importar/', filas, format='json').json()
+        self.assertEqual([r['resultado'] for r in datos['resultados']],
+                         ['creado', 'creado', 'error'])
+        self.assertIn('autor', datos['resultados'][2]['errores'])
+        self.assertEqual(Libro.objects.get(isbn='9786071603289').autor, con_acento)
+        self.assertEqual(Libro.objects.get(isbn='9788437604183').autor, sin_acento)
+        self.assertFalse(Libro.objects.filter(isbn='9788437604572').exists())
+        self.assertEqual(Autor.objects.filter(apellido='García').count(), 2)
+
+    def test_publica_los_cambios_importados(self):
+        ensayo = Categoria.objects.create(nombre='Ensayo')
+        existente = crear_libro(isbn='9786071603289', stock=3, categoria=ensayo)
+        filas = [self.fila('9786071603289', stock=0), self.fila('9788437604183')]
+        with mock.patch('libros.importacion.registrar') as registrar:
+            self.client.post('/api/libros/importar/', filas, format='json')
+        publicados = list(registrar.call_args.args[0])
+        nuevo = Libro.objects.get(isbn='9788437604183')
+        self.assertEqual(publicados, [
+            dict(instantanea(Libro.objects.get(pk=existente.pk)), categoria_anterior_id=ensayo.pk),
+            instantanea(nuevo),
+        ])
+        self.assertFalse(publicados[0]['disponible'])
+
+    def test_consultas_no_crecen_con_la_cantidad_de_filas(self):
+        def consultas(inicio, cantidad):
+            filas = [
+                self.fila(f'978843761{i:04d}',
+                          autor={'nombre': f'Autor{i}', 'apellido': 'Prueba'},
+                          categoria=f'Categoria{i}')
+                for i in range(inicio, inicio + cantidad)
+            ]
+            with CaptureQueriesContext(connection) as capturadas:
+                self.client.post('/api/libros/importar/', filas, format='json')
+            return len(capturadas)
+
+        # Ambas cargas caben en un lote de INSERT aun con el límite de SQLite
+        self.assertEqual(consultas(0, 5), consultas(100, 40))
+
+
+class ExportacionTests(TestCase):
+    """Exportación en streaming de libros y préstamos"""
+
+    def setUp(self):
+        self.usuario = User.objects.create_user('lector', password='clave123')
+        self.libros = [
+            crear_libro(isbn=f'97800000{i:05d}', titulo=f'Tomo {i}',
+                        estado=Libro.DISPONIBLE if i % 2 else Libro.MANTENIMIENTO)
+            for i in range(5)
+        ]
+        Prestamo.objects.create(libro=self.libros[1], usuario=self.usuario,
+                                fecha_devolucion_esperada='2030-01-01')
+        self.client = APIClient()
+
+    def contenido(self, url):
+        respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertTrue(respuesta.streaming)
+        return b''.join(respuesta.streaming_content).decode()
+
+    def test_csv_respeta_los_filtros(self):
+        filas = list(csv.DictReader(
+            self.contenido('/api/libros/exportar/?formato=csv&estado=disponible').splitlines()
+        ))
+        self.assertEqual([int(fila['id']) for fila in filas],
+                         [self.libros[1].id, self.libros[3].id])
+        self.assertEqual(filas[0]['autor_nombre'], 'Gabriel García Márquez')
+        self.assertEqual(filas[0]['precio'], '350.00')
+
+    def test_ndjson_de_prestamos(self):
+        lineas = self.contenido('/api/prestamos/exportar/?formato=ndjson').splitlines()
+        self.assertEqual(len(lineas), 1)
+        prestamo = json.loads(lineas[0])
+        self.assertEqual(prestamo['libro_titulo'], 'Tomo 1')
+        self.assertEqual(prestamo['usuario_nombre'], 'lector')
+
+    def test_lee_en_bloques_por_pk(self):
+        with mock.patch('libros.exportacion.LOTE', 2):
+            with CaptureQueriesContext(connection) as capturadas:
+                contenido = self.contenido('/api/libros/exportar/?formato=ndjson')
+        self.assertEqual(len(contenido.splitlines()), len(self.libros))
+        self.assertEqual(
+            sum('FROM "libros_libro"' in q['sql'] for q in capturadas), 3
+        )
+
+    def test_comando_escribe_archivo(self):
+        with tempfile.TemporaryDirectory() as directorio:
+            salida = os.path.join(directorio, 'libros.csv')
+            call_command('exportar', 'libros', salida,
+                         '--filtro', 'estado=mantenimiento', stdout=StringIO())
+            with open(salida, encoding='utf-8') as archivo:
+                filas = list(csv.DictReader(archivo))
+        self.assertEqual(len(filas), 3)
+
+
+class CamposParcialesTests(TestCase):
+    """?fields= / ?omit= recortan la respuesta y las columnas leídas"""
+
+    def setUp(self):
+        categoria = Categoria.objects.create(nombre='Novela')
+        self.libros = [
+            crear_libro(isbn=f'97800000{i:05d}', titulo=f'Tomo {i}',
+                        categoria=categoria, descripcion='x' * 500, stock=i)
+            for i in range(3)
+        ]
+        self.client = APIClient()
+
+    def consultar(self, url):
+        with CaptureQueriesContext(connection) as capturadas:
+            respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta.json(), [q['sql'] for q in capturadas]
+
+    def test_fields_recorta_campos_y_columnas(self):
+        datos, consultas = self.consultar(
+            '/api/libros/?fields=id,titulo,stock,esta_disponible'
+        )
+        self.assertEqual(len(consultas), 1)
+        self.assertNotIn('descripcion', consultas[0])
+        self.assertNotIn('JOIN', consultas[0])
+        self.assertEqual(
+            datos['results'][0],
+            {'id': self.libros[2].id, 'titulo': 'Tomo 2', 'stock': 2,
+             'esta_disponible': True}
+        )
+
+    def test_select_related_solo_para_relaciones_pedidas(self):
+        datos, consultas = self.consultar('/api/libros/?fields=id,autor_nombre')
+        self.assertEqual(len(consultas), 1)
+        self.assertIn('libros_autor', consultas[0])
+        self.assertNotIn('libros_categoria', consultas[0])
+        self.assertEqual(datos['results'][0]['autor_nombre'], 'Gabriel García Márquez')
+
+    def test_omit_difiere_columnas(self):
+        datos, consultas = self.consultar('/api/libros/?omit=descripcion,imagen_portada')
+        self.assertNotIn('descripcion', datos['results'][0])
+        self.assertIn('categoria_nombre', datos['results'][0])
+        self.assertEqual(len(consultas), 1)
+        self.assertNotIn('"descripcion"', consultas[0])
+
+    def test_cursor_y_detalle_con_campos(self):
+        datos, _ = self.consultar('/api/libros/?fields=id&page_size=2')
+        siguiente, consultas = self.consultar(datos['next'])
+        self.assertEqual(len(consultas), 1)
+        self.assertEqual(siguiente['results'], [{'id': self.libros[0].id}])
+        detalle, _ = self.consultar(f'/api/libros/{self.libros[0].id}/?fields=titulo')
+        self.assertEqual(detalle, {'titulo': 'Tomo 0'})
+
+    def test_prestamos_con_campos(self):
+        usuario = User.objects.create_user('lector', password='clave123')
+        Prestamo.objects.create(libro=self.libros[1], usuario=usuario,
+                                fecha_devolucion_esperada='2000-01-01')
+        datos, consultas = self.consultar(
+            '/api/prestamos/?fields=id,libro_titulo,esta_atrasado'
+        )
+        self.assertEqual(len(consultas), 1)
+        self.assertNotIn('auth_user', consultas[0])
+        self.assertEqual(datos['results'][0]['libro_titulo'], 'Tomo 1')
+        self.assertTrue(datos['results'][0]['esta_atrasado'])
+
+    def test_campo_desconocido(self):
+        respuesta = self.client.get('/api/libros/?fields=id,precio_final')
+        self.assertEqual(respuesta.status_code, 400)
+        self.assertIn('precio_final', respuesta.json()['fields'])
+
+    def test_libros_de_autor_con_campos_del_libro(self):
+        url = f'/api/autores/{self.libros[0].autor_id}/libros/'
+        datos, _ = self.consultar(f'{url}?fields=titulo')
+        self.assertEqual(sorted(datos, key=lambda libro: libro['titulo']),
+                         [{'titulo': f'Tomo {i}'} for i in range(3)])
+        respuesta = self.client.get(f'{url}?fields=nombre')
+        self.assertEqual(respuesta.status_code, 400)
+        self.assertIn('nombre', respuesta.json()['fields'])
+
+
+class LecturaRapidaTests(TestCase):
+    """Los listados desde .values() responden lo mismo que el serializer"""
+
+    def setUp(self):
+        categoria = Categoria.objects.create(nombre='Novela')
+        self.libros = [
+            crear_libro(isbn=f'97800000{i:05d}', titulo=f'Crónica {i}',
+                        categoria=categoria if i % 2 else None,
+                        fecha_publicacion='1981-01-01' if i % 3 else None,
+                        precio=Decimal('199.9'), valoracion=Decimal('4.5'),
+                        stock=i % 3, estado=Libro.DISPONIBLE)
+            for i in range(6)
+        ]
+        usuario = User.objects.create_user('lector', password='clave123')
+        Prestamo.objects.create(libro=self.libros[1], usuario=usuario,
+                                fecha_devolucion_esperada='2000-01-01')
+        devuelto = Prestamo.objects.create(libro=self.libros[2], usuario=usuario,
+                                           fecha_devolucion_esperada='2000-01-01')
+        Prestamo.objects.filter(pk=devuelto.pk).update(
+            estado=Prestamo.DEVUELTO, fecha_devolucion_real=timezone.now()
+        )
+        self.client = APIClient()
+
+    def test_misma_salida_que_el_serializer(self):
+        urls = [
+            '/api/libros/',
+            '/api/libros/?page_size=4',
+            '/api/libros/?ordering=titulo&page_size=4',
+            '/api/libros/?search=cronica',
+            '/api/libros/?fields=id,categoria_nombre,esta_disponible,precio',
+            '/api/libros/disponibles/',
+            '/api/prestamos/',
+            '/api/prestamos/?omit=notas',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                rapida = self.client.get(url)
+                obtener_cache().clear()
+                with mock.patch('libros.api_views.LecturaRapida.soporta',
+                                return_value=False):
+                    original = self.client.get(url)
+                self.assertEqual(rapida.status_code, 200)
+                self.assertEqual(rapida.content, original.content)
+
+    def test_cursor_con_filas_de_values(self):
+        datos = self.client.get('/api/libros/?page_size=4').json()
+        siguiente = self.client.get(datos['next']).json()
+        self.assertEqual(
+            [l['id'] for l in datos['results'] + siguiente['results']],
+            [l.id for l in reversed(self.libros)]
+        )
+
+    def test_una_consulta_por_pagina(self):
+        with CaptureQueriesContext(connection) as capturadas:
+            self.client.get('/api/prestamos/')
+        self.assertEqual(len(capturadas), 1)
+
+
+class CacheRespuestasTests(TestCase):
+    """Cache de lecturas del catálogo con invalidación por versiones"""
+
+    def setUp(self):
+        obtener_cache().clear()
+        self.categoria = Categoria.objects.create(nombre='Novela')
+        self.libro = crear_libro(categoria=self.categoria)
+        self.client = APIClient()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as capturadas:
+            respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta, len(capturadas)
+
+    def test_segunda_lectura_no_consulta_la_base(self):
+        primera, consultas = self.get('/api/libros/')
+        self.assertEqual(primera['X-Cache'], 'MISS')
+        self.assertGreater(consultas, 0)
+        segunda, consultas = self.get('/api/libros/')
+        self.assertEqual(segunda['X-Cache'], 'HIT')
+        self.assertEqual(consultas, 0)
+        self.assertEqual(segunda.json(), primera.json())
+        self.assertEqual(
+            estadisticas(['libro-list'])['libro-list'],
+            {'aciertos': 1, 'fallos': 1, 'esperas': 0}
+        )
+
+    def test_parametros_normalizados(self):
+        self.get('/api/libros/?estado=disponible&ordering=titulo')
+        respuesta, _ = self.get('/api/libros/?ordering=titulo&estado=disponible')
+        self.assertEqual(respuesta['X-Cache'], 'HIT')
+        respuesta, _ = self.get('/api/libros/?ordering=-titulo&estado=disponible')
+        self.assertEqual(respuesta['X-Cache'], 'MISS')
+
+    def test_escrituras_invalidan(self):
+        urls = ['/api/libros/', '/api/libros/disponibles/', '/api/categorias/',
+                f'/api/autores/{self.libro.autor_id}/libros/']
+        for url in urls:
+            self.get(url)
+
+        self.libro.actualizar_stock(4)
+        respuesta, _ = self.get('/api/libros/disponibles/')
+        self.assertEqual(respuesta['X-Cache'], 'MISS')
+        self.assertEqual(respuesta.json()[0]['stock'], 5)
+        respuesta, _ = self.get('/api/categorias/')
+        self.assertEqual(respuesta['X-Cache'], 'HIT')
+
+        self.categoria.nombre = 'Cuento'
+        self.categoria.save()
+        for url in urls:
+            with self.subTest(url=url):
+                respuesta, _ = self.get(url)
+                self.assertEqual(respuesta['X-Cache'], 'MISS')
+
+    def test_errores_no_se_guardan(self):
+        self.client.get('/api/libros/?fields=inexistente')
+        respuesta = self.client.get('/api/libros/?fields=inexistente')
+        self.assertEqual(respuesta.status_code, 400)
+        self.assertEqual(estadisticas(['libro-list'])['libro-list']['aciertos'], 0)
+
+
+class CacheEstampidaTests(TransactionTestCase):
+    """Una clave fría se calcula una sola vez aunque lleguen muchas lecturas"""
+
+    def test_un_solo_calculo(self):
+        obtener_cache().clear()
+        calculos = []
+        barrera = threading.Barrier(10)
+
+        def calcular():
+            calculos.append(1)
+            threading.Event().wait(0.2)
+            return {'datos': 1}, True
+
+        def leer():
+            barrera.wait()
+            obtener_o_calcular('prueba', 'respuestas:prueba:fria', calcular)
+
+        hilos = [threading.Thread(target=leer) for _ in range(10)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        self.assertEqual(len(calculos), 1)
+        self.assertEqual(estadisticas(['prueba'])['prueba']['esperas'], 9)
+
+
+class GetCondicionalTests(TestCase):
+    """ETag / Last-Modified con 304 sin serializar e If-Match en escrituras"""
+
+    def setUp(self):
+        obtener_cache().clear()
+        self.libro = crear_libro(stock=3)
+        self.usuario = User.objects.create_user('bibliotecario', password='clave123')
+        self.client = APIClient()
+
+    def test_listado_304_sin_serializar(self):
+        primera = self.client.get('/api/libros/')
+        etag = primera['ETag']
+        self.assertIn('Last-Modified', primera)
+        # Otra clave de cache con las mismas filas y sin enlaces: mismo ETag
+        with mock.patch('libros.api_views.LecturaRapida.serializar') as serializar, \
+                CaptureQueriesContext(connection) as capturadas:
+            respuesta = self.client.get('/api/libros/?estado=disponible',
+                                        HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 304)
+        self.assertEqual(respuesta['ETag'], etag)
+        serializar.assert_not_called()
+        self.assertEqual(len(capturadas), 1)
+        # Desde la cache también se responde 304
+        respuesta = self.client.get('/api/libros/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((respuesta.status_code, respuesta['X-Cache']), (304, 'HIT'))
+
+    def test_cambios_invalidan_el_etag(self):
+        etag = self.client.get('/api/libros/')['ETag']
+        self.libro.actualizar_stock(1)
+        respuesta = self.client.get('/api/libros/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertNotEqual(respuesta['ETag'], etag)
+
+        # El nombre del autor no cambia la fecha del libro, pero sí el ETag
+        etag = respuesta['ETag']
+        autor = self.libro.autor
+        autor.nombre = 'Gabo'
+        autor.save()
+        respuesta = self.client.get('/api/libros/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['results'][0]['autor_nombre'],
+                         'Gabo García Márquez')
+
+    def test_detalle_if_modified_since(self):
+        url = f'/api/libros/{self.libro.pk}/'
+        primera = self.client.get(url)
+        respuesta = self.client.get(url, HTTP_IF_MODIFIED_SINCE=primera['Last-Modified'])
+        self.assertEqual(respuesta.status_code, 304)
+        respuesta = self.client.get(url, HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(respuesta.status_code, 304)
+
+    def test_prestamos(self):
+        prestamo = Prestamo.objects.create(libro=self.libro, usuario=self.usuario,
+                                           fecha_devolucion_esperada='2030-01-01')
+        etag = self.client.get('/api/prestamos/')['ETag']
+        self.assertEqual(
+            self.client.get('/api/prestamos/', HTTP_IF_NONE_MATCH=etag).status_code, 304
+        )
+        self.client.post(f'/api/prestamos/{prestamo.pk}/devolver/')
+        self.assertEqual(
+            self.client.get('/api/prestamos/', HTTP_IF_NONE_MATCH=etag).status_code, 200
+        )
+
+    def test_if_match_en_actualizar_stock(self):
+        url = f'/api/libros/{self.libro.pk}/'
+        etag = self.client.get(url)['ETag']
+        self.client.force_authenticate(self.usuario)
+        respuesta = self.client.post(f'{url}actualizar_stock/', {'cantidad': 2},
+                                     format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['stock'], 5)
+
+        # El mismo ETag ya no vale: la otra edición no se pisa
+        respuesta = self.client.post(f'{url}actualizar_stock/', {'cantidad': -5},
+                                     format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 412)
+        self.libro.refresh_from_db()
+        self.assertEqual(self.libro.stock, 5)
+
+    def test_if_match_solo_depende_de_la_fila(self):
+        url = f'/api/libros/{self.libro.pk}/'
+        etag = self.client.get(url)['ETag']
+        # Escrituras en otras filas suben las versiones de cache
+        Autor.objects.create(nombre='Otro', apellido='Autor')
+        crear_libro(isbn='9780000000099')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.client.force_authenticate(self.usuario)
+        respuesta = self.client.post(f'{url}actualizar_stock/', {'cantidad': 1},
+                                     format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+
+    def test_devolver_con_if_match_y_otros_prestamos(self):
+        prestamo = Prestamo.objects.create(libro=self.libro, usuario=self.usuario,
+                                           fecha_devolucion_esperada='2030-01-01')
+        etag = self.client.get(f'/api/prestamos/{prestamo.pk}/')['ETag']
+        self.libro.actualizar_stock(-1)
+        respuesta = self.client.post(f'/api/prestamos/{prestamo.pk}/devolver/',
+                                     HTTP_IF_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+
+    def test_prestamos_cambian_con_la_hora(self):
+        hoy = timezone.localdate()
+        prestamo = Prestamo.objects.create(libro=self.libro, usuario=self.usuario,
+                                           fecha_devolucion_esperada=hoy + timedelta(days=2))
+        for url in ['/api/prestamos/', f'/api/prestamos/{prestamo.pk}/']:
+            with self.subTest(url=url):
+                primera = self.client.get(url)
+                # Cinco días después la fila es la misma, pero no la respuesta
+                with mock.patch('django.utils.timezone.now',
+                                return_value=timezone.now() + timedelta(days=5)):
+                    respuesta = self.client.get(url, HTTP_IF_NONE_MATCH=primera['ETag'])
+                    self.assertEqual(respuesta.status_code, 200)
+                    datos = respuesta.json()
+                    datos = datos['results'][0] if 'results' in datos else datos
+                    self.assertEqual((datos['dias_prestamo'], datos['esta_atrasado']), (5, True))
+                    respuesta = self.client.get(
+                        url, HTTP_IF_MODIFIED_SINCE=primera['Last-Modified']
+                    )
+                    self.assertEqual(respuesta.status_code, 200)
+                    segunda = respuesta['ETag']
+                    self.assertEqual(
+                        self.client.get(url, HTTP_IF_NONE_MATCH=segunda).status_code, 304
+                    )
+
+    def test_nombre_de_usuario_cambia_el_etag_de_prestamos(self):
+        Prestamo.objects.create(libro=self.libro, usuario=self.usuario,
+                                fecha_devolucion_esperada='2030-01-01')
+        etag = self.client.get('/api/prestamos/')['ETag']
+        self.usuario.username = 'bibliotecaria'
+        self.usuario.save()
+        respuesta = self.client.get('/api/prestamos/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['results'][0]['usuario_nombre'], 'bibliotecaria')
+
+    def test_devolver_con_if_match_no_pisa_escrituras_concurrentes(self):
+        prestamo = Prestamo.objects.create(libro=self.libro, usuario=self.usuario,
+                                           fecha_devolucion_esperada='2030-01-01')
+        etag = self.client.get(f'/api/prestamos/{prestamo.pk}/')['ETag']
+        version_leida = PrestamoViewSet.version_leida
+
+        def editar_despues(vista, instancia):
+            # Otra escritura entre la comprobación de If-Match y el UPDATE
+            Prestamo.objects.filter(pk=instancia.pk).update(
+                notas='renovado', fecha_actualizacion=timezone.now() + timedelta(seconds=1)
+            )
+            return version_leida(vista, instancia)
+        with mock.patch.object(PrestamoViewSet, 'version_leida', autospec=True,
+                               side_effect=editar_despues):
+            respuesta = self.client.post(f'/api/prestamos/{prestamo.pk}/devolver/',
+                                         HTTP_IF_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 412)
+        prestamo.refresh_from_db()
+        self.assertEqual((prestamo.estado, prestamo.notas), (Prestamo.ACTIVO, 'renovado'))
+
+    def test_actualizar_stock_de_libro_borrado(self):
+        actualizar_stock = Libro.actualizar_stock
+
+        def borrar_antes(libro, *args, **kwargs):
+            # Otro proceso borra el libro entre la lectura y el UPDATE
+            Libro.objects.filter(pk=libro.pk).delete()
+            return actualizar_stock(libro, *args, **kwargs)
+        self.client.force_authenticate(self.usuario)
+        with mock.patch.object(Libro, 'actualizar_stock', autospec=True, side_effect=borrar_antes):
+            respuesta = self.client.post(f'/api/libros/{self.libro.pk}/actualizar_stock/',
+                                         {'cantidad': 1}, format='json')
+        self.assertEqual(respuesta.status_code, 404)
+
+    def test_version_condiciona_el_update(self):
+        leida = self.libro.fecha_actualizacion
+        Libro.objects.get(pk=self.libro.pk).actualizar_stock(1)
+        self.assertFalse(self.libro.actualizar_stock(-3, version=leida))
+        self.libro.refresh_from_db()
+        self.assertEqual(self.libro.stock, 4)
+
+
+class CodecsTests(TestCase):
+    """msgpack/CBOR/JSON en la API REST, GraphQL y los WebSockets"""
+
+    def setUp(self):
+        obtener_cache().clear()
+        self.libro = crear_libro()
+        self.client = APIClient()
+
+    def test_negociacion_rest(self):
+        esperado = self.client.get('/api/libros/').json()
+        for nombre, codec in CODECS.items():
+            with self.subTest(codec=nombre):
+                respuesta = self.client.get('/api/libros/', HTTP_ACCEPT=codec.media_type)
+                self.assertEqual(respuesta['Content-Type'].split(';')[0], codec.media_type)
+                self.assertEqual(codec.decodificar(respuesta.content), esperado)
+
+    def test_cuerpo_msgpack(self):
+        self.client.force_authenticate(User.objects.create_user('admin', password='x'))
+        codec = CODECS['msgpack']
+        respuesta = self.client.post(
+            '/api/categorias/', codec.codificar({'nombre': 'Poesía'}),
+            content_type=codec.media_type, HTTP_ACCEPT=codec.media_type
+        )
+        self.assertEqual(respuesta.status_code, 201)
+        self.assertEqual(codec.decodificar(respuesta.content)['nombre'], 'Poesía')
+
+    def test_graphql(self):
+        vista = GraphQLCodecView.as_view(schema=schema)
+        consulta = {'query': '{ allLibros { titulo } }'}
+        for nombre, codec in CODECS.items():
+            with self.subTest(codec=nombre):
+                peticion = RequestFactory().post(
+                    '/graphql', codec.codificar(consulta),
+                    content_type=codec.media_type, HTTP_ACCEPT=codec.media_type
+                )
+                respuesta = vista(peticion)
+                self.assertEqual(respuesta.status_code, 200)
+                self.assertEqual(respuesta['Content-Type'], codec.media_type)
+                self.assertEqual(
+                    codec.decodificar(respuesta.content),
+                    {'data': {'allLibros': [{'titulo': self.libro.titulo}]}}
+                )
+
+    async def conectar(self, consumer, subprotocolos=(), **kwargs):
+        comunicador = ApplicationCommunicator(consumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/', 'headers': [], 'query_string': b'',
+            'subprotocols': list(subprotocolos), 'url_route': {'kwargs': kwargs},
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        aceptado = await comunicador.receive_output()
+        self.assertEqual(aceptado['type'], 'websocket.accept')
+        return comunicador, aceptado.get('subprotocol')
+
+    async def test_subprotocolo_websocket(self):
+        cbor = CODECS['cbor']
+        comunicador, subprotocolo = await self.conectar(
+            ChatConsumer, ['cbor', 'json'], room_name='sala'
+        )
+        self.assertEqual(subprotocolo, 'cbor')
+        for tipo in ('historial', 'system'):
+            frame = await comunicador.receive_output()
+            self.assertEqual(cbor.decodificar(frame['bytes'])['type'], tipo)
+
+        await comunicador.send_input({
+            'type': 'websocket.receive', 'bytes': cbor.codificar({'message': 'hola'})
+        })
+        mensaje = cbor.decodificar((await comunicador.receive_output())['bytes'])
+        self.assertEqual((mensaje['message'], mensaje['username']), ('hola', 'Anónimo'))
+        await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await comunicador.wait()
+
+    async def test_json_por_defecto(self):
+        comunicador, subprotocolo = await self.conectar(NotificacionesConsumer)
+        self.assertIsNone(subprotocolo)
+        frame = await comunicador.receive_output()
+        self.assertEqual(json.loads(frame['text'])['type'], 'connection')
+        await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await comunicador.wait()
+
+
+class CargadoresGraphQLTests(TestCase):
+    """Las relaciones de GraphQL cuestan lo mismo con 2 o con 20 libros"""
+
+    CONSULTA = '''{
+        allLibros {
+            titulo
+            autor { nombre libros { titulo categoria { nombre } } }
+            categoria { nombre libros { isbn } }
+        }
+    }'''
+
+    def crear_catalogo(self, cantidad):
+        Libro.objects.all().delete()
+        Autor.objects.all().delete()
+        Categoria.objects.all().delete()
+        for i in range(cantidad):
+            autor = Autor.objects.create(nombre=f'Autor {i}', apellido='X')
+            categoria = Categoria.objects.create(nombre=f'Categoría {i}')
+            crear_libro(titulo=f'Libro {i}', isbn=f'978{i:010d}', autor=autor,
+                        categoria=categoria if i % 3 else None)
+
+    def ejecutar(self):
+        with CaptureQueriesContext(connection) as consultas:
+            resultado = schema.execute(self.CONSULTA, context_value=RequestFactory().get('/'))
+        self.assertIsNone(resultado.errors)
+        return resultado.data['allLibros'], len(consultas)
+
+    def test_consultas_constantes(self):
+        self.crear_catalogo(2)
+        _, pocas = self.ejecutar()
+        self.crear_catalogo(20)
+        libros, muchas = self.ejecutar()
+        # libros con autor y categoría (JOIN), libros por autor, por categoría
+        self.assertEqual(pocas, 3)
+        self.assertEqual(muchas, pocas)
+
+        self.assertEqual(len(libros), 20)
+        por_titulo = {libro['titulo']: libro for libro in libros}
+        self.assertIsNone(por_titulo['Libro 0']['categoria'])
+        libro = por_titulo['Libro 4']
+        self.assertEqual(libro['autor']['nombre'], 'Autor 4')
+        self.assertEqual(libro['autor']['libros'],
+                         [{'titulo': 'Libro 4', 'categoria': {'nombre': 'Categoría 4'}}])
+        self.assertEqual(libro['categoria']['libros'], [{'isbn': '9780000000004'}])
+
+    def test_cargadores_sin_precarga(self):
+        # Objetos que no pasaron por el optimizador (p. ej. de una mutación)
+        self.crear_catalogo(4)
+        libros = nivel(Libro.objects.all())
+        contexto = Cargadores()
+        with self.assertNumQueries(1):
+            autores = [contexto.autores.cargar_relacion(libro, 'autor') for libro in libros]
+        self.assertEqual([autor.pk for autor in autores], [libro.autor_id for libro in libros])
+        otro = Libro.objects.first()
+        with self.assertNumQueries(0):
+            contexto.autores.cargar_relacion(otro, 'autor')
+
+
+class OptimizadorGraphQLTests(TestCase):
+    """El SQL de GraphQL se recorta a la selección del cliente"""
+
+    def setUp(self):
+        self.categoria = Categoria.objects.create(nombre='Novela')
+        self.libro = crear_libro(categoria=self.categoria, descripcion='x' * 500)
+
+    def ejecutar(self, consulta, **variables):
+        with CaptureQueriesContext(connection) as capturadas:
+            resultado = schema.execute(
+                consulta, variable_values=variables, context_value=RequestFactory().get('/')
+            )
+        self.assertIsNone(resultado.errors)
+        return resultado.data, [q['sql'] for q in capturadas]
+
+    def test_seleccion_estrecha(self):
+        datos, sql = self.ejecutar('{ allLibros { titulo } }')
+        self.assertEqual(datos, {'allLibros': [{'titulo': self.libro.titulo}]})
+        self.assertEqual(len(sql), 1)
+        self.assertIn('"titulo"', sql[0])
+        self.assertNotIn('descripcion', sql[0])
+        self.assertNotIn('JOIN', sql[0])
+
+    def test_seleccion_profunda_con_fragmentos(self):
+        consulta = '''
+            query ($conLibros: Boolean!) {
+                libro(id: %d) {
+                    ...Basico
+                    autor { nombre libros @include(if: $conLibros) { isbn estaDisponible } }
+                    categoria { ... on CategoriaType { nombre } }
+                }
+            }
+            fragment Basico on LibroType { titulo }
+        ''' % self.libro.pk
+        datos, sql = self.ejecutar(consulta, conLibros=True)
+        self.assertEqual(datos['libro'], {
+            'titulo': self.libro.titulo,
+            'autor': {'nombre': 'Gabriel', 'libros': [{'isbn': self.libro.isbn, 'estaDisponible': True}]},
+            'categoria': {'nombre': 'Novela'},
+        })
+        # Libro con autor y categoría en un JOIN, y los libros del autor
+        self.assertEqual(len(sql), 2)
+        self.assertEqual(sql[0].count('JOIN'), 2)
+        self.assertNotIn('descripcion', ' '.join(sql))
+        self.assertIn('"stock"', sql[1])
+
+        datos, sql = self.ejecutar(consulta, conLibros=False)
+        self.assertNotIn('libros', datos['libro']['autor'])
+        self.assertEqual(len(sql), 1)
+
+
+class ConsultasGraphQLTests(TestCase):
+    """Límites de costo, cache de documentos y consultas persistidas"""
+
+    def setUp(self):
+        self.libro = crear_libro()
+        self.vista = GraphQLCodecView.as_view(schema=schema)
+        preparar_documento.cache_clear()
+
+    def consultar(self, **cuerpo):
+        peticion = RequestFactory().post(
+            '/graphql', json.dumps(cuerpo), content_type='application/json'
+        )
+        respuesta = self.vista(peticion)
+        return respuesta.status_code, json.loads(respuesta.content)
+
+    def assertRechazada(self, respuesta, codigo):
+        estado, datos = respuesta
+        self.assertEqual(estado, 400)
+        self.assertEqual(datos['errors'][0]['extensions']['code'], codigo)
+
+    def test_consulta_normal(self):
+        estado, datos = self.consultar(query='{ allLibros { titulo autor { nombre } } }')
+        self.assertEqual(estado, 200)
+        self.assertEqual(datos['data']['allLibros'][0]['autor']['nombre'], 'Gabriel')
+
+    def test_limites(self):
+        anidada = '{ allAutores { libros { autor { libros { titulo } } } } }'
+        self.assertRechazada(self.consultar(query=anidada), 'QUERY_TOO_EXPENSIVE')
+        with self.settings(GRAPHQL_MAX_PROFUNDIDAD=2, GRAPHQL_MAX_COSTO=10 ** 9):
+            estado, datos = self.consultar(query='{ allLibros { autor { nombre } } }')
+            self.assertEqual(estado, 400)
+            self.assertEqual(datos['errors'][0]['extensions']['costo'],
+                             {'profundidad': 3, 'ancho': 1, 'campos': 300})
+        # Muchos alias del mismo campo
+        alias = ' '.join(f'a{i}: titulo' for i in range(101))
+        self.assertRechazada(
+            self.consultar(query=f'{{ libro(id: {self.libro.pk}) {{ {alias} }} }}'),
+            'QUERY_TOO_EXPENSIVE'
+        )
+
+    def test_introspeccion_permitida(self):
+        estado, datos = self.consultar(query=get_introspection_query())
+        self.assertEqual(estado, 200)
+        self.assertIn('__schema', datos['data'])
+
+    def test_documento_se_parsea_una_vez(self):
+        consulta = '{ allLibros { titulo } }'
+        with mock.patch('libros.consultas_graphql.parse', wraps=parse) as parseo:
+            for _ in range(3):
+                self.assertEqual(self.consultar(query=consulta)[0], 200)
+        self.assertEqual(parseo.call_count, 1)
+        self.assertEqual(preparar_documento.cache_info().hits, 2)
+
+    def test_consulta_persistida(self):
+        consulta = '{ allLibros { isbn } }'
+        extensiones = {'persistedQuery': {'version': 1, 'sha256Hash': huella(consulta)}}
+        self.assertRechazada(self.consultar(extensions=extensiones), 'PERSISTED_QUERY_NOT_FOUND')
+
+        estado, _ = self.consultar(query=consulta, extensions=extensiones)
+        self.assertEqual(estado, 200)
+        estado, datos = self.consultar(extensions=extensiones)
+        self.assertEqual(estado, 200)
+        self.assertEqual(datos['data']['allLibros'], [{'isbn': self.libro.isbn}])
+
+        self.assertRechazada(
+            self.consultar(query='{ allAutores { id } }', extensions=extensiones),
+            'PERSISTED_QUERY_HASH_MISMATCH'
+        )
+
+    @override_settings(GRAPHQL_MAX_PROFUNDIDAD=2, GRAPHQL_PERSISTIDAS_SEGUNDOS=60)
+    def test_solo_se_persisten_consultas_aceptadas(self):
+        def extensiones(consulta):
+            return {'persistedQuery': {'version': 1, 'sha256Hash': huella(consulta)}}
+        invalida = '{ allLibros { noExiste } }'
+        costosa = '{ allLibros { autor { nombre } } }'
+        self.consultar(query=invalida, extensions=extensiones(invalida))
+        self.consultar(query=costosa, extensions=extensiones(costosa))
+        for consulta in (invalida, costosa):
+            self.assertRechazada(self.consultar(extensions=extensiones(consulta)),
+                                 'PERSISTED_QUERY_NOT_FOUND')
+
+        self.assertRechazada(
+            self.consultar(extensions={'persistedQuery': {'version': 1, 'sha256Hash': 'x' * 64}}),
+            'PERSISTED_QUERY_HASH_INVALID'
+        )
+        consulta = '{ allLibros { isbn } }'
+        with mock.patch.object(caches['default'], 'set') as guardar:
+            self.consultar(query=consulta, extensions=extensiones(consulta))
+        guardar.assert_called_once_with(f'graphql:persistida:{huella(consulta)}', consulta, 60)
+
+    def test_mutacion_por_get(self):
+        peticion = RequestFactory().get('/graphql', {
+            'query': 'mutation { actualizarStockLibro(libroId: 1, cantidad: 1) { mensaje } }'
+        })
+        self.assertEqual(self.vista(peticion).status_code, 405)
+
+
+class ConexionesGraphQLTests(TestCase):
+    """Conexiones Relay con cursor keyset para las listas de libros"""
+
+    CONSULTA = '''query ($after: String) {
+        allLibrosConexion(first: 2, after: $after) {
+            pageInfo { hasNextPage hasPreviousPage endCursor }
+            edges { node { titulo } }
+        }
+    }'''
+
+    def setUp(self):
+        self.libros = [
+            crear_libro(titulo=f'Libro {i}', isbn=f'978000000000{i}') for i in range(5)
+        ]
+
+    def ejecutar(self, consulta, **variables):
+        with CaptureQueriesContext(connection) as capturadas:
+            resultado = schema.execute(
+                consulta, variable_values=variables, context_value=RequestFactory().get('/')
+            )
+        return resultado, [q['sql'] for q in capturadas]
+
+    def test_recorrer_paginas(self):
+        titulos, after, paginas = [], None, 0
+        while True:
+            resultado, sql = self.ejecutar(self.CONSULTA, after=after)
+            self.assertIsNone(resultado.errors)
+            conexion = resultado.data['allLibrosConexion']
+            titulos += [edge['node']['titulo'] for edge in conexion['edges']]
+            self.assertEqual(conexion['pageInfo']['hasPreviousPage'], after is not None)
+            # Una consulta por página, sin OFFSET ni COUNT
+            self.assertEqual(len(sql), 1)
+            self.assertNotIn('OFFSET', sql[0])
+            self.assertNotIn('COUNT', sql[0])
+            paginas += 1
+            if not conexion['pageInfo']['hasNextPage']:
+                break
+            after = conexion['pageInfo']['endCursor']
+        self.assertEqual(paginas, 3)
+        self.assertEqual(titulos, [f'Libro {i}' for i in reversed(range(5))])
+
+    def test_total_solo_si_se_pide(self):
+        resultado, sql = self.ejecutar('''{
+            librosPorAutorConexion(autorId: %d, first: 1) { totalCount edges { node { isbn } } }
+        }''' % self.libros[0].autor_id)
+        self.assertIsNone(resultado.errors)
+        self.assertEqual(resultado.data['librosPorAutorConexion']['totalCount'], 5)
+        self.assertEqual(len(sql), 2)
+
+    def test_maximo_de_pagina(self):
+        with self.settings(GRAPHQL_PAGINA_MAXIMA=3):
+            resultado, _ = self.ejecutar(
+                '{ librosDisponiblesConexion(first: 1000) { edges { cursor } } }'
+            )
+        self.assertEqual(len(resultado.data['librosDisponiblesConexion']['edges']), 3)
+
+    def test_cursor_invalido(self):
+        resultado, _ = self.ejecutar(self.CONSULTA, after='no-es-un-cursor')
+        self.assertEqual(resultado.errors[0].message, 'Cursor inválido')
+
+    def test_busqueda_por_posicion(self):
+        consulta = '''query ($after: String) {
+            buscarLibrosConexion(titulo: "libro", first: 3, after: $after) {
+                pageInfo { hasNextPage endCursor } edges { node { id } }
+            }
+        }'''
+        primera, _ = self.ejecutar(consulta)
+        conexion = primera.data['buscarLibrosConexion']
+        self.assertTrue(conexion['pageInfo']['hasNextPage'])
+        segunda, _ = self.ejecutar(consulta, after=conexion['pageInfo']['endCursor'])
+        ids = [edge['node']['id'] for pagina in (primera, segunda)
+               for edge in pagina.data['buscarLibrosConexion']['edges']]
+        self.assertEqual(sorted(map(int, ids)), sorted(libro.pk for libro in self.libros))
+        self.assertFalse(segunda.data['buscarLibrosConexion']['pageInfo']['hasNextPage'])
+
+    def test_listas_acotadas(self):
+        with self.settings(GRAPHQL_MAX_LISTA=2):
+            resultado, _ = self.ejecutar('{ allLibros { id } }')
+        self.assertEqual(len(resultado.data['allLibros']), 2)
+
+    def test_costo_usa_first(self):
+        documento = parse('{ allLibrosConexion(first: 10) { totalCount edges { node { titulo } } } }')
+        # conexión 1 + totalCount 1 + edges 10 + node 10 + titulo 10
+        self.assertEqual(calcular_costo(schema.graphql_schema, documento).campos, 32)
+
+
+class AjusteStockMasivoTests(TestCase):
+    """POST /api/libros/ajustar_stock/ y la mutación actualizarStockLibros"""
+
+    def setUp(self):
+        self.libros = [
+            crear_libro(titulo=f'Libro {i}', isbn=f'978000000000{i}', stock=2) for i in range(4)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('inventario', password='x'))
+
+    def ajustar(self, ajustes):
+        return self.client.post('/api/libros/ajustar_stock/', ajustes, format='json')
+
+    def stocks(self):
+        return {
+            libro.pk: (libro.stock, libro.estado)
+            for libro in Libro.objects.filter(pk__in=[l.pk for l in self.libros])
+        }
+
+    def test_ajustes_mixtos(self):
+        uno, dos, tres, cuatro = self.libros
+        Libro.objects.filter(pk=tres.pk).update(stock=0, estado=Libro.PRESTADO)
+        Libro.objects.filter(pk=cuatro.pk).update(estado=Libro.MANTENIMIENTO)
+        respuesta = self.ajustar([
+            {'libro_id': uno.pk, 'cantidad': 3},
+            {'isbn': dos.isbn, 'stock': 0},
+            {'libro_id': tres.pk, 'cantidad': 4},
+            {'isbn': cuatro.isbn, 'stock': 7},
+            # Se acumula sobre el ajuste anterior del mismo libro
+            {'libro_id': uno.pk, 'cantidad': -10},
+        ])
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['libros'], [
+            {'libro_id': uno.pk, 'isbn': uno.isbn, 'stock': 0, 'estado': Libro.PRESTADO},
+            {'libro_id': dos.pk, 'isbn': dos.isbn, 'stock': 0, 'estado': Libro.PRESTADO},
+            {'libro_id': tres.pk, 'isbn': tres.isbn, 'stock': 4, 'estado': Libro.DISPONIBLE},
+            {'libro_id': cuatro.pk, 'isbn': cuatro.isbn, 'stock': 7, 'estado': Libro.MANTENIMIENTO},
+        ])
+        self.assertEqual(self.stocks(), {
+            libro['libro_id']: (libro['stock'], libro['estado'])
+            for libro in respuesta.json()['libros']
+        })
+
+    def test_todo_o_nada(self):
+        antes = self.stocks()
+        for ajustes, errores in [
+            ([{'libro_id': self.libros[0].pk, 'cantidad': 1}, {'isbn': '9789999999999', 'cantidad': 1}],
+             [{'ajuste': 1, 'errores': {'libro': ['El libro no existe']}}]),
+            ([{'libro_id': self.libros[0].pk, 'cantidad': 1}, {'libro_id': self.libros[1].pk}],
+             [{'ajuste': 1, 'errores': {'non_field_errors': ['Indique cantidad o stock (solo uno)']}}]),
+        ]:
+            with self.subTest(ajustes=ajustes):
+                respuesta = self.ajustar(ajustes)
+                self.assertEqual(respuesta.status_code, 400)
+                self.assertEqual(respuesta.json()['errores'], errores)
+                self.assertEqual(self.stocks(), antes)
+
+    def test_consultas_no_crecen(self):
+        ajustes = [{'libro_id': libro.pk, 'cantidad': 1} for libro in self.libros] * 10
+        with CaptureQueriesContext(connection) as capturadas:
+            self.assertEqual(self.ajustar(ajustes).status_code, 200)
+        sql = [q['sql'] for q in capturadas if 'libros_libro' in q['sql']]
+        # Lectura de las filas (en orden de id, para los candados) y un UPDATE
+        self.assertEqual(len(sql), 2)
+        self.assertIn('ORDER BY "libros_libro"."id" ASC', sql[0])
+        self.assertEqual({stock for stock, _ in self.stocks().values()}, {12})
+
+    def test_requiere_autenticacion(self):
+        respuesta = APIClient().post('/api/libros/ajustar_stock/', [], format='json')
+        self.assertIn(respuesta.status_code, (401, 403))
+
+    def test_mutacion(self):
+        resultado = schema.execute('''mutation ($ajustes: [AjusteStockInput!]!) {
+            actualizarStockLibros(ajustes: $ajustes) { mensaje libros { isbn stock estado } }
+        }''', variable_values={'ajustes': [
+            {'isbn': self.libros[0].isbn, 'cantidad': -2},
+            {'libroId': self.libros[1].pk, 'stock': 5},
+        ]})
+        self.assertIsNone(resultado.errors)
+        self.assertEqual(resultado.data['actualizarStockLibros']['libros'], [
+            {'isbn': self.libros[0].isbn, 'stock': 0, 'estado': Libro.PRESTADO},
+            {'isbn': self.libros[1].isbn, 'stock': 5, 'estado': Libro.DISPONIBLE},
+        ])
+
+        resultado = schema.execute('''mutation {
+            actualizarStockLibros(ajustes: [{isbn: "9789999999999", cantidad: 1}]) { mensaje }
+        }''')
+        self.assertEqual(resultado.errors[0].extensions['errores'][0]['ajuste'], 0)
+
+    @override_settings(AJUSTES_STOCK_MAX_FILAS=3)
+    def test_limite_de_ajustes_en_rest_y_graphql(self):
+        antes = self.stocks()
+        ajustes = [{'libro_id': libro.pk, 'cantidad': 1} for libro in self.libros]
+        respuesta = self.ajustar(ajustes)
+        self.assertEqual(respuesta.status_code, 400)
+        self.assertEqual(respuesta.json(), {'error': 'Máximo 3 ajustes por solicitud'})
+
+        resultado = schema.execute('''mutation ($ajustes: [AjusteStockInput!]!) {
+            actualizarStockLibros(ajustes: $ajustes) { mensaje }
+        }''', variable_values={'ajustes': [
+            {'libroId': libro.pk, 'cantidad': 1} for libro in self.libros
+        ]})
+        self.assertEqual(resultado.errors[0].message, 'Máximo 3 ajustes por solicitud')
+        self.assertEqual(self.stocks(), antes)
+
+
+class SuscripcionesGraphQLTests(TestCase):
+    """ws/graphql/ con el protocolo graphql-transport-ws"""
+
+    LIBRO = 'subscription ($ids: [ID!]!) { libroActualizado(ids: $ids) { id stock disponible } }'
+
+    def setUp(self):
+        self.categoria = Categoria.objects.create(nombre='Novela')
+        self.libro = crear_libro(categoria=self.categoria, stock=2)
+
+    async def conectar(self, subprotocolos=('graphql-transport-ws',)):
+        comunicador = ApplicationCommunicator(GraphQLSuscripcionesConsumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/graphql/', 'headers': [], 'query_string': b'',
+            'subprotocols': list(subprotocolos),
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        return comunicador
+
+    async def enviar(self, comunicador, mensaje):
+        await comunicador.send_input({'type': 'websocket.receive', 'text': json.dumps(mensaje)})
+
+    async def recibir(self, comunicador):
+        return json.loads((await comunicador.receive_output())['text'])
+
+    async def iniciar(self):
+        comunicador = await self.conectar()
+        aceptado = await comunicador.receive_output()
+        self.assertEqual(aceptado['subprotocol'], 'graphql-transport-ws')
+        await self.enviar(comunicador, {'type': 'connection_init'})
+        self.assertEqual(await self.recibir(comunicador), {'type': 'connection_ack'})
+        return comunicador
+
+    async def suscribir(self, comunicador, operacion, query, **variables):
+        await self.enviar(comunicador, {
+            'type': 'subscribe', 'id': operacion, 'payload': {'query': query, 'variables': variables}
+        })
+        # La suscripción ya escucha cuando el consumer procesó el mensaje
+        await comunicador.receive_nothing(0.05)
+
+    async def cerrar(self, comunicador):
+        await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await comunicador.wait()
+
+    async def test_libro_actualizado(self):
+        comunicador = await self.iniciar()
+        await self.enviar(comunicador, {'type': 'ping'})
+        self.assertEqual(await self.recibir(comunicador), {'type': 'pong'})
+        await self.suscribir(comunicador, '1', self.LIBRO, ids=[str(self.libro.pk)])
+
+        datos = instantanea(self.libro)
+        await publicar([datos])
+        self.assertEqual(await self.recibir(comunicador), {'type': 'next', 'id': '1', 'payload': {
+            'data': {'libroActualizado': {'id': str(self.libro.pk), 'stock': 2, 'disponible': True}}
+        }})
+        # Sin cambios no se envía nada
+        await publicar([datos])
+        self.assertTrue(await comunicador.receive_nothing(0.05))
+        await publicar([dict(datos, stock=0, disponible=False)])
+        mensaje = await self.recibir(comunicador)
+        self.assertEqual(mensaje['payload']['data']['libroActualizado']['stock'], 0)
+
+        await self.enviar(comunicador, {'type': 'complete', 'id': '1'})
+        await publicar([dict(datos, stock=5)])
+        self.assertTrue(await comunicador.receive_nothing(0.05))
+        await self.cerrar(comunicador)
+
+    async def test_disponibilidad_categoria(self):
+        comunicador = await self.iniciar()
+        await self.suscribir(
+            comunicador, 'cat',
+            'subscription ($id: ID!) { disponibilidadCategoria(id: $id) { id disponible } }',
+            id=str(self.categoria.pk),
+        )
+        datos = instantanea(self.libro)
+        for cambio in [{}, {'stock': 1}, {'stock': 0, 'disponible': False}, {'estado': 'prestado'}]:
+            datos = dict(datos, **cambio)
+            await publicar([datos])
+        disponibles = [
+            (await self.recibir(comunicador))['payload']['data']['disponibilidadCategoria']['disponible']
+            for _ in range(2)
+        ]
+        self.assertEqual(disponibles, [True, False])
+        self.assertTrue(await comunicador.receive_nothing(0.05))
+        await self.cerrar(comunicador)
+
+    async def test_guardar_publica_al_confirmar(self):
+        comunicador = await self.iniciar()
+        await self.suscribir(comunicador, '1', self.LIBRO, ids=[str(self.libro.pk)])
+
+        def guardar():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.libro.stock = 9
+                self.libro.save()
+        await sync_to_async(guardar)()
+        mensaje = await self.recibir(comunicador)
+        self.assertEqual(mensaje['payload']['data']['libroActualizado']['stock'], 9)
+        await self.cerrar(comunicador)
+
+    async def test_libro_que_cambia_de_categoria_avisa_a_la_anterior(self):
+        otra = await Categoria.objects.acreate(nombre='Ensayo')
+        comunicador = await self.iniciar()
+        await self.suscribir(
+            comunicador, 'cat',
+            'subscription ($id: ID!) { disponibilidadCategoria(id: $id) { id disponible categoriaId } }',
+            id=str(self.categoria.pk),
+        )
+
+        def mover():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.libro.categoria = otra
+                self.libro.save()
+        await sync_to_async(mover)()
+        mensaje = await self.recibir(comunicador)
+        self.assertEqual(mensaje['payload']['data']['disponibilidadCategoria'], {
+            'id': str(self.libro.pk), 'disponible': True, 'categoriaId': str(otra.pk),
+        })
+        # Ya no es de la categoría: sus cambios siguientes no llegan
+        await publicar([dict(instantanea(self.libro), stock=0, disponible=False)])
+        self.assertTrue(await comunicador.receive_nothing(0.05))
+        await self.cerrar(comunicador)
+
+    async def test_cola_guarda_la_ultima_instantanea_de_cada_libro(self):
+        cola = ColaLibros(maximo=2)
+        for libro_id, stock in [(1, 1), (2, 1), (1, 2), (3, 1)]:
+            cola.poner({'id': libro_id, 'stock': stock})
+        self.assertEqual((len(cola), cola.descartados), (2, 1))
+        self.assertEqual(await cola.obtener(), {'id': 2, 'stock': 1})
+        self.assertEqual(await cola.obtener(), {'id': 3, 'stock': 1})
+
+    async def test_errores_de_protocolo(self):
+        comunicador = await self.conectar(subprotocolos=())
+        self.assertEqual((await comunicador.receive_output())['type'], 'websocket.close')
+
+        comunicador = await self.conectar()
+        await comunicador.receive_output()
+        await self.enviar(comunicador, {'type': 'subscribe', 'id': '1', 'payload': {'query': self.LIBRO}})
+        self.assertEqual(await comunicador.receive_output(), {'type': 'websocket.close', 'code': 4401})
+
+        comunicador = await self.iniciar()
+        await self.enviar(comunicador, {
+            'type': 'subscribe', 'id': '1', 'payload': {'query': '{ allLibros { id } }'}
+        })
+        mensaje = await self.recibir(comunicador)
+        self.assertEqual((mensaje['type'], mensaje['id']), ('error', '1'))
+        await self.enviar(comunicador, {'type': 'subscribe', 'id': '2', 'payload': {
+            'query': self.LIBRO, 'variables': {'ids': [str(i) for i in range(101)]}
+        }})
+        mensaje = await self.recibir(comunicador)
+        self.assertEqual((mensaje['type'], mensaje['id']), ('error', '2'))
+        self.assertIn('como mucho 100', mensaje['payload'][0]['message'])
+        await self.cerrar(comunicador)
+
+    def test_http_rechaza_suscripciones(self):
+        vista = GraphQLCodecView.as_view(schema=schema)
+        peticion = RequestFactory().post(
+            '/graphql', json.dumps({'query': self.LIBRO, 'variables': {'ids': ['1']}}),
+            content_type='application/json'
+        )
+        errores = json.loads(vista(peticion).content)['errors']
+        self.assertIn('WebSocket', errores[0]['message'])
+
+
+@override_settings(NOTIFICACIONES_VENTANA=0.01)
+class NotificacionesAgrupadasTests(TransactionTestCase):
+    """libro_update en ws/notificaciones/ se difunde en lotes por ventana"""
+
+    def setUp(self):
+        self.libros = [
+            crear_libro(titulo=f'Libro {i}', isbn=f'978000000000{i}', stock=i + 1) for i in range(2)
+        ]
+        esperar_publicaciones()
+        # Los cambios por UPDATE directo no pasan por el cache
+        recientes.limpiar()
+
+    async def conectar(self):
+        comunicador = ApplicationCommunicator(NotificacionesConsumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/notificaciones/', 'headers': [],
+            'query_string': b'', 'subprotocols': [],
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        await comunicador.receive_output()
+        await comunicador.receive_output()
+        return comunicador
+
+    async def pedir(self, comunicador, libro_id):
+        await comunicador.send_input({
+            'type': 'websocket.receive', 'text': json.dumps({'type': 'libro_update', 'libro_id': libro_id})
+        })
+
+    async def recibir(self, comunicador):
+        return json.loads((await comunicador.receive_output())['text'])
+
+    async def test_un_frame_por_ventana(self):
+        uno, dos = self.libros
+        emisor, oyente = await self.conectar(), await self.conectar()
+        for libro_id in [uno.pk, dos.pk, uno.pk, 'x', 999999, dos.pk]:
+            await self.pedir(emisor, libro_id)
+        await Libro.objects.filter(pk=uno.pk).aupdate(stock=7)
+
+        for comunicador in (emisor, oyente):
+            mensaje = await self.recibir(comunicador)
+            self.assertEqual(mensaje['type'], 'libros_actualizados')
+            self.assertEqual(
+                [(libro['id'], libro['stock']) for libro in mensaje['libros']],
+                [(uno.pk, 7), (dos.pk, 2)]
+            )
+            self.assertTrue(await comunicador.receive_nothing(0.05))
+            await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await comunicador.wait()
+
+    @override_settings(NOTIFICACIONES_MAX_LOTE=1)
+    async def test_lotes_acotados(self):
+        comunicador = await self.conectar()
+        for libro in self.libros:
+            await self.pedir(comunicador, libro.pk)
+        lotes = [(await self.recibir(comunicador))['libros'] for _ in self.libros]
+        self.assertEqual([[datos['id'] for datos in lote] for lote in lotes], [
+            [libro.pk] for libro in self.libros
+        ])
+        await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await comunicador.wait()
+
+
+@override_settings(NOTIFICACIONES_VENTANA=0.01)
+class TemasNotificacionesTests(TransactionTestCase):
+    """Suscripción por temas en ws/notificaciones/"""
+
+    def setUp(self):
+        self.novela, self.ensayo = (
+            Categoria.objects.create(nombre=nombre) for nombre in ('Novela', 'Ensayo')
+        )
+        self.uno = crear_libro(isbn='9780000000001', categoria=self.novela)
+        self.dos = crear_libro(isbn='9780000000002', categoria=self.ensayo)
+        esperar_publicaciones()
+        _disponibilidad.clear()
+        recientes.limpiar()
+
+    async def conectar(self, temas=None):
+        comunicador = ApplicationCommunicator(NotificacionesConsumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/notificaciones/', 'headers': [],
+            'query_string': f'temas={temas}'.encode() if temas else b'', 'subprotocols': [],
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        await comunicador.receive_output()
+        bienvenida = json.loads((await comunicador.receive_output())['text'])
+        return comunicador, bienvenida['temas']
+
+    async def enviar(self, comunicador, mensaje):
+        await comunicador.send_input({'type': 'websocket.receive', 'text': json.dumps(mensaje)})
+
+    async def recibir(self, comunicador):
+        return json.loads((await comunicador.receive_output())['text'])
+
+    async def libros_recibidos(self, comunicador):
+        ids = []
+        while not await comunicador.receive_nothing(0.05):
+            mensaje = await self.recibir(comunicador)
+            ids += [libro['id'] for libro in mensaje['libros']]
+        return sorted(ids)
+
+    async def cerrar(self, *comunicadores):
+        for comunicador in comunicadores:
+            await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await comunicador.wait()
+
+    async def test_cada_conexion_recibe_sus_temas(self):
+        todos, temas = await self.conectar()
+        self.assertEqual(temas, ['todos'])
+        libro, temas = await self.conectar(f'libro:{self.uno.pk}')
+        self.assertEqual(temas, [f'libro:{self.uno.pk}'])
+        categoria, _ = await self.conectar(f'categoria:{self.ensayo.pk}')
+        for libro_id in (self.uno.pk, self.dos.pk):
+            await self.enviar(todos, {'type': 'libro_update', 'libro_id': libro_id})
+
+        self.assertEqual(await self.libros_recibidos(todos), [self.uno.pk, self.dos.pk])
+        self.assertEqual(await self.libros_recibidos(libro), [self.uno.pk])
+        self.assertEqual(await self.libros_recibidos(categoria), [self.dos.pk])
+        await self.cerrar(todos, libro, categoria)
+
+    async def test_suscribir_y_desuscribir(self):
+        comunicador, _ = await self.conectar('disponibles')
+        await self.enviar(comunicador, {
+            'type': 'suscribir', 'temas': [f'libro:{self.dos.pk}', 'libro:x', 'todos']
+        })
+        error = await self.recibir(comunicador)
+        self.assertEqual(error['type'], 'error')
+        self.assertIn('libro:x', error['message'])
+        self.assertEqual(await self.recibir(comunicador), {
+            'type': 'suscripciones', 'temas': ['disponibles', f'libro:{self.dos.pk}', 'todos']
+        })
+        await self.enviar(comunicador, {'type': 'desuscribir', 'temas': ['todos', 'disponibles']})
+        self.assertEqual((await self.recibir(comunicador))['temas'], [f'libro:{self.dos.pk}'])
+
+        for libro_id in (self.uno.pk, self.dos.pk):
+            await self.enviar(comunicador, {'type': 'libro_update', 'libro_id': libro_id})
+        self.assertEqual(await self.libros_recibidos(comunicador), [self.dos.pk])
+        await self.cerrar(comunicador)
+
+    async def test_disponibles(self):
+        comunicador, _ = await self.conectar('disponibles')
+        await Libro.objects.filter(pk=self.dos.pk).aupdate(stock=0, estado=Libro.PRESTADO)
+        # Sin saber cómo estaba antes, el agotado también se avisa
+        for libro_id in (self.uno.pk, self.dos.pk):
+            await self.enviar(comunicador, {'type': 'libro_update', 'libro_id': libro_id})
+        self.assertEqual(await self.libros_recibidos(comunicador), [self.uno.pk, self.dos.pk])
+        # Ya se difundió como no disponible: un nuevo cambio no le interesa
+        await self.enviar(comunicador, {'type': 'libro_update', 'libro_id': self.dos.pk})
+        self.assertEqual(await self.libros_recibidos(comunicador), [])
+        await self.cerrar(comunicador)
+
+
+@override_settings(NOTIFICACIONES_VENTANA=0.01)
+class CambiosPublicadosTests(TransactionTestCase):
+    """Las escrituras publican sus instantáneas al confirmarse"""
+
+    def setUp(self):
+        self.uno = crear_libro(isbn='9780000000001', stock=2)
+        self.dos = crear_libro(isbn='9780000000002', stock=5)
+        esperar_publicaciones()
+        _disponibilidad.clear()
+        recientes.limpiar()
+
+    async def conectar(self, temas='todos'):
+        comunicador = ApplicationCommunicator(NotificacionesConsumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/notificaciones/', 'headers': [],
+            'query_string': f'temas={temas}'.encode(), 'subprotocols': [],
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        await comunicador.receive_output()
+        await comunicador.receive_output()
+        return comunicador
+
+    async def recibir(self, comunicador):
+        mensaje = json.loads((await comunicador.receive_output())['text'])
+        self.assertEqual(mensaje['type'], 'libros_actualizados')
+        return [(libro['id'], libro['stock']) for libro in mensaje['libros']]
+
+    async def cerrar(self, comunicador):
+        await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await comunicador.wait()
+
+    async def test_stock_y_prestamos_sin_consultas_extra(self):
+        comunicador = await self.conectar(f'libro:{self.uno.pk}')
+
+        def escribir():
+            with CaptureQueriesContext(connection) as consultas:
+                self.uno.actualizar_stock(3)
+            return len(consultas)
+        # El UPDATE y el refresh; publicar no consulta
+        self.assertEqual(await sync_to_async(escribir)(), 2)
+        self.assertEqual(await self.recibir(comunicador), [(self.uno.pk, 5)])
+        await sync_to_async(self.uno.prestar_ejemplar)()
+        self.assertEqual(await self.recibir(comunicador), [(self.uno.pk, 4)])
+        await self.cerrar(comunicador)
+
+    async def test_savepoint_deshecho_no_publica(self):
+        comunicador = await self.conectar()
+
+        def escribir():
+            with transaction.atomic():
+                self.uno.actualizar_stock(1)
+                try:
+                    with transaction.atomic():
+                        self.dos.actualizar_stock(1)
+                        raise ValueError
+                except ValueError:
+                    pass
+        await sync_to_async(escribir)()
+        self.assertEqual(await self.recibir(comunicador), [(self.uno.pk, 3)])
+        self.assertTrue(await comunicador.receive_nothing(0.05))
+        await self.cerrar(comunicador)
+
+    async def test_ajuste_masivo_en_un_frame(self):
+        comunicador = await self.conectar()
+        await sync_to_async(ajustar_stock)([
+            {'libro_id': self.uno.pk, 'cantidad': 1},
+            {'libro_id': self.dos.pk, 'stock': 5},
+            {'isbn': self.dos.isbn, 'cantidad': -5},
+        ])
+        self.assertEqual(await self.recibir(comunicador), [(self.uno.pk, 3), (self.dos.pk, 0)])
+        self.assertTrue(await comunicador.receive_nothing(0.05))
+        await self.cerrar(comunicador)
+
+    async def test_libro_update_lee_solo_lo_que_falta(self):
+        await sync_to_async(self.uno.actualizar_stock)(1)
+        comunicador = await self.conectar()
+        with mock.patch.object(difusion, 'instantaneas', wraps=difusion.instantaneas) as leer:
+            for libro in (self.uno, self.dos):
+                await comunicador.send_input({'type': 'websocket.receive', 'text': json.dumps(
+                    {'type': 'libro_update', 'libro_id': libro.pk}
+                )})
+            self.assertEqual(await self.recibir(comunicador), [(self.uno.pk, 3), (self.dos.pk, 5)])
+        leer.assert_called_once_with([self.dos.pk])
+        await self.cerrar(comunicador)
+
+
+    @override_settings(CAMBIOS_CUBETAS_LIBRO=1)
+    async def test_cubetas_solo_entregan_lo_que_se_sigue(self):
+        comunicador = await self.conectar(f'libro:{self.uno.pk}')
+        # Los dos libros van en el mismo frame a la única cubeta
+        await sync_to_async(ajustar_stock)([
+            {'libro_id': self.uno.pk, 'cantidad': 1}, {'libro_id': self.dos.pk, 'cantidad': 1},
+        ])
+        self.assertEqual(await self.recibir(comunicador), [(self.uno.pk, 3)])
+        await self.cerrar(comunicador)
+
+    @override_settings(CAMBIOS_CUBETAS_LIBRO=4)
+    def test_ajuste_masivo_publica_en_segundo_plano_y_por_lotes(self):
+        libros = Libro.objects.bulk_create([
+            Libro(titulo=f'Libro {i}', isbn=f'97811{i:08d}', autor=self.uno.autor,
+                  stock=1, precio=Decimal('10'))
+            for i in range(300)
+        ])
+        capa = get_channel_layer()
+        hilos = []
+        group_send = capa.group_send
+
+        async def contar(grupo, mensaje):
+            hilos.append(threading.get_ident())
+            await group_send(grupo, mensaje)
+        with mock.patch.object(capa, 'group_send', side_effect=contar):
+            ajustar_stock([{'libro_id': libro.pk, 'cantidad': 1} for libro in libros])
+            esperar_publicaciones()
+        self.assertNotIn(threading.get_ident(), hilos)
+        # GraphQL: 4 cubetas; notificaciones: las mismas, 'todos' y
+        # 'disponibles'. Antes eran varios group_send por libro
+        self.assertEqual(len(hilos), 10)
+
+
+@override_settings(WEBSOCKET_COLA_MAXIMA=20)
+class ContrapresionTests(TestCase):
+    """Colas de salida acotadas y límite de mensajes entrantes"""
+
+    async def conectar_lento(self, consumer, ruta, demora=60, **scope):
+        """
+        Conexión cuyo cliente tarda `demora` segundos en aceptar cada frame
+        (send espera, como un servidor con el buffer del socket lleno)
+        """
+        entrada, salidas = asyncio.Queue(), []
+
+        async def enviar(mensaje):
+            salidas.append(mensaje)
+            if mensaje['type'] == 'websocket.send':
+                await asyncio.sleep(demora)
+        aplicacion = consumer.as_asgi()({
+            'type': 'websocket', 'path': ruta, 'headers': [], 'query_string': b'',
+            'subprotocols': [], **scope,
+        }, entrada.get, enviar)
+        tarea = asyncio.ensure_future(aplicacion)
+        await entrada.put({'type': 'websocket.connect'})
+        await asyncio.sleep(0.01)
+        return entrada, tarea, salidas
+
+    async def cerrar(self, conexiones):
+        for entrada, tarea, _ in conexiones:
+            await entrada.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.gather(*(tarea for _, tarea, _ in conexiones))
+
+    async def difundir(self, cantidad, inicio=0):
+        capa = get_channel_layer()
+        for numero in range(inicio, inicio + cantidad):
+            bloque = numero % 2 * 50
+            await capa.group_send('notificaciones', {'type': 'libros_actualizados', 'libros': [
+                {'id': libro_id, 'titulo': f'Libro {libro_id}', 'stock': numero}
+                for libro_id in range(bloque, bloque + 50)
+            ]})
+            await capa.group_send('chat_sala', {
+                'type': 'chat_message', 'message': 'x' * 1000, 'username': f'u{numero}'
+            })
+            # Que los consumers lean el channel layer antes de que se llene
+            await asyncio.sleep(0.001)
+
+    async def test_clientes_lentos_memoria_estable(self):
+        metricas.descartados = metricas.agrupados = 0
+        conexiones = [
+            await self.conectar_lento(NotificacionesConsumer, '/ws/notificaciones/') for _ in range(10)
+        ] + [
+            await self.conectar_lento(ChatConsumer, '/ws/chat/sala/',
+                                      url_route={'kwargs': {'room_name': 'sala'}})
+            for _ in range(10)
+        ]
+        tracemalloc.start()
+        try:
+            await self.difundir(200)
+            antes = tracemalloc.get_traced_memory()[0]
+            await self.difundir(1000, inicio=200)
+            despues = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        # Sin cota serían ~1000 frames más por conexión (decenas de MB)
+        self.assertLess(despues - antes, 1024 * 1024)
+        resumen = metricas.resumen()
+        self.assertEqual(resumen['conexiones'], 20)
+        self.assertLessEqual(resumen['cola_maxima'], 20)
+        # Los lotes de libros se juntan; el chat pierde los más viejos
+        self.assertGreater(resumen['agrupados'], 10 * 1000)
+        self.assertGreater(resumen['descartados'], 10 * 1000)
+        await self.cerrar(conexiones)
+        self.assertEqual(metricas.resumen()['conexiones'], 0)
+
+    @override_settings(WEBSOCKET_COLA_MAXIMA=2, WEBSOCKET_POLITICAS_DESBORDE={'ChatConsumer': 'desconectar'})
+    async def test_politica_desconectar(self):
+        conexion = await self.conectar_lento(ChatConsumer, '/ws/chat/sala/',
+                                             url_route={'kwargs': {'room_name': 'sala'}})
+        await self.difundir(5)
+        await asyncio.sleep(0.01)
+        self.assertEqual(conexion[2][-1], {'type': 'websocket.close', 'code': 4008})
+        await self.cerrar([conexion])
+
+    @override_settings(WEBSOCKET_MENSAJES_POR_SEGUNDO=1, WEBSOCKET_RAFAGA_MENSAJES=3)
+    async def test_limite_de_entrada(self):
+        limitados = metricas.limitados
+        comunicador = ApplicationCommunicator(NotificacionesConsumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/notificaciones/', 'headers': [],
+            'query_string': b'', 'subprotocols': [],
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        await comunicador.receive_output()
+        await comunicador.receive_output()
+        for _ in range(6):
+            await comunicador.send_input({'type': 'websocket.receive', 'text': json.dumps(
+                {'type': 'suscribir', 'temas': ['todos']}
+            )})
+        tipos = []
+        while not await comunicador.receive_nothing(0.05):
+            tipos.append(json.loads((await comunicador.receive_output())['text'])['type'])
+        self.assertEqual(tipos, ['suscripciones'] * 3 + ['error'])
+        self.assertEqual(metricas.limitados - limitados, 3)
+        await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await comunicador.wait()
+
+
+class HistorialChatTests(TestCase):
+    """Historial por sala de ws/chat/ reproducido al conectar"""
+
+    def setUp(self):
+        _memoria.salas = {}
+
+    async def conectar(self, since=None):
+        comunicador = ApplicationCommunicator(ChatConsumer.as_asgi(), {
+            'type': 'websocket', 'path': '/ws/chat/sala/', 'headers': [],
+            'query_string': f'since={since}'.encode() if since else b'', 'subprotocols': [],
+            'url_route': {'kwargs': {'room_name': 'sala'}},
+        })
+        await comunicador.send_input({'type': 'websocket.connect'})
+        await comunicador.receive_output()
+        historial = await self.recibir(comunicador)
+        self.assertEqual(historial['type'], 'historial')
+        self.assertEqual((await self.recibir(comunicador))['type'], 'system')
+        return comunicador, historial['mensajes']
+
+    async def recibir(self, comunicador):
+        return json.loads((await comunicador.receive_output())['text'])
+
+    async def escribir(self, comunicador, *mensajes):
+        ids = []
+        for mensaje in mensajes:
+            await comunicador.send_input({'type': 'websocket.receive', 'text': json.dumps(
+                {'message': mensaje, 'username': 'ana'}
+            )})
+            ids.append((await self.recibir(comunicador))['id'])
+        return ids
+
+    async def cerrar(self, *comunicadores):
+        for comunicador in comunicadores:
+            await comunicador.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await comunicador.wait()
+
+    async def test_reproduce_desde_since(self):
+        comunicador, mensajes = await self.conectar()
+        self.assertEqual(mensajes, [])
+        ids = await self.escribir(comunicador, 'uno', 'dos', 'tres')
+
+        desde_uno, mensajes = await self.conectar(since=ids[0])
+        self.assertEqual(mensajes, [
+            {'id': ids[1], 'username': 'ana', 'message': 'dos'},
+            {'id': ids[2], 'username': 'ana', 'message': 'tres'},
+        ])
+        completo, mensajes = await self.conectar(since='x')
+        self.assertEqual([mensaje['message'] for mensaje in mensajes], ['uno', 'dos', 'tres'])
+        await self.cerrar(comunicador, desde_uno, completo)
+
+    @override_settings(CHAT_HISTORIAL_MENSAJES=2)
+    async def test_guarda_los_ultimos(self):
+        comunicador, _ = await self.conectar()
+        await self.escribir(comunicador, 'uno', 'dos', 'tres')
+        otro, mensajes = await self.conectar()
+        self.assertEqual([mensaje['message'] for mensaje in mensajes], ['dos', 'tres'])
+        await self.cerrar(comunicador, otro)
+
+    async def test_vence(self):
+        comunicador, _ = await self.conectar()
+        with override_settings(CHAT_HISTORIAL_SEGUNDOS=0):
+            await self.escribir(comunicador, 'uno')
+        otro, mensajes = await self.conectar()
+        self.assertEqual(mensajes, [])
+        await self.cerrar(comunicador, otro)
@@ -0,0 +1,14 @@
+"""
+Utilidades compartidas por los módulos de la app. No importa los modelos,
+así la pueden usar también cambios.py y suscripciones.py.
+"""
+
+# Claves por consulta `IN (...)` y filas por sentencia en las escrituras en bloque
+LOTE = 1000
+
+
+def en_bloques(elementos, tamano=LOTE):
+    """Listas de hasta `tamano` elementos de `elementos`, en orden"""
+    elementos = list(elementos)
+    for inicio in range(0, len(elementos), tamano):
+        yield elementos[inicio:inicio + tamano]
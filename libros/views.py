@@ -1,4 +1,130 @@
+from django.db import connection, transaction
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed
 from django.shortcuts import render
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.views import GraphQLView, HttpError
+from graphql import ExecutionResult, GraphQLError, OperationType, execute, get_operation_ast
+
+from .codecs import JSON, codec_para_accept, codec_para_media_type
+from .consultas_graphql import (
+    consulta_persistida, preparar_documento, registrar_persistida, verificar_costo,
+)
+
 
 def chat_view(request):
-    return render(request, 'chat.html')
\ No newline at end of file
+    return render(request, 'chat.html')
+
+
+class GraphQLCodecView(GraphQLView):
+    """
+    GraphQLView con los codecs de `libros.codecs`: acepta el cuerpo en
+    msgpack/CBOR según Content-Type y responde en el formato del Accept.
+    Con batch se responde siempre JSON (la vista une los resultados como texto).
+    Además reutiliza documentos ya parseados y validados, rechaza consultas
+    por encima de los límites de costo y acepta consultas persistidas
+    (ver consultas_graphql.py). Las suscripciones van por
+    GraphQLSuscripcionesConsumer.
+    Uso en las urls del proyecto: GraphQLCodecView.as_view(graphiql=True)
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        request.codec_respuesta = JSON if self.batch else codec_para_accept(
+            request.META.get('HTTP_ACCEPT')
+        )
+        respuesta = super().dispatch(request, *args, **kwargs)
+        if respuesta.get('Content-Type') == JSON.media_type:
+            respuesta['Content-Type'] = request.codec_respuesta.media_type
+        return respuesta
+
+    def json_encode(self, request, d, pretty=False):
+        codec = getattr(request, 'codec_respuesta', JSON)
+        if pretty:
+            return super().json_encode(request, d, pretty)
+        contenido = codec.codificar(d)
+        return contenido if codec.binario else contenido.decode()
+
+    def parse_body(self, request):
+        codec = codec_para_media_type(self.get_content_type(request), por_defecto=None)
+        if codec is None or not codec.binario:
+            return super().parse_body(request)
+        try:
+            datos = codec.decodificar(request.body)
+        except Exception:
+            raise HttpError(HttpResponseBadRequest(f'Cuerpo {codec.nombre} inválido.'))
+        esperado = list if self.batch else dict
+        if not isinstance(datos, esperado):
+            raise HttpError(HttpResponseBadRequest(
+                'Se espera una lista de consultas.' if self.batch
+                else 'Se espera un objeto con la consulta.'
+            ))
+        return datos
+
+    def extensiones(self, request, data):
+        extensiones = request.GET.get('extensions') or data.get('extensions')
+        if isinstance(extensiones, str):
+            try:
+                extensiones = JSON.decodificar(extensiones)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest('Extensions are invalid JSON.'))
+        return extensiones if isinstance(extensiones, dict) else None
+
+    def execute_graphql_request(
+        self, request, data, query, variables, operation_name, show_graphiql=False
+    ):
+        """Igual que GraphQLView, pero sin volver a parsear ni validar"""
+        extensiones = self.extensiones(request, data)
+        try:
+            query = consulta_persistida(query, extensiones)
+        except GraphQLError as error:
+            return ExecutionResult(errors=[error])
+        if not query:
+            return super().execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql
+            )
+
+        schema = self.schema.graphql_schema
+        documento, errores = preparar_documento(schema, query)
+        if errores:
+            return ExecutionResult(errors=errores)
+
+        operacion = get_operation_ast(documento, operation_name)
+        if request.method.lower() == 'get' and operacion and operacion.operation != OperationType.QUERY:
+            if show_graphiql:
+                return None
+            raise HttpError(HttpResponseNotAllowed(
+                ['POST'],
+                f'Can only perform a {operacion.operation.value} operation from a POST request.',
+            ))
+
+        if operacion and operacion.operation == OperationType.SUBSCRIPTION:
+            return ExecutionResult(errors=[
+                GraphQLError('Las suscripciones se sirven por WebSocket (ws/graphql/)')
+            ])
+
+        errores = verificar_costo(schema, documento, operation_name, variables)
+        if errores:
+            return ExecutionResult(errors=errores)
+        registrar_persistida(query, extensiones)
+
+        opciones = {
+            'root_value': self.get_root_value(request),
+            'context_value': self.get_context(request),
+            'variable_values': variables,
+            'operation_name': operation_name,
+            'middleware': self.get_middleware(request),
+            'execution_context_class': self.execution_context_class,
+        }
+        try:
+            if operacion and operacion.operation == OperationType.MUTATION and (
+                graphene_settings.ATOMIC_MUTATIONS is True
+                or connection.settings_dict.get('ATOMIC_MUTATIONS', False) is True
+            ):
+                with transaction.atomic():
+                    resultado = execute(schema, documento, **opciones)
+                    if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                        transaction.set_rollback(True)
+                return resultado
+            return execute(schema, documento, **opciones)
+        except Exception as error:
+            return ExecutionResult(errors=[error])